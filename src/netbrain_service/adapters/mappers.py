@@ -1,65 +1,107 @@
-from test_services.atf.common import (
-    Message,
-    Command,
-    Event,
-    get_cid,
-    get_yesterday,
-)
-
-from test_services.atf import (
-    commands,
-    events,
-)
-
-from test_services import logger
-
-from datetime import (
-    datetime,
-    timezone,
-)
-
-
-def documents_to_messages(documents: list[dict]) -> list[Message]:
-    return_messages: list[Message] = []
-    for document in documents:
-        if document.get('meta_message_type') == 'Command':
-            return_messages.append(convert_to_command(document))
-        elif document.get('meta_message_type') == 'Event':
-            return_messages.append(convert_to_event(document))
-        else:
-            logger.error(f'Invalid document field: meta_message_type must be Command or Event, not {document.get("meta_message_type")}')
-    return return_messages
-
-
-def convert_to_event(document: dict) -> Event:
-    """
-    The purpose of this function is to convert formatted documents from test_services.external_message_queue
-    collection into Events that can be passed to the Messagebus.
-    """
-    message_type: str = document.get('message_type', '')
-    event: Event = events.EmptyEvent(cid=get_cid(), create_time=datetime.now(timezone.utc))
-
-
-def convert_to_command(document: dict) -> Command:
-    """
-    This function is used to convert formatted documents from test_services.external_message_queue
-    collection into Commands that can be passed to the Messagebus.
-
-    To add a new mapping, just follow the format established below, capturing the message
-    type and assigning the correct command to the command variable.
-
-    Calling code expects a Command to be returned, so we use EmptyCommand for the scenario
-    that the command provided has not yet been mapped.
-    """
-
-    message_type: str = document.get('message_type', '')
-    command: Command = commands.EmptyCommand(cid=get_cid(), create_time=datetime.now(timezone.utc))
-
-
-command_types = {
-
-}
-
-event_types = {
-
-}
+import logging
+
+from src.netbrain_service.domain.common import (
+    Message,
+    Command,
+    Event,
+    get_cid,
+    get_yesterday,
+)
+
+from src.netbrain_service.domain import commands
+
+from src.netbrain_service.adapters.odm import ExternalMessageQueue
+
+from dataclasses import fields
+
+from datetime import (
+    datetime,
+    timezone,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def documents_to_messages(documents: list[dict]) -> list[Message]:
+    return_messages: list[Message] = []
+    for document in documents:
+        message = None
+        try:
+            if document.get('meta_message_type') == 'Command':
+                message = convert_to_command(document)
+            elif document.get('meta_message_type') == 'Event':
+                message = convert_to_event(document)
+            else:
+                logger.error('Invalid document field: meta_message_type must be Command or Event, not %s', document.get("meta_message_type"))
+        except Exception as e:
+            logger.error('Unable to map External Message Queue document %s to a Message', document.get("_id"), exc_info=True)
+        finally:
+            if message is None:
+                # nothing will consume it, so don't let its in_flight claim
+                # block the next document for the same domain/campaign
+                try:
+                    ExternalMessageQueue.release_document(document.get('_id'))
+                except Exception as e:
+                    logger.error('Unable to release External Message Queue document %s', document.get("_id"), exc_info=True)
+        if message is not None:
+            return_messages.append(message)
+    return return_messages
+
+
+def convert_to_event(document: dict) -> Event:
+    """
+    The purpose of this function is to convert formatted documents from test_services.external_message_queue
+    collection into Events that can be passed to the Messagebus.
+
+    Mapped the same way as convert_to_command, through event_types. A
+    message_type that has not yet been mapped returns None, and
+    documents_to_messages releases the document's in_flight claim.
+    """
+    message_type: str = document.get('message_type', '')
+    event_type = event_types.get(message_type)
+    if event_type is None:
+        logger.error('No Event mapped for message_type %s', message_type)
+        return None
+    return _build_message(event_type, document)
+
+
+def convert_to_command(document: dict) -> Command:
+    """
+    This function is used to convert formatted documents from test_services.external_message_queue
+    collection into Commands that can be passed to the Messagebus.
+
+    To add a new mapping, just follow the format established below, capturing the message
+    type and assigning the correct command to the command variable.
+
+    A message_type that has not yet been mapped returns None, and documents_to_messages
+    releases the document's in_flight claim.
+    """
+
+    message_type: str = document.get('message_type', '')
+    command_type = command_types.get(message_type)
+    if command_type is None:
+        logger.error('No Command mapped for message_type %s', message_type)
+        return None
+    return _build_message(command_type, document)
+
+
+def _build_message(message_type: type, document: dict) -> Message:
+    """the Message of message_type, its fields read from the document"""
+    field_names = {field.name for field in fields(message_type)} - {'cid', 'create_time'}
+    message: Message = message_type(
+        cid=document.get('cid') or get_cid(),
+        create_time=document.get('create_date') or datetime.now(timezone.utc),
+        **{name: document[name] for name in field_names if name in document},
+    )
+    if document.get('trace_context'):
+        message.trace_context = document['trace_context']
+    return message
+
+
+command_types = {
+    'UpdateCampaignResults': commands.UpdateCampaignResults,
+}
+
+event_types = {
+
+}
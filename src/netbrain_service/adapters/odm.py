@@ -1,22 +1,218 @@
-from mongoengine import (
-    Document
-)
-
-from datetime import (
-    datetime,
-    timezone,
-)
-
-"""
-The purpose of this adapter is Object Document Mapping, or
-mapping data objects to documents. Our current ODM is MongoEngine.
-"""
-
-
-class Sessions(Document):
-    token = StringField(required=True)
-    datetime = DateTimeField(required=True)
-
-
-class ExternalMessageQueue(Document):
-    pass
+from mongoengine import (
+    Document,
+    StringField,
+    DateTimeField,
+    BooleanField,
+    IntField,
+    DictField,
+)
+
+from datetime import (
+    datetime,
+    timezone,
+    timedelta,
+)
+
+from mongoengine import Q
+from mongoengine.errors import NotUniqueError
+
+from pymongo import ReadPreference
+from pymongo.write_concern import WriteConcern
+
+from src.netbrain_service.config import settings
+
+"""
+The purpose of this adapter is Object Document Mapping, or
+mapping data objects to documents. Our current ODM is MongoEngine.
+"""
+
+
+class TunedDocument(Document):
+    """
+    Document whose collection carries its own write concern and read
+    preference instead of the client defaults, declared in meta:
+
+        meta = {
+            'collection': 'parsed_record',
+            'write_concern': {'w': 1},
+            'read_preference': 'primaryPreferred',
+        }
+
+    Either can be overridden per collection without a code change with
+    the MONGO_COLLECTION_OPTIONS setting, ex.
+        MONGO_COLLECTION_OPTIONS = {parsed_record = {write_concern = {w = "majority"}}}
+
+    read_preference is the pymongo name (primary, primaryPreferred,
+    secondary, secondaryPreferred, nearest).
+    """
+    meta = {'abstract': True}
+
+    @classmethod
+    def _get_collection(cls):
+        if getattr(cls, '_collection', None) is None:
+            collection = super()._get_collection()
+            overrides = (settings.get('MONGO_COLLECTION_OPTIONS') or {}).get(collection.name, {})
+            write_concern = overrides.get('write_concern', cls._meta.get('write_concern'))
+            read_preference = overrides.get('read_preference', cls._meta.get('read_preference'))
+            options = {}
+            if write_concern:
+                options['write_concern'] = WriteConcern(**write_concern)
+            if read_preference:
+                options['read_preference'] = getattr(ReadPreference, _read_preference_attr(read_preference))
+            cls._collection = collection.with_options(**options) if options else collection
+        return cls._collection
+
+
+def _read_preference_attr(name: str) -> str:
+    """'secondaryPreferred' -> 'SECONDARY_PREFERRED'"""
+    return ''.join(f"_{char}" if char.isupper() else char for char in name).upper()
+
+
+class Sessions(Document):
+    token = StringField(required=True)
+    datetime = DateTimeField(required=True)
+
+
+class ExternalMessageQueue(TunedDocument):
+    """
+    Messages placed here by producers outside of the Service Daemon,
+    such as the PollingManager, to be converted to Messages and passed
+    to the MessageBus.
+
+    in_flight is True from the time a Message is queued until its
+    consumer has finished with it. The unique partial index on
+    (message_type, domain, campaign) only covers in_flight documents,
+    so a second UpdateCampaignResults for a domain/campaign that is
+    still queued or running is rejected with NotUniqueError at insert
+    time, while finished documents are kept for history.
+
+    A claim is only honored for EXTERNAL_MESSAGE_QUEUE_LEASE seconds
+    after claimed_at. A document whose consumer crashed, or that was
+    never mapped or consumed, would otherwise block its domain/campaign
+    forever, so enqueue() reclaims an expired claim and retries.
+    """
+    meta = {
+        'collection': 'external_message_queue',
+        # queue entries are claims, they must survive a failover
+        'write_concern': {'w': 'majority'},
+        'indexes': [
+            {
+                'fields': ['message_type', 'domain', 'campaign'],
+                'unique': True,
+                'partialFilterExpression': {'in_flight': True},
+            },
+        ],
+    }
+    meta_message_type = StringField(required=True)
+    message_type = StringField(required=True)
+    domain = StringField()
+    campaign = StringField()
+    cid = StringField(required=True)
+    create_date = DateTimeField(required=True)
+    in_flight = BooleanField(default=True)
+    claimed_at = DateTimeField(default=lambda: datetime.now(timezone.utc))
+    completed_date = DateTimeField()
+    # released by reclaim_expired rather than by its consumer
+    lease_expired = BooleanField(default=False)
+    # w3c trace context of the producer, see tracing.inject_trace_context
+    trace_context = DictField()
+
+    @classmethod
+    def enqueue(cls, **fields) -> bool:
+        """
+        Save a new in_flight document. Returns False when a matching one
+        is still in flight within its lease, an expired claim is reclaimed
+        and the save retried once.
+        """
+        document = cls(**fields)
+        try:
+            document.save()
+        except NotUniqueError:
+            if not cls.reclaim_expired(message_type=document.message_type,
+                                       domain=document.domain,
+                                       campaign=document.campaign):
+                return False
+            try:
+                document.save()
+            except NotUniqueError:
+                # another producer claimed it first
+                return False
+        return True
+
+    @classmethod
+    def reclaim_expired(cls, lease: float = None, **fields) -> int:
+        """
+        Release in_flight documents matching fields whose claim is older
+        than lease seconds (EXTERNAL_MESSAGE_QUEUE_LEASE), returns how many.
+        Documents from before claimed_at existed are aged by create_date.
+        """
+        lease = lease or settings.get('EXTERNAL_MESSAGE_QUEUE_LEASE', 900)
+        now = datetime.now(timezone.utc)
+        cutoff = now - timedelta(seconds=lease)
+        return cls.objects(
+            Q(claimed_at__lt=cutoff) | Q(claimed_at=None, create_date__lt=cutoff),
+            in_flight=True,
+            **fields,
+        ).update(
+            set__in_flight=False,
+            set__completed_date=now,
+            set__lease_expired=True,
+        )
+
+    @classmethod
+    def release_document(cls, document_id):
+        """release the claim of one document, ex. when it could not be mapped to a Message"""
+        cls.objects(id=document_id, in_flight=True).update(
+            set__in_flight=False,
+            set__completed_date=datetime.now(timezone.utc),
+        )
+
+    @classmethod
+    def release(cls, message_type: str, **fields):
+        """
+        Mark the in_flight document matching message_type and fields
+        (ex. domain and campaign) as finished so that the next interval
+        can enqueue a new one.
+        """
+        cls.objects(
+            message_type=message_type,
+            in_flight=True,
+            **fields,
+        ).update(
+            set__in_flight=False,
+            set__completed_date=datetime.now(timezone.utc),
+        )
+
+
+class TestRequestOutbox(TunedDocument):
+    """
+    Transactional outbox of notifications for Test Requests (TRID).
+
+    Consumers only save a row here; the OutboxRelay claims PENDING
+    rows (SENDING, with claim_token and a claimed_until lease), delivers
+    them to Stackstorm and marks them DELIVERED, or FAILED once attempts
+    runs out, so delivery is at-least-once and never holds up a
+    MessageBus consumer. A SENDING row whose lease ran out is claimed
+    again, by any relay.
+    """
+    meta = {
+        'collection': 'test_request_outbox',
+        'write_concern': {'w': 'majority'},
+        'indexes': [
+            ('status', 'next_attempt_time'),
+            ('status', 'claimed_until'),
+            'claim_token',
+        ],
+    }
+    event_type = StringField(required=True)
+    trid = StringField(required=True)
+    cid = StringField()
+    payload = DictField()
+    status = StringField(default='PENDING')
+    attempts = IntField(default=0)
+    last_error = StringField()
+    create_time = DateTimeField(required=True)
+    next_attempt_time = DateTimeField(default=lambda: datetime.now(timezone.utc))
+    delivered_time = DateTimeField()
+    claim_token = StringField()
+    claimed_until = DateTimeField()
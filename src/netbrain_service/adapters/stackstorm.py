@@ -1,222 +1,390 @@
-import json
-from dataclasses import dataclass
-from dataclasses import asdict
-from xmlrpc.client import Boolean
-
-from test_services import logger
-
-from test_services.config import settings
-
-from test_services.atf.common import Alert
-from test_services.atf.common import Command
-
-from requests import post
-
-from urllib3 import disable_warnings
-from urllib3.exceptions import InsecureRequestWarning, SSLError
-
-
-@dataclass
-class StackstormInstance:
-    base_url: str
-    alert_webhook: str
-    api_key: str
-    send_comment_webhook: str
-    send_comment_api_key: str
-
-
-class Stackstorm:
-    """
-    Adapter class to handle communication with Stackstorm.
-    No arguments are required to instantiate this class, as it
-    pulls required data from settings.
-
-
-    Example:
-
-    mock_alert: test_Services.atf.alerts.FailedTest
-    Stackstorm().send_alert(mock_alert)
-    """
-
-    def __init__(self):
-        self.dev_instance = StackstormInstance(
-            base_url=settings.STACKSTORM_BASE_URL_DEV,
-            alert_webhook=settings.STACKSTORM_ALERT_WEBHOOK,
-            api_key=settings.STACKSTORM_API_KEY_DEV,
-            send_comment_webhook=settings.STACKSTORM_SEND_COMMENT,
-            send_comment_api_key=settings.STACKSTORM_SEND_COMMENT_API_KEY_DEV,
-        )
-        self.prod_instance = StackstormInstance(
-            base_url=settings.STACKSTORM_BASE_URL_PROD,
-            alert_webhook=settings.STACKSTORM_ALERT_WEBHOOK,
-            api_key=settings.STACKSTORM_API_KEY_PROD,
-            send_comment_webhook=settings.STACKSTORM_SEND_COMMENT,
-            send_comment_api_key=settings.STACKSTORM_SEND_COMMENT_API_KEY_DEV,
-        )
-
-    def send_alert(self, alert: Alert) -> bool:
-        # build url based on target_environ
-        target = self.prod_instance if alert.production_alert else self.dev_instance
-        url = f"{target.base_url}{target.alert_webhook}?st2-api-key={target.api_key}"
-
-        # alert -> dict
-        payload = asdict(alert)
-
-        # disable insecure request warning
-        disable_warnings(InsecureRequestWarning)
-        disable_warnings(SSLError)
-
-        # send to Stackstorm
-        try:
-            response = post(url, data=payload, verify=False)
-        except:
-            logger.error(f"{alert.cid} unable to send alert, encountered exception.", exc_info=True)
-        else:
-            # handle and log response
-            if response.ok:
-                # notice that we remove the api key by slicing args off
-                logger.info(f"{alert.cid} alert was sent successfully to {url[:url.find('?')]}")
-                return True
-            else:
-                logger.error(
-                    f"{alert.cid} during sending of {alert}, received error from {url[:url.find('?')]} {response.status_code} {response.text}")
-
-        # if we get here, sending the alert was not successful
-        return False
-
-    def send_comment(self, command: Command) -> bool:
-        # build url based on target_environ
-        target = self.dev_instance
-        # url = f"{target.base_url}{target.send_comment_webhook}?st2-api-key={target.send_comment_api_key}"
-        url = "http://localhost:8000/api/v1/test/payload"
-
-        comment = {
-            "Domain": command.domain,
-            "TestId": command.test_id,
-            "TestName": command.test_name,
-            "TestStatus": command.test_status,
-            "StatusDescription": command.status_description,
-            "TestStartTime": command.start_time,
-            "TestEndTime": command.end_time
-        }
-
-        # status = True if command.test_status.lower() == "passed" else False
-
-        # command -> dict
-        payload = {
-            "support_ticket": f"{command.support_ticket}",
-            "comment": json.dumps(comment, indent=4),
-            # "testname": command.test_name,
-            # "passed": status,
-        }
-
-        # disable insecure request warning
-        disable_warnings(InsecureRequestWarning)
-        disable_warnings(SSLError)
-
-        # send to Stackstorm
-        try:
-            logger.info(f"{command.cid} payload being sent to stackstorm: {payload}")
-            response = post(url, data=payload, verify=False)
-        except:
-            logger.error(f"{command.cid} unable to send comment, encountered exception.", exc_info=True)
-        else:
-            # handle and log response
-            if response.ok:
-                # notice that we remove the api key by slicing args off
-                logger.info(
-                    f"{command.cid} alert was sent successfully to {url[:url.find('?')]} with payload: {payload}")
-                return True
-            else:
-                logger.error(
-                    f"{command.cid} during sending of {command}, received error from {url[:url.find('?')]} {response.status_code} {response.text}")
-
-        # if we get here, sending the alert was not successful
-        return False
-
-    def notify_of_test_results(self, cid: str, support_ticket: str, comment: str, testname: str, passed: bool,
-                               prod=True) -> bool:
-        # build url based on target_environ
-        target = self.dev_instance if not prod else self.prod_instance
-        url = f"{target.base_url}{target.send_comment_webhook}?st2-api-key={target.send_comment_api_key}"
-
-        # build payload and convert to json-encoded string
-        payload = {
-            "support_ticket": support_ticket,
-            "comment": comment,
-            "testname": testname,
-            "passed": passed,
-        }
-        payload_string = json.dumps(payload)
-
-        # disable insecure request warning
-        disable_warnings(InsecureRequestWarning)
-        disable_warnings(SSLError)
-
-        # send to Stackstorm
-        try:
-            response = post(url, data=payload_string, verify=False)
-        except Exception as e:
-            logger.error(f"{cid} unable to send comment, encountered Exception {str(e)}")
-        else:
-            # handle and log response
-            if response.ok:
-                # notice that we remove the api key by slicing args off
-                logger.info(f"{cid} test results sent successfully to {url[:url.find('?')]} with payload: {payload}")
-                return True
-            else:
-                logger.error(
-                    f"{cid} during sending of test result to Stackstorm, received error from {url[:url.find('?')]} {response.status_code} {response.text}")
-
-        # if we get here, sending the alert was not successful
-        return False
-
-    def send_test_update(self, command: Command) -> bool:
-        # build url based on target_environ
-        target = self.dev_instance
-        url = f"{target.base_url}{target.send_comment_webhook}?st2-api-key={target.send_comment_api_key}"
-
-        comment = {
-            "Domain": command.domain,
-            "TestId": command.test_id,
-            "TestName": command.test_name,
-            "TestStatus": command.test_status,
-            "StatusDescription": command.status_description,
-            "TestStartTime:": command.start_time,
-            "TestEndTime": command.end_time
-        }
-
-        status = True if command.test_status.lower() == "passed" else False
-
-        # command -> dict
-        payload = {
-            "support_ticket": command.support_ticket,
-            "comment": json.dumps(comment, indent=4),
-            "testname": command.test_name,
-            "passed": status,
-        }
-
-        payload_string = json.dumps(payload)
-
-        # disable insecure request warning
-        disable_warnings(InsecureRequestWarning)
-        disable_warnings(SSLError)
-
-        # send to Stackstorm
-        try:
-            response = post(url, data=payload_string, verify=False)
-        except:
-            logger.error(f"{command.cid} unable to send comment, encountered exception.", exc_info=True)
-        else:
-            # handle and log response
-            if response.ok:
-                # notice that we remove the api key by slicing args off
-                logger.info(
-                    f"{command.cid} alert was sent successfully to {url[:url.find('?')]} with payload: {payload}")
-                return True
-            else:
-                logger.error(
-                    f"{command.cid} during sending of {command}, received error from {url[:url.find('?')]} {response.status_code} {response.text}")
-
-        # if we get here, sending the alert was not successful
-        return False
+import json
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass
+from dataclasses import asdict
+from typing import Callable
+from typing import TYPE_CHECKING
+from xmlrpc.client import Boolean
+
+from src.netbrain_service.config import settings
+
+from src.netbrain_service.domain.common import Command
+
+from requests import Session
+from requests import Response
+from requests.adapters import HTTPAdapter
+
+from urllib3 import disable_warnings
+from urllib3.util.retry import Retry
+from urllib3.exceptions import InsecureRequestWarning, SSLError
+
+from src.netbrain_service.log_config import Truncated
+from src.netbrain_service.metrics import OUTBOUND_ERRORS
+from src.netbrain_service.metrics import OUTBOUND_LATENCY
+from src.netbrain_service.tracing import span
+
+if TYPE_CHECKING:
+    # Alerts are built by the ATF test services, only send_alert refers to them
+    from test_services.atf.common import Alert
+
+logger = logging.getLogger(__name__)
+
+# disable insecure request warning, once for the process
+disable_warnings(InsecureRequestWarning)
+disable_warnings(SSLError)
+
+
+@dataclass
+class StackstormInstance:
+    base_url: str
+    alert_webhook: str
+    api_key: str
+    send_comment_webhook: str
+    send_comment_api_key: str
+
+
+class Stackstorm:
+    """
+    Adapter class to handle communication with Stackstorm.
+    No arguments are required to instantiate this class, as it
+    pulls required data from settings.
+
+
+    Example:
+
+    mock_alert: test_Services.atf.alerts.FailedTest
+    Stackstorm().send_alert(mock_alert)
+
+    All requests share one pooled Session with connect/read timeouts.
+    Connection errors are retried with backoff by the transport; the
+    webhooks are POSTs, so a request that may have reached Stackstorm (read
+    errors, 502/503/504) is not sent again, the caller sees the failure.
+
+    The send_* methods block until Stackstorm answers; to keep
+    notification latency off the processing path use enqueue() (or
+    queue_comment()), which hands the call to a pool of worker threads and
+    returns a Future of its result immediately.
+
+    When STACKSTORM_COMMENT_BATCH_WINDOW is set, queue_comment() holds
+    comments for that many seconds and delivers all comments for the same
+    support ticket as a single request.
+    """
+
+    def __init__(self):
+        self.dev_instance = StackstormInstance(
+            base_url=settings.STACKSTORM_BASE_URL_DEV,
+            alert_webhook=settings.STACKSTORM_ALERT_WEBHOOK,
+            api_key=settings.STACKSTORM_API_KEY_DEV,
+            send_comment_webhook=settings.STACKSTORM_SEND_COMMENT,
+            send_comment_api_key=settings.STACKSTORM_SEND_COMMENT_API_KEY_DEV,
+        )
+        self.prod_instance = StackstormInstance(
+            base_url=settings.STACKSTORM_BASE_URL_PROD,
+            alert_webhook=settings.STACKSTORM_ALERT_WEBHOOK,
+            api_key=settings.STACKSTORM_API_KEY_PROD,
+            send_comment_webhook=settings.STACKSTORM_SEND_COMMENT,
+            send_comment_api_key=settings.STACKSTORM_SEND_COMMENT_API_KEY_DEV,
+        )
+        # (connect, read) seconds
+        self.timeout = (settings.get('STACKSTORM_CONNECT_TIMEOUT', 5), settings.get('STACKSTORM_READ_TIMEOUT', 30))
+        self.session = self.__build_session(
+            pool_size=settings.get('STACKSTORM_POOL_SIZE', 10),
+            retries=settings.get('STACKSTORM_RETRIES', 3),
+            backoff=settings.get('STACKSTORM_RETRY_BACKOFF', 0.5),
+        )
+        self.worker_count = settings.get('STACKSTORM_WORKER_COUNT', 4)
+        self.batch_window = settings.get('STACKSTORM_COMMENT_BATCH_WINDOW', 0)
+        self.outbound_q = queue.Queue()
+        self._pending_comments: dict[str, list[tuple[str, str]]] = {}
+        self._pending_lock = threading.Lock()
+        self._workers_started = False
+        self._workers_lock = threading.Lock()
+
+    @staticmethod
+    def __build_session(pool_size: int, retries: int, backoff: float) -> Session:
+        # read and status retries only apply to the idempotent
+        # DEFAULT_ALLOWED_METHODS, so POSTs are only retried on connect errors
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            backoff_factor=backoff,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        session = Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def __post(self, endpoint: str, url: str, data) -> Response:
+        """POST through the pooled session, recording latency and errors for endpoint"""
+        try:
+            # notice that we remove the api key by slicing args off
+            with OUTBOUND_LATENCY.labels('stackstorm', endpoint).time(), \
+                    span(f'stackstorm.{endpoint}', **{'http.method': 'POST', 'http.url': url.split('?')[0]}):
+                response = self.session.post(url, data=data, verify=False, timeout=self.timeout)
+        except Exception:
+            OUTBOUND_ERRORS.labels('stackstorm', endpoint).inc()
+            raise
+        if not response.ok:
+            OUTBOUND_ERRORS.labels('stackstorm', endpoint).inc()
+        return response
+
+    def __start_workers(self):
+        with self._workers_lock:
+            if self._workers_started:
+                return
+            # each worker spawns its own thread, same as the MessageBus consumers
+            for i in range(self.worker_count):
+                threading.Thread(target=self.__worker, name='stackstorm-worker', daemon=True).start()
+            if self.batch_window:
+                threading.Thread(target=self.__comment_flusher, name='stackstorm-comments', daemon=True).start()
+            self._workers_started = True
+            logger.info('Stackstorm outbound queue initialized with %s workers.', self.worker_count)
+
+    def __worker(self):
+        while True:
+            future, send, args, kwargs = self.outbound_q.get()
+            try:
+                if future.set_running_or_notify_cancel():
+                    future.set_result(send(*args, **kwargs))
+            except Exception as e:
+                logger.error("Exception encountered while %s was sending queued Stackstorm request",
+                             getattr(send, '__name__', send), exc_info=True)
+                future.set_exception(e)
+            finally:
+                self.outbound_q.task_done()
+
+    def enqueue(self, send: Callable[..., bool], *args, **kwargs) -> Future:
+        """
+        Queue a call of one of the send_* methods (ex. self.send_alert, alert)
+        for the worker pool and return without waiting for Stackstorm. The
+        Future resolves to what the call returned.
+        """
+        self.__start_workers()
+        future = Future()
+        self.outbound_q.put((future, send, args, kwargs))
+        return future
+
+    def join(self):
+        """Block until every queued request has been attempted"""
+        self.outbound_q.join()
+
+    def queue_comment(self, command: Command):
+        """
+        Non-blocking send_comment. With a batch window, comments are held and
+        combined per support ticket by the comment flusher.
+        """
+        if not self.batch_window:
+            self.enqueue(self.send_comment, command)
+            return
+        self.__start_workers()
+        with self._pending_lock:
+            self._pending_comments.setdefault(f"{command.support_ticket}", []).append(
+                (command.cid, self.__build_comment(command)))
+
+    def __comment_flusher(self):
+        while True:
+            time.sleep(self.batch_window)
+            with self._pending_lock:
+                pending, self._pending_comments = self._pending_comments, {}
+            for support_ticket, comments in pending.items():
+                self.enqueue(self.__send_comment_batch, support_ticket, comments)
+
+    def __send_comment_batch(self, support_ticket: str, comments: list[tuple[str, str]]) -> bool:
+        cids = ",".join(cid for cid, comment in comments)
+        payload = {
+            "support_ticket": support_ticket,
+            "comment": "\n\n".join(comment for cid, comment in comments),
+        }
+        return self.__post_comment(cids, payload, f"{len(comments)} batched comments")
+
+    def send_alert(self, alert: 'Alert') -> bool:
+        # build url based on target_environ
+        target = self.prod_instance if alert.production_alert else self.dev_instance
+        url = f"{target.base_url}{target.alert_webhook}?st2-api-key={target.api_key}"
+
+        # alert -> dict
+        payload = asdict(alert)
+
+        # send to Stackstorm
+        try:
+            response = self.__post('alert', url, data=payload)
+        except:
+            logger.error("%s unable to send alert, encountered exception.", alert.cid, exc_info=True)
+        else:
+            # handle and log response
+            if response.ok:
+                # notice that we remove the api key by slicing args off
+                logger.info("%s alert was sent successfully to %s", alert.cid, url[:url.find('?')])
+                return True
+            else:
+                logger.error("%s during sending of %s, received error from %s %s %s", alert.cid, Truncated(alert),
+                             url[:url.find('?')], response.status_code, Truncated(response.text))
+
+        # if we get here, sending the alert was not successful
+        return False
+
+    def send_comment(self, command: Command) -> bool:
+        # command -> dict
+        payload = {
+            "support_ticket": f"{command.support_ticket}",
+            "comment": self.__build_comment(command),
+            # "testname": command.test_name,
+            # "passed": status,
+        }
+        return self.__post_comment(command.cid, payload, command)
+
+    @staticmethod
+    def __build_comment(command: Command) -> str:
+        comment = {
+            "Domain": command.domain,
+            "TestId": command.test_id,
+            "TestName": command.test_name,
+            "TestStatus": command.test_status,
+            "StatusDescription": command.status_description,
+            "TestStartTime": command.start_time,
+            "TestEndTime": command.end_time
+        }
+
+        # status = True if command.test_status.lower() == "passed" else False
+
+        return json.dumps(comment, indent=4)
+
+    def __post_comment(self, cid: str, payload: dict, sent) -> bool:
+        # build url based on target_environ
+        target = self.dev_instance
+        # url = f"{target.base_url}{target.send_comment_webhook}?st2-api-key={target.send_comment_api_key}"
+        url = "http://localhost:8000/api/v1/test/payload"
+
+        # send to Stackstorm
+        try:
+            logger.info("%s payload being sent to stackstorm: %s", cid, Truncated(payload))
+            response = self.__post('comment', url, data=payload)
+        except:
+            logger.error("%s unable to send comment, encountered exception.", cid, exc_info=True)
+        else:
+            # handle and log response
+            if response.ok:
+                # notice that we remove the api key by slicing args off
+                logger.info("%s alert was sent successfully to %s with payload: %s", cid, url[:url.find('?')],
+                            Truncated(payload))
+                return True
+            else:
+                logger.error("%s during sending of %s, received error from %s %s %s", cid, Truncated(sent),
+                             url[:url.find('?')], response.status_code, Truncated(response.text))
+
+        # if we get here, sending the alert was not successful
+        return False
+
+    def notify_of_test_results(self, cid: str, support_ticket: str, comment: str, testname: str, passed: bool,
+                               prod=True) -> bool:
+        # build url based on target_environ
+        target = self.dev_instance if not prod else self.prod_instance
+        url = f"{target.base_url}{target.send_comment_webhook}?st2-api-key={target.send_comment_api_key}"
+
+        # build payload and convert to json-encoded string
+        payload = {
+            "support_ticket": support_ticket,
+            "comment": comment,
+            "testname": testname,
+            "passed": passed,
+        }
+        payload_string = json.dumps(payload)
+
+        # send to Stackstorm
+        try:
+            response = self.__post('test_results', url, data=payload_string)
+        except Exception as e:
+            logger.error("%s unable to send comment, encountered Exception %s", cid, e)
+        else:
+            # handle and log response
+            if response.ok:
+                # notice that we remove the api key by slicing args off
+                logger.info("%s test results sent successfully to %s with payload: %s", cid, url[:url.find('?')],
+                            Truncated(payload))
+                return True
+            else:
+                logger.error("%s during sending of test result to Stackstorm, received error from %s %s %s", cid,
+                             url[:url.find('?')], response.status_code, Truncated(response.text))
+
+        # if we get here, sending the alert was not successful
+        return False
+
+    def send_outbox_entry(self, cid: str, trid: str, event_type: str, payload: dict, prod=True) -> bool:
+        """Deliver one TestRequestOutbox row, used by the OutboxRelay"""
+        # build url based on target_environ
+        target = self.dev_instance if not prod else self.prod_instance
+        url = f"{target.base_url}{target.send_comment_webhook}?st2-api-key={target.send_comment_api_key}"
+
+        payload_string = json.dumps({"trid": trid, "event_type": event_type, "cid": cid, **payload}, default=str)
+
+        # send to Stackstorm
+        try:
+            response = self.__post('outbox_entry', url, data=payload_string)
+        except Exception as e:
+            logger.error("%s TRID=%s unable to deliver outbox entry, encountered Exception %s", cid, trid, e)
+        else:
+            # handle and log response
+            if response.ok:
+                # notice that we remove the api key by slicing args off
+                logger.info("%s TRID=%s outbox entry %s delivered to %s", cid, trid, event_type, url[:url.find('?')])
+                return True
+            else:
+                logger.error("%s TRID=%s during delivery of outbox entry %s, received error from %s %s %s", cid, trid,
+                             event_type, url[:url.find('?')], response.status_code, Truncated(response.text))
+
+        # if we get here, delivery was not successful
+        return False
+
+    def send_test_update(self, command: Command) -> bool:
+        # build url based on target_environ
+        target = self.dev_instance
+        url = f"{target.base_url}{target.send_comment_webhook}?st2-api-key={target.send_comment_api_key}"
+
+        comment = {
+            "Domain": command.domain,
+            "TestId": command.test_id,
+            "TestName": command.test_name,
+            "TestStatus": command.test_status,
+            "StatusDescription": command.status_description,
+            "TestStartTime:": command.start_time,
+            "TestEndTime": command.end_time
+        }
+
+        status = True if command.test_status.lower() == "passed" else False
+
+        # command -> dict
+        payload = {
+            "support_ticket": command.support_ticket,
+            "comment": json.dumps(comment, indent=4),
+            "testname": command.test_name,
+            "passed": status,
+        }
+
+        payload_string = json.dumps(payload)
+
+        # send to Stackstorm
+        try:
+            response = self.__post('test_update', url, data=payload_string)
+        except:
+            logger.error("%s unable to send comment, encountered exception.", command.cid, exc_info=True)
+        else:
+            # handle and log response
+            if response.ok:
+                # notice that we remove the api key by slicing args off
+                logger.info("%s alert was sent successfully to %s with payload: %s", command.cid, url[:url.find('?')],
+                            Truncated(payload))
+                return True
+            else:
+                logger.error("%s during sending of %s, received error from %s %s %s", command.cid, Truncated(command),
+                             url[:url.find('?')], response.status_code, Truncated(response.text))
+
+        # if we get here, sending the alert was not successful
+        return False
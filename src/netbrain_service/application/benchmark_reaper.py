@@ -0,0 +1,252 @@
+import time
+import logging
+import threading
+
+from time import sleep
+
+from typing import Optional
+
+from concurrent.futures import ThreadPoolExecutor
+
+from datetime import datetime
+from datetime import timedelta
+
+from mongoengine import Q
+
+from src.netbrain_service.config import settings
+from src.netbrain_service.domain.common import cid_datetime
+from src.netbrain_service.metrics import BENCHMARK_TASKS_DELETED
+from src.netbrain_service.application import command_consumers
+from src.netbrain_service.application.event_consumer import get_creds
+from src.netbrain_service.application.mongo_models import BenchmarkPayload
+from src.netbrain_service.application.mongo_models import TaskLog
+
+logger = logging.getLogger(__name__)
+
+# task names created by create_group_benchmark, the only ones the orphan sweep deletes
+ORPHAN_TASK_PREFIX = 'Benchmark_event_'
+
+
+class _RateLimiter:
+    """spaces acquire() calls at least 1 / rate seconds apart, across threads"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate else 0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            sleep(slot - now)
+
+
+class BenchmarkReaper:
+    """
+    Deletes NetBrain benchmark tasks in the background, off the
+    process_event path.
+
+    Every cycle the reaper will:
+        - pick up to batch_size task names whose task logs are all done
+            with their content (DELETE_TASK or COMPLETED) and are not
+            waiting out a retry delay
+        - delete them concurrently on `concurrency` threads, no faster
+            than `rate` deletes per second overall
+        - mark the task logs of deleted tasks COMPLETED in one update
+        - bump delete_attempts on tasks that failed and push their
+            next_delete_datetime out exponentially (capped at
+            max_backoff seconds); after max_attempts their task logs are
+            marked COMPLETED anyway and the task is left to the orphan
+            sweep
+
+    Every orphan_interval seconds it also lists the tasks on NetBrain and
+    deletes Benchmark_event_* tasks older than orphan_min_age seconds that
+    no unfinished TaskLog or BenchmarkPayload refers to, left behind by
+    crashed or abandoned runs.
+
+    The reaper logs in with a NetBrain session of its own instead of the
+    shared LoginToken, which the pipeline logs out at the end of every
+    process_pending. After a cycle with failed calls the session is logged
+    out and a fresh one is opened on the next cycle.
+    """
+
+    def __init__(
+            self,
+            batch_size: Optional[int] = None,
+            poll_interval: Optional[float] = None,
+            concurrency: Optional[int] = None,
+            rate: Optional[float] = None,
+            max_attempts: Optional[int] = None,
+            max_backoff: Optional[float] = None,
+            orphan_interval: Optional[float] = None,
+            orphan_min_age: Optional[float] = None,
+    ):
+        self.batch_size = batch_size or settings.get('BENCHMARK_REAPER_BATCH_SIZE', 50)
+        self.poll_interval = poll_interval or settings.get('BENCHMARK_REAPER_POLL_INTERVAL', 2)
+        self.concurrency = concurrency or settings.get('BENCHMARK_REAPER_CONCURRENCY', 4)
+        self.rate = rate or settings.get('BENCHMARK_REAPER_RATE', 10)
+        self.max_attempts = max_attempts or settings.get('BENCHMARK_REAPER_MAX_ATTEMPTS', 5)
+        self.max_backoff = max_backoff or settings.get('BENCHMARK_REAPER_MAX_BACKOFF', 300)
+        self.orphan_interval = orphan_interval or settings.get('BENCHMARK_REAPER_ORPHAN_INTERVAL', 3600)
+        self.orphan_min_age = orphan_min_age or settings.get('BENCHMARK_REAPER_ORPHAN_MIN_AGE', 3600)
+        self._limiter = _RateLimiter(self.rate)
+        self._next_orphan_sweep = 0.0
+        self._token = None
+        self._running = False
+
+    def __login(self) -> bool:
+        if self._token:
+            return True
+        result = command_consumers.requests_consumer.login_to_netbrain(*get_creds())
+        if result['status'] != 'Success.':
+            logger.error("BenchmarkReaper > login failed, status: '%s'", result['status'])
+            return False
+        self._token = result['token']
+        return True
+
+    def __logout(self):
+        token, self._token = self._token, None
+        if token:
+            status = command_consumers.requests_consumer.logout_from_netbrain(token)
+            if status != 'Success.':
+                logger.error("BenchmarkReaper > logout failed, status: '%s'", status)
+
+    def __delete(self, task_name: str, kind: str) -> bool:
+        self._limiter.acquire()
+        try:
+            status = command_consumers.delete_task(task_name, self._token)
+        except Exception as e:
+            status = f"Error: {str(e)}"
+        deleted = status == 'Success.'
+        BENCHMARK_TASKS_DELETED.labels(kind, 'success' if deleted else 'failed').inc()
+        if not deleted:
+            logger.error("BenchmarkReaper > delete of %s task '%s' failed, status: '%s'", kind, task_name, status)
+        return deleted
+
+    def __delete_all(self, task_names: list[str], kind: str) -> list[bool]:
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return list(executor.map(lambda task_name: self.__delete(task_name, kind), task_names))
+
+    def ready_task_names(self) -> list[str]:
+        """up to batch_size task names ready to be deleted"""
+        now = datetime.utcnow()
+        candidates = (TaskLog.objects(status='DELETE_TASK', from_cache__ne=True)
+                      .filter(Q(next_delete_datetime=None) | Q(next_delete_datetime__lte=now))
+                      .distinct('task_name'))
+        if not candidates:
+            return []
+        # a group task is deleted once every device's task log is done with its content
+        busy = set(TaskLog.objects(task_name__in=candidates, status__nin=['DELETE_TASK', 'COMPLETED'])
+                   .distinct('task_name'))
+        return [task_name for task_name in candidates if task_name not in busy][:self.batch_size]
+
+    def __retry_later(self, task_name: str):
+        task_log = TaskLog.objects(task_name=task_name, status='DELETE_TASK').only('delete_attempts').first()
+        if task_log is None:
+            return
+        attempts = (task_log.delete_attempts or 0) + 1
+        if attempts >= self.max_attempts:
+            TaskLog.objects(task_name=task_name, status='DELETE_TASK').update(
+                set__status='COMPLETED', set__delete_attempts=attempts)
+            logger.error("BenchmarkReaper > giving up on task '%s' after %s attempts, left to the orphan sweep",
+                         task_name, attempts)
+            return
+        backoff = min(self.max_backoff, self.poll_interval * (2 ** attempts))
+        TaskLog.objects(task_name=task_name, status='DELETE_TASK').update(
+            set__delete_attempts=attempts,
+            set__next_delete_datetime=datetime.utcnow() + timedelta(seconds=backoff))
+
+    def reap_batch(self) -> int:
+        """
+        Run a single delete cycle, returns the number of tasks picked up so
+        the caller can tell a full batch from an empty one.
+        """
+        task_names = self.ready_task_names()
+        if not task_names:
+            return 0
+
+        if not self.__login():
+            return 0
+        results = self.__delete_all(task_names, 'finished')
+        deleted = [task_name for task_name, ok in zip(task_names, results) if ok]
+        failed = [task_name for task_name, ok in zip(task_names, results) if not ok]
+
+        if deleted:
+            TaskLog.objects(task_name__in=deleted, status='DELETE_TASK').update(set__status='COMPLETED')
+        for task_name in failed:
+            self.__retry_later(task_name)
+        if failed:
+            self.__logout()
+
+        logger.info("BenchmarkReaper > deleted %s and failed %s of %s benchmark tasks",
+                    len(deleted), len(failed), len(task_names))
+        return len(task_names)
+
+    def orphaned_task_names(self, task_names: list[str]) -> list[str]:
+        """the Benchmark_event_* names among task_names that nothing unfinished refers to"""
+        names = [task_name for task_name in task_names if task_name.startswith(ORPHAN_TASK_PREFIX)]
+        if not names:
+            return []
+        active = set(TaskLog.objects(task_name__in=names, status__ne='COMPLETED').distinct('task_name'))
+        # added on NetBrain, task logs not written yet
+        active.update(BenchmarkPayload.objects(benchmark_payload__taskName__in=names, status__in=['NEW', 'ADDING'])
+                      .distinct('benchmark_payload.taskName'))
+        cutoff = datetime.utcnow().timestamp() - self.orphan_min_age
+        orphans = []
+        for task_name in names:
+            if task_name in active:
+                continue
+            # names that carry no creation time can't be told from a task still being set up
+            created = cid_datetime(task_name[len(ORPHAN_TASK_PREFIX):])
+            if created is not None and created.timestamp() < cutoff:
+                orphans.append(task_name)
+        return orphans
+
+    def sweep_orphans(self) -> int:
+        """delete orphaned benchmark tasks from NetBrain, returns how many were deleted"""
+        if not self.__login():
+            return 0
+        result = command_consumers.list_tasks(self._token)
+        if result['status'] != 'Success.':
+            logger.error("BenchmarkReaper > listing benchmark tasks failed, status: '%s'", result['status'])
+            self.__logout()
+            return 0
+        orphans = self.orphaned_task_names(result['tasks'])
+        deleted = sum(self.__delete_all(orphans, 'orphan')) if orphans else 0
+        if deleted < len(orphans):
+            self.__logout()
+        logger.info("BenchmarkReaper > orphan sweep deleted %s of %s orphaned tasks, %s tasks on NetBrain",
+                    deleted, len(orphans), len(result['tasks']))
+        return deleted
+
+    def run(self):
+        """Reap until stop() is called"""
+        self._running = True
+        logger.info("BenchmarkReaper started, batch_size %s, %s deletes per second", self.batch_size, self.rate)
+        while self._running:
+            try:
+                read = self.reap_batch()
+                if time.monotonic() >= self._next_orphan_sweep:
+                    self._next_orphan_sweep = time.monotonic() + self.orphan_interval
+                    self.sweep_orphans()
+            except Exception as e:
+                logger.error("BenchmarkReaper cycle failed: '%s'", e, exc_info=True)
+                self.__logout()
+                read = 0
+            if read < self.batch_size:
+                sleep(self.poll_interval)
+        self.__logout()
+
+    def start(self) -> threading.Thread:
+        """Run the reaper on a daemon thread"""
+        thread = threading.Thread(target=self.run, name='benchmark-reaper', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._running = False
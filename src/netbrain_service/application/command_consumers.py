@@ -1,20 +1,48 @@
 import logging
 
 from datetime import datetime
+from datetime import timedelta
+
+from mongoengine import Q
+from mongoengine.errors import NotUniqueError
+from mongoengine.errors import ValidationError
+
+from pymongo import ReturnDocument
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from src.netbrain_service.config import settings
+from src.netbrain_service.log_config import Truncated
+from src.netbrain_service.domain.common import get_cid
+from src.netbrain_service.domain.common import cid_context
 
 from src.netbrain_service.application.mongo_models import LoginToken
 from src.netbrain_service.application.mongo_models import BenchmarkPayload, Benchmark, Schedule, DeviceScope
 from src.netbrain_service.application.mongo_models import IncomingPayload
 from src.netbrain_service.application.mongo_models import TaskLog
-
-#from src.netbrain_service.application import requests_consumer
+from src.netbrain_service.application.mongo_models import AlertResult
+from src.netbrain_service.application.device_data_cache import get_device_data_cache
+from src.netbrain_service.application.device_inventory import get_device_inventory
+from src.netbrain_service.application.content_parser import store_parsed_records_many
+from src.netbrain_service.application.output_changes import detect_output_changes
+from src.netbrain_service.application.output_changes import record_output_changes
 
 """ in case API is unavailable - use requests_consumer_dummy: 
-    below is a dummy request module only to do basic functionality testing"""
-import src.netbrain_service.application.requests_consumer_dummy as requests_consumer
+    below is a dummy request module only to do basic functionality testing,
+    set NETBRAIN_USE_DUMMY_API=false to call the NetBrain API"""
+if settings.get('NETBRAIN_USE_DUMMY_API', True):
+    import src.netbrain_service.application.requests_consumer_dummy as requests_consumer
+else:
+    from src.netbrain_service.application import requests_consumer
 
 logger = logging.getLogger(__name__)
 
+# DeviceRawData query collected for every event, also the DeviceDataCache key
+DEVICE_DATA_TYPE = "2"
+DEVICE_DATA_CMD = "sh controllers tenGigE0/0/0/0  phy"
+# CLI commands run by every benchmark task
+BENCHMARK_CLI_COMMANDS = ["showversion", "showarp", "showinterface"]
+
 
 def generate_login_token(username, password):
     """
@@ -30,18 +58,18 @@ def generate_login_token(username, password):
                 login_token = LoginToken(token=result['token'], datetime=datetime.utcnow())
                 login_token.save()
                 token_doc = login_token.to_mongo().to_dict()
-                logger.info(f"generate_login_token > login status: {str(result)}")
-                logger.info(f"generate_login_token > token added: {str(token_doc)}")
+                logger.info("generate_login_token > login status: %s", Truncated(result))
+                logger.info("generate_login_token > token added: %s", Truncated(token_doc))
                 status = 'Success.'
             else:
                 status = result['status']
-                logger.error(f"generate_login_token > login status: {str(result)}")
+                logger.error("generate_login_token > login status: %s", Truncated(result))
         else:
-            logger.info(f"generate_login_token > login status: token exists")
+            logger.info("generate_login_token > login status: token exists")
             status = 'Success.'
     except Exception as e:
         status = 'login failed'
-        logger.error(f"generate_login_token > Error: '{str(e)}'")
+        logger.error("generate_login_token > Error: '%s'", e)
     return status
 
 
@@ -52,7 +80,7 @@ def get_login_token():
         token = token_entry.token
     else:
         token = ''
-        logger.error(f"get_login_token > no token exists")
+        logger.error("get_login_token > no token exists")
     return token
 
 
@@ -67,94 +95,328 @@ def logout_api():
                 login_token = LoginToken.objects(token=token).first()
                 token_doc = login_token.to_mongo().to_dict()
                 login_token.delete()
-                logger.info(f"logout_api > token deleted: {str(token_doc)}")
-                logger.info(f"logout_api > logout status: {status}")
+                logger.info("logout_api > token deleted: %s", Truncated(token_doc))
+                logger.info("logout_api > logout status: %s", status)
             else:
-                logger.error(f"logout_api > logout status:{status}")
+                logger.error("logout_api > logout status:%s", status)
         else:
             status = 'No active token found'
-            logger.error(f"logout_api > logout status: {status}")
+            logger.error("logout_api > logout status: %s", status)
     except Exception as e:
         status = 'logout failed'
-        logger.error(f"logout_api > Error: '{str(e)}'")
+        logger.error("logout_api > Error: '%s'", e)
     return status
 
 
 def create_event_entry(payload):
-    """Log incoming payload in DB"""
+    """
+    Log incoming payload in DB
+
+    While a payload for the same devicename/ipaddress/objectname is still in
+    flight (and younger than INGEST_DEDUPE_WINDOW seconds) no new entry is
+    created, the cid is attached to the existing entry and its tracking id
+    returned, so alert storms don't start duplicate benchmarks.
+    """
+    tracking_id = None
+    tracking_cid = None
+    duplicate = False
     try:
         devicename = payload['devicename']
         ipaddress = payload['ipaddress']
         objectname = payload['objectname']
-        cid = payload['cid']
-        logger.info(f"create_event_entry > payload: {str(payload)}")
-        incoming_payload = IncomingPayload(devicename=devicename,
-                                           ipaddress=ipaddress,
-                                           objectname=objectname,
-                                           cid=str(cid),
-                                           status='NEW',
-                                           created_datetime=datetime.utcnow())
-        incoming_payload.save()
-        payload_doc = incoming_payload.to_mongo().to_dict()
-        logger.info(f"create_event_entry > document: {str(payload_doc)}")
+        cid = str(payload['cid'])
+        logger.info("create_event_entry > payload: %s", Truncated(payload))
+        now = datetime.utcnow()
+        window_start = now - timedelta(seconds=settings.get('INGEST_DEDUPE_WINDOW', 900))
+        """in-flight entries older than the window stop absorbing new alerts"""
+        IncomingPayload.objects(devicename=devicename, ipaddress=ipaddress, objectname=objectname,
+                                in_flight=True, created_datetime__lt=window_start).update(set__in_flight=False)
+        incoming_payload = None
+        for attempt in range(2):
+            try:
+                incoming_payload = IncomingPayload.objects(
+                    devicename=devicename, ipaddress=ipaddress, objectname=objectname, in_flight=True
+                ).modify(upsert=True,
+                         new=True,
+                         add_to_set__related_cids=cid,
+                         set_on_insert__cid=cid,
+                         set_on_insert__status='NEW',
+                         set_on_insert__created_datetime=now)
+                break
+            except NotUniqueError:
+                """a concurrent request inserted the in-flight entry first, attach to it"""
+                continue
+        tracking_id = str(incoming_payload.id)
+        tracking_cid = incoming_payload.cid
+        duplicate = tracking_cid != cid
+        if duplicate:
+            logger.info("create_event_entry > %s attached to in-flight entry %s cid %s", cid, tracking_id, tracking_cid)
+        else:
+            logger.info("create_event_entry > document: %s", Truncated(incoming_payload.to_mongo))
         status = 'Success.'
     except Exception as e:
         status = f"create_event_entry failed. Error: {str(e)}"
-        logger.error(f"create_event_entry > status: {str(status)}")
-    return status
+        logger.error("create_event_entry > status: %s", status)
+    return {'status': status, 'tracking_id': tracking_id, 'cid': tracking_cid, 'duplicate': duplicate}
+
 
+def create_event_entries(payloads):
+    """
+    Log a batch of incoming payloads in DB, the batch counterpart of
+    create_event_entry with the same dedupe rules, in a fixed number of
+    round trips instead of several per payload:
+        - every payload is validated up front, invalid ones are reported
+            and skipped, payloads without a cid get one
+        - payloads for the same devicename/ipaddress/objectname within
+            the batch collapse to one entry, the rest attach their cid
+        - cids for entries already in flight are attached with one bulk
+            write, new entries are created with one unordered insert_many
+
+    Returns one result per payload, in order, with the payload's cid and
+    the tracking id/cid of the entry doing the work.
+    """
+    now = datetime.utcnow()
+    results = [None] * len(payloads)
+    # (devicename, ipaddress, objectname) -> indexes of payloads for it, first one leads
+    groups = {}
+    for index, payload in enumerate(payloads):
+        if not isinstance(payload, dict):
+            results[index] = {'index': index, 'status': 'Invalid payload, expected a JSON object.'}
+            continue
+        # a null or empty cid gets one too, not just a missing one
+        payload['cid'] = payload.get('cid') or get_cid()
+        entry = IncomingPayload(devicename=payload.get('devicename'),
+                                ipaddress=payload.get('ipaddress'),
+                                objectname=payload.get('objectname'),
+                                cid=str(payload['cid']),
+                                status='NEW',
+                                created_datetime=now)
+        try:
+            entry.validate()
+        except ValidationError as e:
+            results[index] = {'index': index, 'cid': entry.cid, 'status': f"Invalid payload. Error: {e}"}
+            continue
+        groups.setdefault((entry.devicename, entry.ipaddress, entry.objectname), []).append(index)
+    if not groups:
+        return {'status': 'Success.', 'results': results}
+
+    def key_filter(key):
+        return {'devicename': key[0], 'ipaddress': key[1], 'objectname': key[2]}
+
+    def cids_of(key):
+        return [str(payloads[index]['cid']) for index in groups[key]]
+
+    def record(key, tracking_id, tracking_cid):
+        for index in groups[key]:
+            cid = str(payloads[index]['cid'])
+            results[index] = {'index': index, 'status': 'Success.', 'cid': cid, 'tracking_id': str(tracking_id),
+                              'tracking_cid': tracking_cid, 'duplicate': tracking_cid != cid}
+
+    collection = IncomingPayload._get_collection()
+    try:
+        window_start = now - timedelta(seconds=settings.get('INGEST_DEDUPE_WINDOW', 900))
+        keys_filter = {'$or': [key_filter(key) for key in groups]}
+        """in-flight entries older than the window stop absorbing new alerts"""
+        collection.update_many({**keys_filter, 'in_flight': True, 'created_datetime': {'$lt': window_start}},
+                               {'$set': {'in_flight': False}})
+
+        in_flight = {
+            (doc['devicename'], doc['ipaddress'], doc['objectname']): doc
+            for doc in collection.find({**keys_filter, 'in_flight': True},
+                                       {'devicename': 1, 'ipaddress': 1, 'objectname': 1, 'cid': 1})
+        }
+        if in_flight:
+            collection.bulk_write([
+                UpdateOne({'_id': doc['_id']}, {'$addToSet': {'related_cids': {'$each': cids_of(key)}}})
+                for key, doc in in_flight.items()
+            ], ordered=False)
+            for key, doc in in_flight.items():
+                record(key, doc['_id'], doc['cid'])
+
+        new_keys = [key for key in groups if key not in in_flight]
+        documents = []
+        for key in new_keys:
+            lead = payloads[groups[key][0]]
+            documents.append({**key_filter(key), 'cid': str(lead['cid']), 'status': 'NEW', 'created_datetime': now,
+                              'in_flight': True, 'related_cids': cids_of(key)})
+        conflicts = set()
+        if documents:
+            try:
+                collection.insert_many(documents, ordered=False)
+            except BulkWriteError as e:
+                """another request inserted some of these in-flight entries first, attach to those below"""
+                conflicts = {error['index'] for error in e.details['writeErrors'] if error['code'] == 11000}
+                if len(conflicts) != len(e.details['writeErrors']):
+                    raise
+        for position, key in enumerate(new_keys):
+            if position not in conflicts:
+                record(key, documents[position]['_id'], documents[position]['cid'])
+                continue
+            doc = collection.find_one_and_update(
+                {**key_filter(key), 'in_flight': True},
+                {'$addToSet': {'related_cids': {'$each': cids_of(key)}}},
+                return_document=ReturnDocument.AFTER)
+            if doc:
+                record(key, doc['_id'], doc['cid'])
+            else:
+                for index in groups[key]:
+                    results[index] = {'index': index, 'cid': str(payloads[index]['cid']),
+                                      'status': 'create_event_entries failed. Error: in-flight entry finished during insert'}
+        logger.info("create_event_entries > %s payloads, %s new entries, %s attached to in-flight entries",
+                    len(payloads), len(documents) - len(conflicts), len(in_flight) + len(conflicts))
+        status = 'Success.'
+    except Exception as e:
+        status = f"create_event_entries failed. Error: {str(e)}"
+        logger.error("create_event_entries > status: %s", status)
+    return {'status': status, 'results': results}
 
-def get_device_name(device):
-    """dummy device mapping, needs to be updated based on incoming payload params"""
-    device_mapp = {'SAP1': 'My Network/USA/TEXAS/Westlake/Westlake Lab/ADRMTXAA7',
-                   'NEC1': 'My Network/USA/TEXAS/Westlake/Westlake Lab/ICRSTXAA',
-                   'NEC2': 'My Network/USA/TEXAS/Westlake/Westlake Lab/MRCRYTX'}
 
-    if device in device_mapp:
-        return device_mapp[device]
+def release_incoming_payload(task_log):
+    """the pipeline for this task log is finished, let new alerts for the device/object start new work"""
+    release_incoming_payloads([task_log])
+
+
+def release_incoming_payloads(task_logs):
+    """
+    release_incoming_payload for many task logs in two queries. Task logs
+    point at their IncomingPayload, older ones at their BenchmarkPayload.
+    """
+    parent_ids = [task_log.parent_id for task_log in task_logs]
+    benchmark_parents = {benchmark_payload.id: benchmark_payload.parent_id
+                         for benchmark_payload in BenchmarkPayload.objects(id__in=parent_ids).only('parent_id')}
+    payload_ids = [benchmark_parents.get(parent_id, parent_id) for parent_id in parent_ids]
+    IncomingPayload.objects(id__in=payload_ids).update(set__in_flight=False)
+
+
+def get_device_name(device, ipaddress=None):
+    """NetBrain site path of the device from the DeviceInventory, by name or else ip address"""
+    inventory_device = get_device_inventory().resolve(device, ipaddress)
+    if inventory_device:
+        return inventory_device.site_path
     else:
         return 'Invalid device'
 
 
+def device_site(site_path):
+    """the NetBrain site of a device site path, the path without the device itself"""
+    return site_path.rsplit('/', 1)[0] if '/' in site_path else site_path
+
+
 def translate_incoming_payload_to_benchmark_payload():
-    """Check if there are any new payloads received, and log them as benchmark payload"""
-    logger.info(f"translate_incoming_payload_to_benchmark_payload > start")
-    new_payloads = IncomingPayload.objects(status='NEW')
+    """
+    Check if there are any new payloads received, and log them as benchmark payload
+
+    Payloads needing a benchmark are grouped by the NetBrain site of their
+    device and CLI command set, and each group becomes one multi-device
+    benchmark. A group is
+    held back while it has fewer than BENCHMARK_BATCH_MAX_DEVICES devices
+    and its oldest payload is younger than BENCHMARK_BATCH_WINDOW seconds,
+    so an outage over many devices runs one NetBrain task instead of one
+    per device. The default window of 0 groups whatever is pending now.
+    """
+    logger.info("translate_incoming_payload_to_benchmark_payload > start")
+    new_payloads = IncomingPayload.objects(status='NEW').order_by('created_datetime')
+    # (scope type, site, cli commands) -> [(payload, device site path)]
+    groups = {}
     for payload in new_payloads:
         device = payload.devicename
         ipaddress = payload.ipaddress
         payload_id = payload.id
         try:
-            """translate incoming payload to benchmark payload"""
-            entry_count = BenchmarkPayload.objects().count()
-            task_name = f"Benchmark_event_{entry_count + 1}"
-            device_name = get_device_name(device)
-            start_date = datetime.utcnow().strftime('%Y-%m-%d')
-            start_time = datetime.utcnow().strftime('%H:%M:%S')
-            new_payload = Benchmark(
-                taskName=task_name,
-                startDate=start_date,
-                schedule=Schedule(frequency="once", startTime=[start_time]),
-                deviceScope=DeviceScope(scopeType="site", scopes=[device_name], ipaddress=ipaddress),
-                cliCommands=["showversion", "showarp", "showinterface"]
-            )
-
-            """log benchmark payload"""
-            benchmark_payload_entry = BenchmarkPayload(
-                parent_id=payload_id,
-                benchmark_payload=new_payload,
-                status='NEW',
-                created_datetime=datetime.utcnow()
-            )
-            benchmark_payload_entry.save()
-            benchmark = benchmark_payload_entry.to_mongo().to_dict()
-            logger.info(f"translate_incoming_payload_to_benchmark_payload > {str(benchmark)}")
-            """set incoming payload status to completed"""
-            payload.status = 'COMPLETED'
-            payload.save()
+            device_name = get_device_name(device, ipaddress)
+            if device_name == 'Invalid device':
+                """unknown to the inventory, rejected even when its device data is cached"""
+                IncomingPayload.objects(id=payload_id, status='NEW').update(set__status='INVALID_DEVICE',
+                                                                           set__in_flight=False)
+                logger.error("translate_incoming_payload_to_benchmark_payload > device %s / %s not in inventory, payload %s rejected",
+                             device, ipaddress, payload_id)
+                continue
+
+            """reuse fresh device data instead of running another benchmark"""
+            cached_content = get_device_data_cache().get(ipaddress, DEVICE_DATA_TYPE, DEVICE_DATA_CMD)
+            if cached_content is not None:
+                if not claim_incoming_payload(payload):
+                    continue
+                task_log = TaskLog(parent_id=payload_id,
+                                   task_name=f"Cached_event_{payload.cid}",
+                                   ipaddress=ipaddress,
+                                   content=cached_content,
+                                   status='PROCESS_CONTENT',
+                                   from_cache=True,
+                                   cids=payload.related_cids or [payload.cid],
+                                   created_datetime=datetime.utcnow())
+                task_log.save()
+                logger.info("translate_incoming_payload_to_benchmark_payload > cached device data used for %s, task log: %s", ipaddress, task_log.id)
+                payload.status = 'COMPLETED'
+                payload.save()
+                continue
+
+            group_key = ("site", device_site(device_name), tuple(BENCHMARK_CLI_COMMANDS))
+            groups.setdefault(group_key, []).append((payload, device_name))
         except Exception as e:
-            logger.error(f"translate_incoming_payload_to_benchmark_payload > Error: '{str(e)}'")
-    logger.info(f"translate_incoming_payload_to_benchmark_payload > end")
+            logger.error("translate_incoming_payload_to_benchmark_payload > Error: '%s'", e)
+
+    window = settings.get('BENCHMARK_BATCH_WINDOW', 0)
+    max_devices = settings.get('BENCHMARK_BATCH_MAX_DEVICES', 50)
+    now = datetime.utcnow()
+    for group_key, members in groups.items():
+        for start in range(0, len(members), max_devices):
+            batch = members[start:start + max_devices]
+            oldest = batch[0][0].created_datetime
+            if len(batch) < max_devices and (now - oldest).total_seconds() < window:
+                logger.info("translate_incoming_payload_to_benchmark_payload > holding %s payloads for %s, window open", len(batch), group_key)
+                continue
+            batch = [(payload, device_name) for payload, device_name in batch if claim_incoming_payload(payload)]
+            if not batch:
+                continue
+            try:
+                create_group_benchmark(group_key, batch)
+            except Exception as e:
+                """hand the payloads back to the next pass"""
+                IncomingPayload.objects(id__in=[payload.id for payload, device_name in batch],
+                                        status='TRANSLATING').update(set__status='NEW')
+                logger.error("translate_incoming_payload_to_benchmark_payload > Error: '%s'", e)
+    logger.info("translate_incoming_payload_to_benchmark_payload > end")
+
+
+def claim_incoming_payload(payload):
+    """move a NEW payload to TRANSLATING, False when a concurrent pass already took it"""
+    return IncomingPayload.objects(id=payload.id, status='NEW').update(set__status='TRANSLATING') == 1
+
+
+def create_group_benchmark(group_key, batch):
+    """log one benchmark payload covering every (payload, device site path) in batch"""
+    scope_type, site, cli_commands = group_key
+    payloads = [payload for payload, device_name in batch]
+    scopes = list(dict.fromkeys(device_name for payload, device_name in batch))
+    ipaddresses = list(dict.fromkeys(payload.ipaddress for payload in payloads))
+
+    """translate incoming payload to benchmark payload, get_cid keeps concurrent task names unique"""
+    task_name = f"Benchmark_event_{get_cid()}"
+    start_date = datetime.utcnow().strftime('%Y-%m-%d')
+    start_time = datetime.utcnow().strftime('%H:%M:%S')
+    new_payload = Benchmark(
+        taskName=task_name,
+        startDate=start_date,
+        schedule=Schedule(frequency="once", startTime=[start_time]),
+        deviceScope=DeviceScope(scopeType=scope_type, scopes=scopes, ipaddresses=ipaddresses,
+                                ipaddress=ipaddresses[0] if len(ipaddresses) == 1 else None),
+        cliCommands=list(cli_commands)
+    )
+
+    """log benchmark payload"""
+    benchmark_payload_entry = BenchmarkPayload(
+        parent_id=payloads[0].id,
+        parent_ids=[payload.id for payload in payloads],
+        benchmark_payload=new_payload,
+        status='NEW',
+        created_datetime=datetime.utcnow()
+    )
+    benchmark_payload_entry.save()
+    logger.info("create_group_benchmark > %s devices at %s: %s", len(payloads), site, Truncated(benchmark_payload_entry.to_mongo))
+    """set incoming payload status to completed"""
+    IncomingPayload.objects(id__in=benchmark_payload_entry.parent_ids).update(set__status='COMPLETED')
+    return benchmark_payload_entry
 
 
 def check_and_add_benchmark():
@@ -163,33 +425,42 @@ def check_and_add_benchmark():
     for new_benchmark_payload in new_benchmark_payloads:
         benchmark_payload = new_benchmark_payload.benchmark_payload
         benchmark_payload_dict = benchmark_payload.to_mongo().to_dict()
-        benchmark_payload_id = new_benchmark_payload.id
+        """claim it, so concurrent passes don't add the same benchmark twice"""
+        if not BenchmarkPayload.objects(id=new_benchmark_payload.id, status='NEW').update(set__status='ADDING'):
+            continue
         try:
-            logger.info(f"check_and_add_benchmark > {str(benchmark_payload_dict)}")
+            logger.info("check_and_add_benchmark > %s", Truncated(benchmark_payload_dict))
             status = add_benchmark(benchmark_payload_dict)
             if status == 'Success.':
                 """set benchmark payload status to completed"""
                 new_benchmark_payload.status = 'COMPLETED'
                 new_benchmark_payload.save()
 
-                logger.info(f"check_and_add_benchmark > statu: {str(status)}")
+                logger.info("check_and_add_benchmark > statu: %s", status)
 
-                """log taskname and ipaddress in task log"""
+                """log taskname and ipaddress in task log, one per device so completion is tracked per device"""
                 task_name = benchmark_payload['taskName']
-                ipaddress = benchmark_payload['deviceScope']['ipaddress']
-                task_log = TaskLog(parent_id=benchmark_payload_id,
-                                   task_name=task_name,
-                                   ipaddress=ipaddress,
-                                   content='',
-                                   status='NEW',
-                                   created_datetime=datetime.utcnow())
-                task_log.save()
-                task_log_dict = task_log.to_mongo().to_dict()
-                logger.info(f"check_and_add_benchmark > create task log : {str(task_log_dict)}")
+                payload_ids = new_benchmark_payload.parent_ids or [new_benchmark_payload.parent_id]
+                task_logs = [
+                    TaskLog(parent_id=payload.id,
+                            task_name=task_name,
+                            ipaddress=payload.ipaddress,
+                            content='',
+                            status='NEW',
+                            cids=payload.related_cids or [payload.cid],
+                            created_datetime=datetime.utcnow())
+                    for payload in IncomingPayload.objects(id__in=payload_ids).only('ipaddress', 'cid', 'related_cids')
+                ]
+                if task_logs:
+                    TaskLog.objects.insert(task_logs, load_bulk=False)
+                logger.info("check_and_add_benchmark > %s task logs created for %s", len(task_logs), task_name)
             else:
-                logger.error(f"check_and_add_benchmark > status: {str(status)}")
+                """hand it back to the next pass"""
+                BenchmarkPayload.objects(id=new_benchmark_payload.id).update(set__status='NEW')
+                logger.error("check_and_add_benchmark > status: %s", status)
         except Exception as e:
-            logger.error(f"check_and_add_benchmark > Error: '{str(e)}'")
+            BenchmarkPayload.objects(id=new_benchmark_payload.id, status='ADDING').update(set__status='NEW')
+            logger.error("check_and_add_benchmark > Error: '%s'", e)
 
 
 def add_benchmark(benchmark_payload_dict):
@@ -201,22 +472,20 @@ def add_benchmark(benchmark_payload_dict):
 
 
 def get_benchmark_status():
-    """Check if there are any new task logs"""
-    task_logs = TaskLog.objects(status='NEW')
-    for task_log in task_logs:
-        task_name = task_log.task_name
+    """Check if there are any new task logs, polling each benchmark task once for all of its devices"""
+    task_names = TaskLog.objects(status='NEW').distinct('task_name')
+    for task_name in task_names:
         try:
-            logger.info(f"get_benchmark_status > task name: '{str(task_name)}'")
+            logger.info("get_benchmark_status > task name: '%s'", task_name)
             """get benchmark status for the given task name"""
             status = check_task_status(task_name)
             if status == 'Success.':
-                task_log.status = 'GET_DEVICE_INFO'
-                task_log.save()
-                logger.info(f"get_benchmark_status > task status: '{str(status)}'")
+                updated = TaskLog.objects(task_name=task_name, status='NEW').update(set__status='GET_DEVICE_INFO')
+                logger.info("get_benchmark_status > task status: '%s', %s devices", status, updated)
             else:
-                logger.error(f"get_benchmark_status > task status: '{str(status)}'")
+                logger.error("get_benchmark_status > task status: '%s'", status)
         except Exception as e:
-            logger.error(f"get_benchmark_status > Error: '{str(e)}'")
+            logger.error("get_benchmark_status > Error: '%s'", e)
 
 
 def check_task_status(task_name):
@@ -233,75 +502,144 @@ def get_device_info():
     for task_log in task_logs:
         ipaddress = task_log.ipaddress
         try:
-            logger.info(f"get_device_info > ipaddress: '{str(ipaddress)}'")
+            logger.info("get_device_info > ipaddress: '%s'", ipaddress)
             """get device info for the given ip address"""
-            result = check_device_info(ipaddress)
+            result = check_device_info(ipaddress, force_refresh=True)
             if result['status'] == 'Success.':
                 task_log.content = str(result['content'])
                 task_log.status = 'PROCESS_CONTENT'
                 task_log.save()
-                logger.info(f"get_device_info > result: '{str(result)}'")
+                logger.info("get_device_info > result: '%s'", Truncated(result))
             else:
-                logger.error(f"get_device_info > result: '{str(result)}'")
+                logger.error("get_device_info > result: '%s'", Truncated(result))
         except Exception as e:
-            logger.error(f"get_device_info > Error: '{str(e)}'")
+            logger.error("get_device_info > Error: '%s'", e)
 
 
-def check_device_info(ipaddress):
-    """get devise info by ip address"""
-    token = get_login_token()
-    if token == '':
-        return {'status': "Error: No token found", 'content': ''}
-    return requests_consumer.get_device_info(token, ipaddress)
+def check_device_info(ipaddress, force_refresh=False):
+    """get devise info by ip address, served from the DeviceDataCache while fresh"""
+    def fetch():
+        token = get_login_token()
+        if token == '':
+            return {'status': "Error: No token found", 'content': ''}
+        return requests_consumer.get_device_info(token, ipaddress, DEVICE_DATA_TYPE, DEVICE_DATA_CMD)
+
+    return get_device_data_cache().get_or_fetch(ipaddress, DEVICE_DATA_TYPE, DEVICE_DATA_CMD, fetch,
+                                                force_refresh=force_refresh)
 
 
 def process_device_content():
-    """Check if there are any new task with status as process content"""
-    task_logs = TaskLog.objects(status='PROCESS_CONTENT')
+    """
+    Check if there are any new task with status as process content. The
+    content of every task log is parsed in one go, so the optional parse
+    pool works on all of them at once, and statuses are updated in bulk.
+    Content identical to the device's last parsed output isn't parsed again.
+
+    Each task log is claimed first, PROCESS_CONTENT to PARSING in a status
+    filtered update, so concurrent passes never parse the same content;
+    failed parses are handed back as PROCESS_CONTENT, and a claim older
+    than CONTENT_PARSER_LEASE seconds (its pass died) is taken over.
+    """
+    now = datetime.utcnow()
+    claimable = (Q(status='PROCESS_CONTENT') |
+                 Q(status='PARSING', parsing_datetime__lt=now - timedelta(seconds=settings.get('CONTENT_PARSER_LEASE', 600))))
+    task_logs = [
+        task_log for task_log in TaskLog.objects(claimable)
+        if TaskLog.objects(Q(id=task_log.id) & claimable).update_one(set__status='PARSING', set__parsing_datetime=now)
+    ]
+    if not task_logs:
+        return
+    try:
+        for task_log in task_logs:
+            logger.info("process_device_content > content: '%s'", Truncated(task_log.content))
+        changes = detect_output_changes(task_logs, DEVICE_DATA_CMD)
+        """parse the changed content into ParsedRecords"""
+        results = store_parsed_records_many([task_log for task_log in task_logs if changes[task_log.id].changed],
+                                            DEVICE_DATA_CMD)
+        for task_log in task_logs:
+            if not changes[task_log.id].changed:
+                results[task_log.id] = {'status': 'Success.', 'records': 0}
+    except Exception as e:
+        release_parsing(task_logs)
+        logger.error("process_device_content > Error: '%s'", e)
+        return
+
+    parsed = []
     for task_log in task_logs:
-        content = task_log.content
-        try:
-            logger.info(f"process_device_content > content: '{str(content)}'")
-            """get device info for the given ip address"""
-            status = next_process_with_device_content(content)
-            if status == 'Success.':
-                task_log.status = 'DELETE_TASK'
-                task_log.save()
-                logger.info(f"process_device_content > status: '{str(status)}'")
-            else:
-                logger.error(f"process_device_content > status: '{str(status)}'")
-        except Exception as e:
-            logger.error(f"process_device_content > Error: '{str(e)}'")
+        status = results[task_log.id]['status']
+        if status == 'Success.':
+            parsed.append(task_log)
+            logger.info("process_device_content > status: '%s'", status)
+        else:
+            logger.error("process_device_content > status: '%s'", status)
+    release_parsing([task_log for task_log in task_logs if task_log not in parsed])
+    if not parsed:
+        return
 
+    try:
+        record_output_changes(parsed, changes, DEVICE_DATA_CMD)
+        """
+        the result is ready, so the payloads are released now; benchmark tasks
+        are deleted later by the BenchmarkReaper, cached results have none
+        """
+        now = datetime.utcnow()
+        benchmarked = [task_log.id for task_log in parsed if not task_log.from_cache]
+        from_cache = [task_log.id for task_log in parsed if task_log.from_cache]
+        if benchmarked:
+            TaskLog.objects(id__in=benchmarked).update(set__status='DELETE_TASK', set__completed_datetime=now)
+        if from_cache:
+            TaskLog.objects(id__in=from_cache).update(set__status='COMPLETED', set__completed_datetime=now)
+        release_incoming_payloads(parsed)
+    except Exception as e:
+        logger.error("process_device_content > Error: '%s'", e)
+        return
 
-def next_process_with_device_content(content):
-    """dummy function: placeholder to process device content"""
-    return 'Success.'
+    """fan the result back out to every alert waiting on this device"""
+    try:
+        record_alert_results(parsed, now)
+    except Exception as e:
+        logger.error("process_device_content > Error: '%s'", e)
 
 
-def delete_benchmark():
-    """Check if there are any new task with status as delete task"""
-    task_logs = TaskLog.objects(status='DELETE_TASK')
-    for task_log in task_logs:
-        task_name = task_log.task_name
-        try:
-            logger.info(f"delete_benchmark > task_name: '{str(task_name)}'")
-            """get benchmark status for the given task name"""
-            status = delete_task(task_name)
-            if status == 'Success.':
-                task_log.status = 'COMPLETED'
-                task_log.save()
-                logger.info(f"delete_benchmark > status: '{str(status)}'")
-            else:
-                logger.error(f"delete_benchmark > status: '{str(status)}'")
-        except Exception as e:
-            logger.error(f"delete_benchmark > Error: '{str(e)}'")
+def release_parsing(task_logs):
+    """hand claimed task logs back to the next process_device_content pass"""
+    if task_logs:
+        TaskLog.objects(id__in=[task_log.id for task_log in task_logs], status='PARSING').update(
+            set__status='PROCESS_CONTENT')
 
 
-def delete_task(task_name):
-    """delete benchmark / task"""
-    token = get_login_token()
+def record_alert_results(task_logs, completed_datetime):
+    """
+    one AlertResult per cid covered by task_logs, upserted on the cid so
+    a pass repeated after a crash writes nothing twice
+    """
+    for task_log in task_logs:
+        for cid in task_log.cids:
+            AlertResult.objects(cid=cid).update_one(
+                upsert=True,
+                set__payload_id=task_log.parent_id,
+                set__task_log_id=task_log.id,
+                set__task_name=task_log.task_name,
+                set__ipaddress=task_log.ipaddress,
+                set__status='RESULT_READY',
+                set__completed_datetime=completed_datetime)
+            with cid_context(cid):
+                logger.info("process_device_content > result ready for %s, task log %s", task_log.ipaddress, task_log.id)
+
+
+def delete_task(task_name, token=None):
+    """delete benchmark / task, with the shared login token unless one is given"""
+    token = token or get_login_token()
     if token == '':
         return "Error: No token found"
 
     return requests_consumer.delete_task(token, task_name)
+
+
+def list_tasks(token=None):
+    """names of the benchmark tasks on NetBrain, with the shared login token unless one is given"""
+    token = token or get_login_token()
+    if token == '':
+        return {'status': "Error: No token found", 'tasks': []}
+
+    return requests_consumer.list_tasks(token)
@@ -0,0 +1,411 @@
+import os
+import re
+import logging
+import threading
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from datetime import datetime
+from functools import lru_cache
+from itertools import islice
+from typing import Iterable, Iterator, Optional
+
+from pymongo.errors import BulkWriteError
+
+from src.netbrain_service.config import settings
+from src.netbrain_service.application.mongo_models import ParsedRecord
+
+"""
+Streaming parse stage for NetBrain DeviceRawData content.
+
+Content is walked line by line with generators, records are produced as
+lines match and written to the parsed_record collection in chunks of
+CONTENT_PARSER_CHUNK_SIZE, so no more than one chunk of records (and,
+for TextFSM templates, one section of lines) is held at a time however
+large the CLI output is.
+
+Each CLI command is parsed by the first ParserTemplate whose command
+pattern matches it. Templates from the CONTENT_PARSER_TEMPLATES setting
+are tried before the built-in ones, ex. in settings.toml
+
+    [[default.CONTENT_PARSER_TEMPLATES]]
+    name = "arp"
+    command = "sh(ow)? arp"
+    records = ['^(?P<address>\\d+\\.\\d+\\.\\d+\\.\\d+)\\s+\\S+\\s+(?P<mac>[0-9a-f.]+)']
+
+Templates are compiled once per process and cached.
+
+Writes are idempotent: a record is keyed on (task_log_id, template, seq),
+seq being its position in the content, and a key that is already stored
+is left as it is, so parsing the same content again (a retry, or a pass
+that raced another) converges on one copy of every record.
+
+Parsing is CPU bound, with CONTENT_PARSER_PROCESSES set to a worker count
+store_parsed_records_many parses in a process pool instead of on the
+calling thread, see get_parse_pool.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ParserTemplate:
+    """
+    name        stored on every ParsedRecord it produces
+    command     regex matched against the whole, normalized CLI command
+    records     regexes with named groups, a line matching one of them
+                (first match wins) becomes a record of its groups
+    section     optional regex starting a new section, its named groups
+                are added to every record of the section
+    textfsm     optional path to a TextFSM template, run once per section
+                (or once over the whole content when there is no section
+                regex) instead of records. Needs the textfsm package.
+    """
+    name: str
+    command: str
+    records: tuple[str, ...] = ()
+    section: str = ''
+    textfsm: str = ''
+
+
+BUILTIN_TEMPLATES = (
+    ParserTemplate(
+        name='interface_status',
+        command=r'sh(ow)? (int|interfaces?)( \S+)?( brief)?',
+        records=(
+            r'^(?P<interface>\S+) is (?P<admin_status>administratively down|up|down), '
+            r'line protocol is (?P<protocol_status>[\w ]+?)(?:,|$)',
+        ),
+    ),
+    ParserTemplate(
+        name='controller_phy',
+        command=r'sh(ow)? controllers \S+ phy',
+        records=(
+            r'^(?P<interface>\S+) is (?P<admin_status>administratively down|up|down), '
+            r'line protocol is (?P<protocol_status>[\w ]+?)(?:, rx_errors (?P<rx_errors>\d+))?$',
+            r'^\s*(?P<key>[A-Za-z][\w /().-]*?)\s*:\s*(?P<value>\S.*?)\s*$',
+        ),
+        section=r'^\s*(?:SFP EEPROM|Xcvr) port:\s*(?P<port>\d+)',
+    ),
+)
+
+
+class CompiledTemplate:
+    """a ParserTemplate with its regexes compiled, see compile_template"""
+
+    def __init__(self, template: ParserTemplate):
+        self.template = template
+        self.name = template.name
+        self.records = [re.compile(pattern) for pattern in template.records]
+        self.section = re.compile(template.section) if template.section else None
+        self.textfsm = None
+        if template.textfsm:
+            with open(template.textfsm) as template_file:
+                self.textfsm = template_file.read()
+
+    def parse(self, lines: Iterable[str]) -> Iterator[dict]:
+        if self.textfsm is not None:
+            return self.__parse_textfsm(lines)
+        return self.__parse_records(lines)
+
+    def __parse_records(self, lines: Iterable[str]) -> Iterator[dict]:
+        section = {}
+        for line in lines:
+            if self.section:
+                match = self.section.match(line)
+                if match:
+                    section = {key: value for key, value in match.groupdict().items() if value is not None}
+                    continue
+            for pattern in self.records:
+                match = pattern.match(line)
+                if match:
+                    record = dict(section)
+                    record.update((key, value) for key, value in match.groupdict().items() if value is not None)
+                    yield record
+                    break
+
+    def __parse_textfsm(self, lines: Iterable[str]) -> Iterator[dict]:
+        import io
+        import textfsm
+
+        def run(section: dict, section_lines: list[str]) -> Iterator[dict]:
+            fsm = textfsm.TextFSM(io.StringIO(self.textfsm))
+            for row in fsm.ParseTextToDicts('\n'.join(section_lines) + '\n'):
+                record = dict(section)
+                record.update(row)
+                yield record
+
+        section, section_lines = {}, []
+        for line in lines:
+            match = self.section.match(line) if self.section else None
+            if match:
+                yield from run(section, section_lines)
+                section = {key: value for key, value in match.groupdict().items() if value is not None}
+                section_lines = []
+            else:
+                section_lines.append(line)
+        yield from run(section, section_lines)
+
+
+_templates_lock = threading.RLock()
+_templates: Optional[list[ParserTemplate]] = None
+
+
+def templates() -> list[ParserTemplate]:
+    """CONTENT_PARSER_TEMPLATES followed by BUILTIN_TEMPLATES, read from settings once"""
+    global _templates
+    if _templates is None:
+        with _templates_lock:
+            if _templates is None:
+                configured = [ParserTemplate(**{**spec, 'records': tuple(spec.get('records', ()))})
+                              for spec in settings.get('CONTENT_PARSER_TEMPLATES', [])]
+                _templates = configured + list(BUILTIN_TEMPLATES)
+    return _templates
+
+
+def register_template(template: ParserTemplate):
+    """add a template ahead of the configured and built-in ones"""
+    global _templates
+    with _templates_lock:
+        _templates = [template] + templates()
+    template_for.cache_clear()
+
+
+@lru_cache(maxsize=None)
+def compile_template(template: ParserTemplate) -> CompiledTemplate:
+    return CompiledTemplate(template)
+
+
+def normalize_command(cmd: str) -> str:
+    return ' '.join(cmd.lower().split())
+
+
+@lru_cache(maxsize=1024)
+def template_for(cmd: str) -> Optional[CompiledTemplate]:
+    """compiled template of the first ParserTemplate matching cmd, None when no template does"""
+    normalized = normalize_command(cmd)
+    for template in templates():
+        if re.fullmatch(template.command, normalized, re.IGNORECASE):
+            return compile_template(template)
+    return None
+
+
+def warm_templates():
+    """compile every known template now instead of on first use"""
+    for template in templates():
+        compile_template(template)
+
+
+def iter_lines(content: str) -> Iterator[str]:
+    """lines of content without the line endings, sliced one at a time instead of split up front"""
+    start, length = 0, len(content)
+    while start < length:
+        end = content.find('\n', start)
+        if end == -1:
+            end = length
+        yield content[start:end].rstrip('\r')
+        start = end + 1
+
+
+def parse_content(cmd: str, content: str) -> Iterator[dict]:
+    """records parsed out of content, nothing when no template matches cmd"""
+    compiled = template_for(cmd)
+    if compiled is None:
+        return iter(())
+    return compiled.parse(iter_lines(content))
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def _insert_new(documents: list[ParsedRecord]):
+    """insert documents, keeping the ones whose (task_log_id, template, seq) is already stored"""
+    try:
+        ParsedRecord._get_collection().insert_many([document.to_mongo() for document in documents], ordered=False)
+    except BulkWriteError as e:
+        if any(error['code'] != 11000 for error in e.details['writeErrors']):
+            raise
+
+
+def _drop_stale(task_log_ids: list, template: str, counts: dict):
+    """records left by an earlier parse with another template, or past the end of this one"""
+    for task_log_id in task_log_ids:
+        ParsedRecord.objects(task_log_id=task_log_id, template__ne=template).delete()
+        ParsedRecord.objects(task_log_id=task_log_id, template=template, seq__gte=counts[task_log_id]).delete()
+
+
+def store_parsed_records(task_log, cmd: str) -> dict:
+    """
+    Parse task_log.content as the output of cmd and store the task log's
+    ParsedRecords, returns {'status': ..., 'records': n}. Content with no
+    template for cmd is left unparsed and still succeeds.
+    """
+    compiled = template_for(cmd)
+    if compiled is None:
+        logger.info("store_parsed_records > no template for '%s', content left unparsed", cmd)
+        return {'status': 'Success.', 'records': 0}
+
+    chunk_size = settings.get('CONTENT_PARSER_CHUNK_SIZE', 500)
+    now = datetime.utcnow()
+    count = 0
+    for chunk in chunked(compiled.parse(iter_lines(task_log.content or '')), chunk_size):
+        _insert_new([
+            ParsedRecord(task_log_id=task_log.id, ipaddress=task_log.ipaddress, cmd=cmd,
+                         template=compiled.name, seq=count + offset, record=record, created_datetime=now)
+            for offset, record in enumerate(chunk)
+        ])
+        count += len(chunk)
+    _drop_stale([task_log.id], compiled.name, {task_log.id: count})
+    logger.info("store_parsed_records > %s records from '%s' for %s", count, compiled.name, task_log.ipaddress)
+    return {'status': 'Success.', 'records': count}
+
+
+_parse_pool: Optional[ProcessPoolExecutor] = None
+_parse_pool_pid: Optional[int] = None
+_parse_pool_lock = threading.Lock()
+
+
+def get_parse_pool() -> Optional[ProcessPoolExecutor]:
+    """
+    Process wide parse pool with CONTENT_PARSER_PROCESSES workers, None
+    when the setting is 0 (the default) and content is parsed in-process.
+    Workers are started with CONTENT_PARSER_START_METHOD ('spawn' by
+    default, they never touch the parent's Mongo client or threads) and
+    compile every template before taking their first task. A process
+    forked after the pool was created, ex. a gunicorn worker, gets its own.
+    """
+    global _parse_pool, _parse_pool_pid
+    processes = settings.get('CONTENT_PARSER_PROCESSES', 0)
+    if not processes:
+        return None
+    with _parse_pool_lock:
+        if _parse_pool is None or _parse_pool_pid != os.getpid():
+            _parse_pool = ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context(settings.get('CONTENT_PARSER_START_METHOD', 'spawn')),
+                initializer=_init_parse_worker,
+                initargs=(tuple(templates()),),
+            )
+            _parse_pool_pid = os.getpid()
+            logger.info("get_parse_pool > started %s parse workers", processes)
+        return _parse_pool
+
+
+def _discard_parse_pool(pool: ProcessPoolExecutor):
+    """drop a broken pool, the next get_parse_pool starts a new one"""
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is pool:
+            _parse_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _init_parse_worker(worker_templates: tuple[ParserTemplate, ...]):
+    """pool initializer: take the parent's templates, including registered ones, and compile them"""
+    global _templates
+    _templates = list(worker_templates)
+    template_for.cache_clear()
+    warm_templates()
+
+
+def _parse_batch(cmd: str, items: list[tuple]) -> list[tuple]:
+    """
+    Runs in a pool worker. Parses each (task_log_id, content) and returns
+    (task_log_id, template name, records, error) for each.
+    """
+    compiled = template_for(cmd)
+    results = []
+    for task_log_id, content in items:
+        if compiled is None:
+            results.append((task_log_id, None, [], None))
+            continue
+        try:
+            results.append((task_log_id, compiled.name, list(compiled.parse(iter_lines(content or ''))), None))
+        except Exception as e:
+            results.append((task_log_id, compiled.name, [], str(e)))
+    return results
+
+
+def _write_parsed_batch(parsed: list[tuple], task_logs: dict, cmd: str) -> dict:
+    """store the ParsedRecords of a batch parsed by the pool, inserted in bulk across its task logs"""
+    results = {}
+    for task_log_id, template, records, error in parsed:
+        if error is not None:
+            results[task_log_id] = {'status': f"Failed to parse content. Error: {error}", 'records': 0}
+        else:
+            results[task_log_id] = {'status': 'Success.', 'records': len(records)}
+    succeeded = [task_log_id for task_log_id, template, records, error in parsed if error is None]
+    if not succeeded:
+        return results
+
+    now = datetime.utcnow()
+    documents = (
+        ParsedRecord(task_log_id=task_log_id, ipaddress=task_logs[task_log_id].ipaddress, cmd=cmd,
+                     template=template, seq=seq, record=record, created_datetime=now)
+        for task_log_id, template, records, error in parsed if error is None
+        for seq, record in enumerate(records)
+    )
+    for chunk in chunked(documents, settings.get('CONTENT_PARSER_CHUNK_SIZE', 500)):
+        _insert_new(chunk)
+    counts = {task_log_id: len(records) for task_log_id, template, records, error in parsed if error is None}
+    for task_log_id, template, records, error in parsed:
+        if error is None and template is not None:
+            _drop_stale([task_log_id], template, counts)
+    return results
+
+
+def store_parsed_records_many(task_logs: list, cmd: str) -> dict:
+    """
+    store_parsed_records for every task log, returns task log id -> result.
+
+    In the parse pool, task logs are submitted CONTENT_PARSER_BATCH_SIZE at
+    a time and the records of each batch are written back in bulk as it
+    finishes. A worker returns every record of a content at once, so unlike
+    the in-process path memory is bounded per content rather than per chunk.
+    """
+    if not task_logs:
+        return {}
+    pool = get_parse_pool()
+    results = {}
+    if pool is None:
+        for task_log in task_logs:
+            try:
+                results[task_log.id] = store_parsed_records(task_log, cmd)
+            except Exception as e:
+                results[task_log.id] = {'status': f"Failed to parse content. Error: {str(e)}", 'records': 0}
+        return results
+
+    if template_for(cmd) is None:
+        logger.info("store_parsed_records_many > no template for '%s', content left unparsed", cmd)
+        return {task_log.id: {'status': 'Success.', 'records': 0} for task_log in task_logs}
+
+    by_id = {task_log.id: task_log for task_log in task_logs}
+    futures = {}
+    try:
+        for batch in chunked(task_logs, settings.get('CONTENT_PARSER_BATCH_SIZE', 8)):
+            future = pool.submit(_parse_batch, cmd, [(task_log.id, task_log.content) for task_log in batch])
+            futures[future] = [task_log.id for task_log in batch]
+    except BrokenProcessPool as e:
+        _discard_parse_pool(pool)
+        logger.error("store_parsed_records_many > parse pool Error: '%s'", e)
+
+    for future in as_completed(futures):
+        try:
+            results.update(_write_parsed_batch(future.result(), by_id, cmd))
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                _discard_parse_pool(pool)
+            logger.error("store_parsed_records_many > Error: '%s'", e)
+            for task_log_id in futures[future]:
+                results[task_log_id] = {'status': f"Failed to parse content. Error: {str(e)}", 'records': 0}
+    for task_log in task_logs:
+        results.setdefault(task_log.id, {'status': 'Failed to parse content. Error: not submitted', 'records': 0})
+    logger.info("store_parsed_records_many > %s records from %s task logs",
+                sum(result['records'] for result in results.values()), len(task_logs))
+    return results
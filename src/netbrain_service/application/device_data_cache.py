@@ -0,0 +1,128 @@
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+from src.netbrain_service.config import settings
+from src.netbrain_service.application.mongo_models import DeviceDataCacheEntry
+
+logger = logging.getLogger(__name__)
+
+CacheKey = tuple[str, str, str]
+
+
+class DeviceDataCache:
+    """
+    Read-through cache of NetBrain DeviceRawData content keyed on
+    (ipaddress, dataType, cmd).
+
+    The local tier is a size-bounded LRU where each entry expires ttl
+    seconds after it was stored. When shared is True, entries are also
+    written to the device_data_cache collection (expired by a Mongo TTL
+    index) so other workers can reuse data this one collected; a local
+    miss then falls back to the shared tier before fetching.
+
+    Only successful results are cached, failures always go back to
+    NetBrain on the next call.
+    """
+
+    def __init__(self, ttl: int, max_entries: int, shared: bool = False):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.shared = shared
+        self._entries: OrderedDict[CacheKey, tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, ipaddress: str, data_type: str, cmd: str) -> Optional[str]:
+        """Return cached content if still fresh, else None"""
+        key = (ipaddress, data_type, cmd)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                expires_at, content = entry
+                if time.monotonic() < expires_at:
+                    self._entries.move_to_end(key)
+                    return content
+                del self._entries[key]
+
+        if self.shared:
+            try:
+                shared_entry = DeviceDataCacheEntry.objects(ipaddress=ipaddress, data_type=data_type, cmd=cmd,
+                                                            expires_at__gt=datetime.utcnow()).first()
+            except Exception as e:
+                logger.error("DeviceDataCache.get > shared tier Error: '%s'", e)
+            else:
+                if shared_entry:
+                    remaining = (shared_entry.expires_at - datetime.utcnow()).total_seconds()
+                    self.__put_local(key, shared_entry.content, remaining)
+                    return shared_entry.content
+        return None
+
+    def put(self, ipaddress: str, data_type: str, cmd: str, content: str):
+        self.__put_local((ipaddress, data_type, cmd), content, self.ttl)
+        if self.shared:
+            try:
+                DeviceDataCacheEntry.objects(ipaddress=ipaddress, data_type=data_type, cmd=cmd).update_one(
+                    upsert=True,
+                    set__content=content,
+                    set__expires_at=datetime.utcnow() + timedelta(seconds=self.ttl))
+            except Exception as e:
+                logger.error("DeviceDataCache.put > shared tier Error: '%s'", e)
+
+    def __put_local(self, key: CacheKey, content: str, ttl: float):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, content)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, ipaddress: str, data_type: str, cmd: str):
+        with self._lock:
+            self._entries.pop((ipaddress, data_type, cmd), None)
+        if self.shared:
+            try:
+                DeviceDataCacheEntry.objects(ipaddress=ipaddress, data_type=data_type, cmd=cmd).delete()
+            except Exception as e:
+                logger.error("DeviceDataCache.invalidate > shared tier Error: '%s'", e)
+
+    def get_or_fetch(self, ipaddress: str, data_type: str, cmd: str, fetch: Callable[[], dict],
+                     force_refresh: bool = False) -> dict:
+        """
+        Return {'status': ..., 'content': ...} like requests_consumer.get_device_info,
+        from the cache when fresh, else from fetch(). force_refresh skips the
+        lookup and replaces the cached content with the fetched result.
+        """
+        if not force_refresh:
+            content = self.get(ipaddress, data_type, cmd)
+            if content is not None:
+                logger.info("DeviceDataCache > hit for %s %s '%s'", ipaddress, data_type, cmd)
+                return {'status': 'Success.', 'content': content}
+        result = fetch()
+        if result['status'] == 'Success.':
+            self.put(ipaddress, data_type, cmd, str(result['content']))
+        return result
+
+    def refresh(self, ipaddress: str, data_type: str, cmd: str, fetch: Callable[[], dict]) -> dict:
+        """Force a fetch and replace the cached content"""
+        return self.get_or_fetch(ipaddress, data_type, cmd, fetch, force_refresh=True)
+
+
+_device_data_cache: Optional[DeviceDataCache] = None
+_device_data_cache_lock = threading.Lock()
+
+
+def get_device_data_cache() -> DeviceDataCache:
+    """Process wide DeviceDataCache, built from settings on first use"""
+    global _device_data_cache
+    if _device_data_cache is None:
+        with _device_data_cache_lock:
+            if _device_data_cache is None:
+                _device_data_cache = DeviceDataCache(
+                    ttl=settings.get('DEVICE_DATA_CACHE_TTL', 300),
+                    max_entries=settings.get('DEVICE_DATA_CACHE_MAX_ENTRIES', 1024),
+                    shared=settings.get('DEVICE_DATA_CACHE_SHARED', False),
+                )
+    return _device_data_cache
@@ -0,0 +1,167 @@
+import os
+import bisect
+import logging
+import threading
+import time
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+from src.netbrain_service.config import settings
+from src.netbrain_service.application.mongo_models import DeviceInventoryEntry
+
+logger = logging.getLogger(__name__)
+
+# the devicename -> site path mapping used before the device_inventory
+# collection existed, served while the collection is still empty
+LEGACY_SITE_PATHS = {
+    'SAP1': 'My Network/USA/TEXAS/Westlake/Westlake Lab/ADRMTXAA7',
+    'NEC1': 'My Network/USA/TEXAS/Westlake/Westlake Lab/ICRSTXAA',
+    'NEC2': 'My Network/USA/TEXAS/Westlake/Westlake Lab/MRCRYTX',
+}
+
+
+@dataclass(frozen=True)
+class Device:
+    devicename: str
+    ipaddress: Optional[str]
+    site_path: str
+
+
+class DeviceInventory:
+    """
+    In-memory index of the device_inventory collection, resolving a
+    devicename or ip address to its NetBrain site path in O(1) and
+    answering prefix searches on devicename with a sorted name list.
+
+    The first lookup loads the whole collection. After that a background
+    thread refreshes the index every refresh_interval seconds, only reading
+    entries whose updated_datetime is at or after the newest one already
+    seen, so lookups never wait on Mongo. The thread belongs to the process
+    that started it and is started again after a fork.
+
+    While the collection holds no devices at all, lookups by name fall
+    back to LEGACY_SITE_PATHS (legacy_fallback), so deployments that
+    haven't loaded an inventory yet keep resolving the devices they
+    resolved before.
+    """
+
+    def __init__(self, refresh_interval: float, legacy_fallback: bool = True):
+        self.refresh_interval = refresh_interval
+        self.legacy_fallback = legacy_fallback
+        self._by_name: dict[str, Device] = {}
+        self._by_ip: dict[str, Device] = {}
+        self._sorted_names: list[str] = []
+        self._watermark: Optional[datetime] = None
+        self._refreshed_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._refresher: Optional[threading.Thread] = None
+        self._refresher_pid: Optional[int] = None
+
+    def refresh(self, full: bool = False) -> int:
+        """Apply new and changed entries to the index, returns how many were read"""
+        with self._refresh_lock:
+            query = {} if full or self._watermark is None else {'updated_datetime__gte': self._watermark}
+            entries = list(DeviceInventoryEntry.objects(**query).order_by('updated_datetime'))
+            with self._lock:
+                if full:
+                    self._by_name, self._by_ip, self._sorted_names = {}, {}, []
+                for entry in entries:
+                    self.__apply(entry)
+                if entries:
+                    self._watermark = entries[-1].updated_datetime
+                self._refreshed_at = time.monotonic()
+        logger.info("DeviceInventory.refresh > %s entries read, %s devices indexed", len(entries), len(self._by_name))
+        return len(entries)
+
+    def __apply(self, entry: DeviceInventoryEntry):
+        previous = self._by_name.pop(entry.devicename, None)
+        if previous:
+            if previous.ipaddress and self._by_ip.get(previous.ipaddress) is previous:
+                del self._by_ip[previous.ipaddress]
+            index = bisect.bisect_left(self._sorted_names, entry.devicename)
+            del self._sorted_names[index]
+        if not entry.active:
+            return
+        device = Device(entry.devicename, entry.ipaddress, entry.site_path)
+        self._by_name[device.devicename] = device
+        if device.ipaddress:
+            self._by_ip[device.ipaddress] = device
+        bisect.insort(self._sorted_names, device.devicename)
+
+    def __refresh_forever(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                # keep serving the index we have, retry on the next interval
+                logger.error("DeviceInventory.refresh > Error: '%s'", e)
+
+    def __ensure_refresher(self):
+        if self._refresher_pid == os.getpid() and self._refresher.is_alive():
+            return
+        with self._lock:
+            if self._refresher_pid == os.getpid() and self._refresher.is_alive():
+                return
+            self._refresher = threading.Thread(target=self.__refresh_forever, name='device-inventory-refresh',
+                                               daemon=True)
+            self._refresher.start()
+            self._refresher_pid = os.getpid()
+
+    def __ensure_fresh(self):
+        if self._refreshed_at is None:
+            # nothing to serve yet, the first lookup waits for the full load
+            self.refresh(full=True)
+        self.__ensure_refresher()
+
+    def __legacy(self, devicename: str) -> Optional[Device]:
+        if not self.legacy_fallback or self._by_name or devicename not in LEGACY_SITE_PATHS:
+            return None
+        return Device(devicename, None, LEGACY_SITE_PATHS[devicename])
+
+    def by_name(self, devicename: str) -> Optional[Device]:
+        self.__ensure_fresh()
+        return self._by_name.get(devicename) or self.__legacy(devicename)
+
+    def by_ip(self, ipaddress: str) -> Optional[Device]:
+        self.__ensure_fresh()
+        return self._by_ip.get(ipaddress)
+
+    def resolve(self, devicename: str, ipaddress: Optional[str] = None) -> Optional[Device]:
+        """the device by name, else by ip address, None when it isn't in the inventory"""
+        device = self.by_name(devicename)
+        if device is None and ipaddress:
+            device = self.by_ip(ipaddress)
+        return device
+
+    def search(self, prefix: str, limit: int = 50) -> list[Device]:
+        """devices whose name starts with prefix, in name order"""
+        self.__ensure_fresh()
+        with self._lock:
+            start = bisect.bisect_left(self._sorted_names, prefix)
+            names = []
+            for name in self._sorted_names[start:start + limit]:
+                if not name.startswith(prefix):
+                    break
+                names.append(name)
+            return [self._by_name[name] for name in names]
+
+
+_device_inventory: Optional[DeviceInventory] = None
+_device_inventory_lock = threading.Lock()
+
+
+def get_device_inventory() -> DeviceInventory:
+    """Process wide DeviceInventory, built from settings on first use"""
+    global _device_inventory
+    if _device_inventory is None:
+        with _device_inventory_lock:
+            if _device_inventory is None:
+                _device_inventory = DeviceInventory(
+                    refresh_interval=settings.get('DEVICE_INVENTORY_REFRESH_INTERVAL', 60),
+                    legacy_fallback=settings.get('DEVICE_INVENTORY_LEGACY_FALLBACK', True),
+                )
+    return _device_inventory
@@ -1,22 +1,73 @@
 import logging
+import threading
+
+from time import sleep
 from src.netbrain_service.application import command_consumers
+from src.netbrain_service.metrics import STAGE_LATENCY
+from src.netbrain_service.tracing import span
 
 logger = logging.getLogger(__name__)
 
 
 def process_event(payload):
+    """returns the create_event_entry result, including the tracking id of the in-flight entry"""
     logger.info("process_event > Start")
     event_consumer = EventConsumer()
-    event_consumer.register_event_received(payload)
-    event_consumer.generate_login_token()
-    event_consumer.translate_incoming_payload_to_benchmark_payload()
-    event_consumer.check_and_add_benchmark()
-    event_consumer.get_benchmark_status()
-    event_consumer.get_device_info()
-    event_consumer.process_device_content()
-    event_consumer.delete_benchmark()
-    event_consumer.logout_api()
+    with span('process_event'):
+        with STAGE_LATENCY.labels('register_event_received').time(), span('stage.register_event_received'):
+            result = event_consumer.register_event_received(payload)
+        process_pending(event_consumer)
     logger.info("process_event > end")
+    return result
+
+
+def process_events(payloads):
+    """batch counterpart of process_event, returns the create_event_entries result"""
+    logger.info("process_events > Start, %s payloads", len(payloads))
+    event_consumer = EventConsumer()
+    with span('process_events', payloads=len(payloads)):
+        with STAGE_LATENCY.labels('register_events_received').time(), span('stage.register_events_received'):
+            result = event_consumer.register_events_received(payloads)
+        process_pending(event_consumer)
+    logger.info("process_events > end")
+    return result
+
+
+def process_pending(event_consumer=None):
+    """
+    run every pipeline stage once over whatever is pending in each status,
+    finished benchmark tasks are deleted off this path by the BenchmarkReaper
+    """
+    event_consumer = event_consumer or EventConsumer()
+    # each stage is timed and traced under its own name
+    for stage in (event_consumer.generate_login_token,
+                  event_consumer.translate_incoming_payload_to_benchmark_payload,
+                  event_consumer.check_and_add_benchmark,
+                  event_consumer.get_benchmark_status,
+                  event_consumer.get_device_info,
+                  event_consumer.process_device_content,
+                  event_consumer.logout_api):
+        with STAGE_LATENCY.labels(stage.__name__).time(), span(f'stage.{stage.__name__}'):
+            stage()
+
+
+def start_pipeline_pump(interval: float) -> threading.Thread:
+    """
+    run process_pending every interval seconds on a daemon thread, so held
+    benchmark batches are flushed once their window closes even when no
+    new request arrives to drive the pipeline
+    """
+    def pump():
+        while True:
+            sleep(interval)
+            try:
+                process_pending()
+            except Exception as e:
+                logger.error("pipeline pump > Error: '%s'", e, exc_info=True)
+
+    thread = threading.Thread(target=pump, name='pipeline-pump', daemon=True)
+    thread.start()
+    return thread
 
 
 class EventConsumer:
@@ -35,6 +86,10 @@ class EventConsumer:
     def register_event_received(payload):
         return command_consumers.create_event_entry(payload)
 
+    @staticmethod
+    def register_events_received(payloads):
+        return command_consumers.create_event_entries(payloads)
+
     @staticmethod
     def translate_incoming_payload_to_benchmark_payload():
         return command_consumers.translate_incoming_payload_to_benchmark_payload()
@@ -55,9 +110,6 @@ class EventConsumer:
     def process_device_content():
         return command_consumers.process_device_content()
 
-    @staticmethod
-    def delete_benchmark():
-        return command_consumers.delete_benchmark()
 
 
 def get_creds():
@@ -1,19 +1,43 @@
-async def device_data_processed(event: events.GetDeviceDataProcessed) -> list[Message]:
-    cid = event.cid
-    messages: list[Message] = []
-
-    # send this to TestRequestOutbox!
-    if event.trid:
-        try:
-            TestRequestOutbox(
-                event_type = "",
-                trid = event.trid,
-                create_time = datetime.now(timezone.utc),
-            ).save()
-        except Exception as e:
-            logger.warning(f"{cid} TRID={event.trid} Attempt to save CampaignRunInitiated Event to TestRequestOutbox encountered Exception {str(e)}", exc_info=True)
-            messages.append(event)
-        else:
-            logger.info(f"{cid} TRID={event.trid} saved CampaignRunInitiated Event to TestRequestOutbox.")
-
-    return messages
+from __future__ import annotations
+
+import logging
+
+from datetime import datetime
+from datetime import timezone
+
+from src.netbrain_service.domain import events
+from src.netbrain_service.domain.common import Message
+from src.netbrain_service.adapters.odm import TestRequestOutbox
+
+logger = logging.getLogger(__name__)
+
+# Message fields that travel as columns of the outbox row, not in its payload
+OUTBOX_ENVELOPE_FIELDS = {'cid', 'trid', 'create_time', 'target_stage', 'trace_context'}
+
+
+def outbox_payload(event: Message) -> dict:
+    """the Event's own fields, what the OutboxRelay delivers to Stackstorm"""
+    return {field: value for field, value in vars(event).items() if field not in OUTBOX_ENVELOPE_FIELDS}
+
+
+async def device_data_processed(event: events.GetDeviceDataProcessed) -> list[Message]:
+    cid = event.cid
+    messages: list[Message] = []
+
+    # send this to TestRequestOutbox!
+    if event.trid:
+        try:
+            TestRequestOutbox(
+                event_type = type(event).__name__,
+                trid = event.trid,
+                cid = cid,
+                payload = outbox_payload(event),
+                create_time = datetime.now(timezone.utc),
+            ).save()
+        except Exception as e:
+            logger.warning("%s TRID=%s Attempt to save CampaignRunInitiated Event to TestRequestOutbox encountered Exception %s", cid, event.trid, e, exc_info=True)
+            messages.append(event)
+        else:
+            logger.info("%s TRID=%s saved CampaignRunInitiated Event to TestRequestOutbox.", cid, event.trid)
+
+    return messages
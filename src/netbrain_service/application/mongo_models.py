@@ -1,22 +1,41 @@
 
-from mongoengine import Document, DateTimeField, ListField, DictField, EmbeddedDocument, EmbeddedDocumentField, connect
-from mongoengine.fields import StringField, ObjectIdField
+from mongoengine import DateTimeField, ListField, DictField, EmbeddedDocument, EmbeddedDocumentField
+from mongoengine.fields import StringField, ObjectIdField, BooleanField, IntField
 
-# Connect to MongoDB
-connect(host='mongodb://localhost:27017/netbrain')
+from src.netbrain_service.adapters.odm import TunedDocument
 
+# the connection is registered by bootstrap.init_mongo() (MONGO_URI)
 
-class LoginToken(Document):
+
+class LoginToken(TunedDocument):
     meta = {
-        'collection': 'login_token'
+        'collection': 'login_token',
+        'write_concern': {'w': 'majority'},
     }
     token = StringField(required=True)
     datetime = DateTimeField(required=True)
 
 
-class IncomingPayload(Document):
+class IncomingPayload(TunedDocument):
+    """
+    in_flight stays True until the pipeline for this payload completes; the
+    unique partial index allows only one in-flight payload per
+    device/object, repeat alerts attach their cid to related_cids instead
+    """
     meta = {
-        'collection': 'incoming_payload'
+        'collection': 'incoming_payload',
+        # the in_flight dedupe index and the NEW -> TRANSLATING claim decide
+        # which request does the work, they must survive a failover
+        'write_concern': {'w': 'majority'},
+        'indexes': [
+            {
+                'fields': ['devicename', 'ipaddress', 'objectname'],
+                'unique': True,
+                'partialFilterExpression': {'in_flight': True},
+            },
+            # pipeline stages and StatusCountCollector select by status
+            ('status', 'created_datetime'),
+        ]
     }
     devicename = StringField(required=True)
     objectname = StringField(required=True)
@@ -24,6 +43,8 @@ class IncomingPayload(Document):
     cid = StringField(required=True)
     status = StringField(required=True)
     created_datetime = DateTimeField(required=True)
+    in_flight = BooleanField(default=True)
+    related_cids = ListField(StringField())
 
 
 class Schedule(EmbeddedDocument):
@@ -34,7 +55,9 @@ class Schedule(EmbeddedDocument):
 class DeviceScope(EmbeddedDocument):
     scopeType = StringField(required=True)
     scopes = ListField(StringField())
-    ipaddress = StringField(required=True)
+    # set when the scope covers a single device, ipaddresses lists every device
+    ipaddress = StringField()
+    ipaddresses = ListField(StringField())
 
 
 class Benchmark(EmbeddedDocument):
@@ -45,19 +68,27 @@ class Benchmark(EmbeddedDocument):
     cliCommands = ListField(StringField(), required=True)
 
 
-class BenchmarkPayload(Document):
+class BenchmarkPayload(TunedDocument):
     meta = {
-        'collection': 'benchmark_payload'
+        'collection': 'benchmark_payload',
+        # status transitions drive the pipeline
+        'write_concern': {'w': 'majority'},
+        'indexes': ['status'],
     }
     parent_id = ObjectIdField(required=True)
+    # every IncomingPayload covered by a group benchmark, parent_id is the first of them
+    parent_ids = ListField(ObjectIdField())
     benchmark_payload = EmbeddedDocumentField(Benchmark, required=True)
     status = StringField(required=True)
     created_datetime = DateTimeField(required=True)
 
 
-class TaskLog(Document):
+class TaskLog(TunedDocument):
     meta = {
-        'collection': 'task_log'
+        'collection': 'task_log',
+        # the PROCESS_CONTENT -> PARSING lease and the DELETE_TASK handoff are claims
+        'write_concern': {'w': 'majority'},
+        'indexes': ['status', 'task_name'],
     }
     parent_id = ObjectIdField(required=True)
     task_name = StringField(required=True)
@@ -65,3 +96,129 @@ class TaskLog(Document):
     content = StringField(required=True)
     status = StringField(required=True)
     created_datetime = DateTimeField(required=True)
+    # content came from the DeviceDataCache, no benchmark task exists on NetBrain
+    from_cache = BooleanField(default=False)
+    # when the result was ready, the benchmark task is deleted afterwards by
+    # the BenchmarkReaper, which then sets status COMPLETED
+    completed_datetime = DateTimeField()
+    # failed benchmark task deletes, retried from next_delete_datetime on
+    delete_attempts = IntField(default=0)
+    next_delete_datetime = DateTimeField()
+    # cids of every alert waiting on this device's result
+    cids = ListField(StringField())
+    # see application.output_changes, once parsed the full content is kept
+    # on the DeviceOutputSnapshot and only the diff to the previous
+    # collection stays here
+    content_hash = StringField()
+    content_diff = StringField()
+    # same content as the last parsed collection, whose ParsedRecords
+    # belong to parsed_task_log_id
+    unchanged = BooleanField(default=False)
+    parsed_task_log_id = ObjectIdField()
+    # when process_device_content claimed the task log (status PARSING)
+    parsing_datetime = DateTimeField()
+
+
+class DeviceDataCacheEntry(TunedDocument):
+    """shared tier of DeviceDataCache, removed by the TTL index once expires_at passes"""
+    meta = {
+        'collection': 'device_data_cache',
+        # a slightly stale cache read is fine, a lost write only costs a refetch
+        'write_concern': {'w': 1},
+        'read_preference': 'secondaryPreferred',
+        'indexes': [
+            {'fields': ['ipaddress', 'data_type', 'cmd'], 'unique': True},
+            {'fields': ['expires_at'], 'expireAfterSeconds': 0},
+        ]
+    }
+    ipaddress = StringField(required=True)
+    data_type = StringField(required=True)
+    cmd = StringField(required=True)
+    content = StringField(required=True)
+    expires_at = DateTimeField(required=True)
+
+
+class DeviceInventoryEntry(TunedDocument):
+    """
+    Devices NetBrain benchmarks can run against, loaded into memory by
+    DeviceInventory. Entries are deactivated rather than deleted, and
+    every change must bump updated_datetime so incremental refreshes
+    pick it up.
+    """
+    meta = {
+        'collection': 'device_inventory',
+        'indexes': [
+            {'fields': ['devicename'], 'unique': True},
+            'ipaddress',
+            'updated_datetime',
+        ]
+    }
+    devicename = StringField(required=True)
+    ipaddress = StringField()
+    # NetBrain site path used as the benchmark device scope
+    site_path = StringField(required=True)
+    active = BooleanField(default=True)
+    updated_datetime = DateTimeField(required=True)
+
+
+class ParsedRecord(TunedDocument):
+    """structured record parsed out of a TaskLog's device content, see application.content_parser"""
+    meta = {
+        'collection': 'parsed_record',
+        # rebuilt from the TaskLog content when lost
+        'write_concern': {'w': 1},
+        'indexes': [
+            # a record is written once however often its content is parsed
+            {'fields': ['task_log_id', 'template', 'seq'], 'unique': True},
+            ('ipaddress', 'cmd'),
+        ]
+    }
+    task_log_id = ObjectIdField(required=True)
+    ipaddress = StringField(required=True)
+    cmd = StringField(required=True)
+    # name of the ParserTemplate that produced the record
+    template = StringField(required=True)
+    # position of the record in the parsed content
+    seq = IntField(required=True)
+    record = DictField()
+    created_datetime = DateTimeField(required=True)
+
+
+class DeviceOutputSnapshot(TunedDocument):
+    """latest parsed content per device and CLI command, see application.output_changes"""
+    meta = {
+        'collection': 'device_output_snapshot',
+        'indexes': [
+            {'fields': ['ipaddress', 'cmd'], 'unique': True},
+        ]
+    }
+    ipaddress = StringField(required=True)
+    cmd = StringField(required=True)
+    content_hash = StringField(required=True)
+    content = StringField(required=True)
+    # task log whose ParsedRecords hold the parse of content
+    task_log_id = ObjectIdField(required=True)
+    updated_datetime = DateTimeField(required=True)
+
+
+class AlertResult(TunedDocument):
+    """
+    Outcome for each cid that asked for a device's data, written when the
+    TaskLog covering it has its result; group benchmarks and repeat alerts
+    share a TaskLog, this is where each of their cids finds it
+    """
+    meta = {
+        'collection': 'alert_result',
+        'indexes': [
+            {'fields': ['cid'], 'unique': True},
+            'task_log_id',
+        ]
+    }
+    cid = StringField(required=True)
+    # the IncomingPayload the cid was registered on
+    payload_id = ObjectIdField(required=True)
+    task_log_id = ObjectIdField(required=True)
+    task_name = StringField(required=True)
+    ipaddress = StringField(required=True)
+    status = StringField(required=True)
+    completed_datetime = DateTimeField(required=True)
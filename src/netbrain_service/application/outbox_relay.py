@@ -0,0 +1,164 @@
+import uuid
+import logging
+import threading
+
+from time import sleep
+
+from typing import Optional
+
+from datetime import datetime
+from datetime import timezone
+from datetime import timedelta
+
+from mongoengine import Q
+
+from src.netbrain_service.config import settings
+from src.netbrain_service.adapters.odm import TestRequestOutbox
+from src.netbrain_service.adapters.stackstorm import Stackstorm
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxRelay:
+    """
+    Delivers TestRequestOutbox rows to Stackstorm in the background.
+
+    Every cycle the relay will:
+        - pick up to batch_size PENDING rows whose next_attempt_time
+            has passed, oldest first, using the (status,
+            next_attempt_time) index, plus SENDING rows whose lease ran
+            out
+        - claim them in one conditional update: rows still eligible
+            become SENDING with this cycle's claim_token and a
+            claimed_until lease, so concurrent relays never deliver
+            the same row in the same lease
+        - deliver the rows it claimed concurrently on the Stackstorm
+            client's outbound worker pool
+        - mark delivered rows DELIVERED with one bulk update
+        - hand failed rows back as PENDING, bump attempts and push
+            their next_attempt_time out by the current backoff, also in
+            bulk; rows that reach max_attempts are marked FAILED and
+            left for manual review
+
+    A row is only marked DELIVERED after Stackstorm accepted it, so
+    delivery is at-least-once. The lease (OUTBOX_RELAY_LEASE seconds)
+    must outlast a batch of deliveries. While Stackstorm keeps failing the relay
+    backs off exponentially (capped at max_backoff seconds) rather than
+    hammering it; a fully successful batch resets the backoff, and a
+    full batch is followed immediately by the next one.
+    """
+
+    def __init__(
+            self,
+            stackstorm: Optional[Stackstorm] = None,
+            batch_size: Optional[int] = None,
+            poll_interval: Optional[float] = None,
+            max_attempts: Optional[int] = None,
+            max_backoff: Optional[float] = None,
+    ):
+        self.stackstorm = stackstorm or Stackstorm()
+        self.batch_size = batch_size or settings.get('OUTBOX_RELAY_BATCH_SIZE', 100)
+        self.poll_interval = poll_interval or settings.get('OUTBOX_RELAY_POLL_INTERVAL', 5)
+        self.max_attempts = max_attempts or settings.get('OUTBOX_RELAY_MAX_ATTEMPTS', 10)
+        self.max_backoff = max_backoff or settings.get('OUTBOX_RELAY_MAX_BACKOFF', 300)
+        self.lease = settings.get('OUTBOX_RELAY_LEASE', 300)
+        self._consecutive_failures = 0
+        self._running = False
+
+    def current_backoff(self) -> float:
+        if not self._consecutive_failures:
+            return self.poll_interval
+        return min(self.max_backoff, self.poll_interval * (2 ** self._consecutive_failures))
+
+    def __deliver(self, entry: TestRequestOutbox) -> bool:
+        try:
+            return self.stackstorm.send_outbox_entry(
+                cid=entry.cid,
+                trid=entry.trid,
+                event_type=entry.event_type,
+                payload=entry.payload or {},
+            )
+        except Exception as e:
+            logger.error("%s TRID=%s Exception delivering outbox entry %s", entry.cid, entry.trid, entry.id, exc_info=True)
+            return False
+
+    def relay_batch(self) -> int:
+        """
+        Run a single relay cycle, returns the number of rows read so the
+        caller can tell a full batch from an empty outbox.
+        """
+        now = datetime.now(timezone.utc)
+        eligible = Q(status='PENDING', next_attempt_time__lte=now) | Q(status='SENDING', claimed_until__lt=now)
+        candidate_ids = [
+            entry.id for entry in
+            TestRequestOutbox.objects(eligible).only('id').order_by('next_attempt_time').limit(self.batch_size)
+        ]
+        if not candidate_ids:
+            return 0
+        # rows another relay claimed since they were read are left out
+        token = uuid.uuid4().hex
+        TestRequestOutbox.objects(Q(id__in=candidate_ids) & eligible).update(
+            set__status='SENDING',
+            set__claim_token=token,
+            set__claimed_until=now + timedelta(seconds=self.lease),
+        )
+        entries = list(TestRequestOutbox.objects(claim_token=token, status='SENDING'))
+        if not entries:
+            return len(candidate_ids)
+
+        futures = [self.stackstorm.enqueue(self.__deliver, entry) for entry in entries]
+        results = [future.result() for future in futures]
+
+        delivered_ids = [entry.id for entry, sent in zip(entries, results) if sent]
+        failed_ids = [entry.id for entry, sent in zip(entries, results) if not sent]
+
+        # filtered on the claim, a row reclaimed after this lease ran out belongs to its new claimer
+        if delivered_ids:
+            TestRequestOutbox.objects(id__in=delivered_ids, claim_token=token).update(
+                set__status='DELIVERED',
+                set__delivered_time=datetime.now(timezone.utc),
+                unset__claimed_until=True,
+            )
+        if failed_ids:
+            self._consecutive_failures += 1
+            retry_time = datetime.now(timezone.utc) + timedelta(seconds=self.current_backoff())
+            TestRequestOutbox.objects(id__in=failed_ids, claim_token=token).update(
+                set__status='PENDING',
+                inc__attempts=1,
+                set__next_attempt_time=retry_time,
+                set__last_error='Stackstorm delivery failed',
+                unset__claimed_until=True,
+            )
+            TestRequestOutbox.objects(id__in=failed_ids, claim_token=token, attempts__gte=self.max_attempts).update(
+                set__status='FAILED',
+            )
+        else:
+            self._consecutive_failures = 0
+
+        logger.info("OutboxRelay delivered %s and failed %s of %s outbox entries",
+                    len(delivered_ids), len(failed_ids), len(entries))
+        return len(entries)
+
+    def run(self):
+        """Relay until stop() is called"""
+        self._running = True
+        logger.info("OutboxRelay started, batch_size %s", self.batch_size)
+        while self._running:
+            try:
+                read = self.relay_batch()
+            except Exception as e:
+                # most likely Mongo is unavailable, treat it like a downstream failure
+                self._consecutive_failures += 1
+                logger.error("OutboxRelay cycle failed, backing off %s seconds", self.current_backoff(), exc_info=True)
+                read = 0
+            if read < self.batch_size or self._consecutive_failures:
+                sleep(self.current_backoff())
+
+    def start(self) -> threading.Thread:
+        """Run the relay on a daemon thread"""
+        thread = threading.Thread(target=self.run, name='outbox-relay', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._running = False
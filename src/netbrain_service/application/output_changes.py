@@ -0,0 +1,109 @@
+import difflib
+import hashlib
+import logging
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+from bson import ObjectId
+
+from src.netbrain_service.config import settings
+from src.netbrain_service.application.mongo_models import DeviceOutputSnapshot
+from src.netbrain_service.application.mongo_models import TaskLog
+
+"""
+Change detection for device content collected again for the same device.
+
+Every parsed content is hashed and kept as the DeviceOutputSnapshot of its
+(ipaddress, cmd). When the next collection hashes the same, the parse is
+skipped and the task log points at the task log whose ParsedRecords
+already hold the result (parsed_task_log_id). When it differs, the content
+is parsed as usual and a compact unified diff to the previous snapshot is
+kept on the task log.
+
+Either way, once the content is parsed (or found unchanged) it is cleared
+from the task log, the snapshot keeps the one full copy per device and
+command. OUTPUT_CHANGE_DETECTION = false turns all of this off.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class OutputChange:
+    content_hash: str
+    changed: bool
+    # unified diff to the previous snapshot, None for a first collection or
+    # outputs longer than OUTPUT_DIFF_MAX_LINES
+    diff: Optional[str] = None
+    # set when unchanged, the task log holding the ParsedRecords
+    parsed_task_log_id: Optional[ObjectId] = None
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+def compact_diff(previous: str, content: str) -> Optional[str]:
+    """changed lines only, no context, None when either side is too long to diff cheaply"""
+    max_lines = settings.get('OUTPUT_DIFF_MAX_LINES', 10000)
+    previous_lines = previous.splitlines()
+    lines = content.splitlines()
+    if len(previous_lines) > max_lines or len(lines) > max_lines:
+        return None
+    return '\n'.join(difflib.unified_diff(previous_lines, lines, n=0, lineterm=''))
+
+
+def detect_output_changes(task_logs: list, cmd: str) -> dict:
+    """task log id -> OutputChange against the current snapshots, read in one query"""
+    if not settings.get('OUTPUT_CHANGE_DETECTION', True):
+        return {task_log.id: OutputChange(content_hash='', changed=True) for task_log in task_logs}
+
+    snapshots = {
+        snapshot.ipaddress: snapshot
+        for snapshot in DeviceOutputSnapshot.objects(ipaddress__in=list({task_log.ipaddress for task_log in task_logs}),
+                                                     cmd=cmd)
+    }
+    changes = {}
+    for task_log in task_logs:
+        content = task_log.content or ''
+        digest = content_hash(content)
+        snapshot = snapshots.get(task_log.ipaddress)
+        if snapshot is None:
+            changes[task_log.id] = OutputChange(content_hash=digest, changed=True)
+        elif snapshot.content_hash == digest:
+            changes[task_log.id] = OutputChange(content_hash=digest, changed=False,
+                                                parsed_task_log_id=snapshot.task_log_id)
+        else:
+            changes[task_log.id] = OutputChange(content_hash=digest, changed=True,
+                                                diff=compact_diff(snapshot.content, content))
+    unchanged = sum(1 for change in changes.values() if not change.changed)
+    logger.info("detect_output_changes > %s of %s outputs unchanged", unchanged, len(changes))
+    return changes
+
+
+def record_output_changes(task_logs: list, changes: dict, cmd: str):
+    """
+    For task logs done with their content: move changed content onto the
+    snapshots and leave the hash, diff or unchanged marker on the task logs.
+    """
+    if not settings.get('OUTPUT_CHANGE_DETECTION', True):
+        return
+
+    now = datetime.utcnow()
+    for task_log in task_logs:
+        change = changes[task_log.id]
+        if change.changed:
+            DeviceOutputSnapshot.objects(ipaddress=task_log.ipaddress, cmd=cmd).update_one(
+                upsert=True,
+                set__content_hash=change.content_hash,
+                set__content=task_log.content or '',
+                set__task_log_id=task_log.id,
+                set__updated_datetime=now)
+            TaskLog.objects(id=task_log.id).update_one(
+                set__content='', set__content_hash=change.content_hash, set__content_diff=change.diff)
+        else:
+            TaskLog.objects(id=task_log.id).update_one(
+                set__content='', set__content_hash=change.content_hash, set__unchanged=True,
+                set__parsed_task_log_id=change.parsed_task_log_id)
@@ -1,8 +1,18 @@
 import requests
 
+from src.netbrain_service.metrics import observe_outbound
+from src.netbrain_service.tracing import traced
+from src.netbrain_service.config import settings
 
+# NetBrain server, override with NETBRAIN_HOST (ex. a local stand-in for benchmarks)
+NETBRAIN_HOST = settings.get('NETBRAIN_HOST', 'http://10.139.225.12')
+API_URL = f"{NETBRAIN_HOST}/ServicesAPI/API/V1"
+
+
+@observe_outbound('netbrain', 'login_to_netbrain')
+@traced('netbrain.login_to_netbrain')
 def login_to_netbrain(username: str, password: str):
-    url = "http://10.139.225.12/ServicesAPI/API/V1/Session"
+    url = f"{API_URL}/Session"
 
     headers = {"Content-Type": "application/json"}
 
@@ -31,8 +41,10 @@ def login_to_netbrain(username: str, password: str):
     return result
 
 
+@observe_outbound('netbrain', 'logout_from_netbrain')
+@traced('netbrain.logout_from_netbrain')
 def logout_from_netbrain(token: str):
-    url = "http://10.139.225.12/v1/session"
+    url = f"{NETBRAIN_HOST}/v1/session"
 
     headers = {
         "Content-Type": "application/json",
@@ -51,8 +63,10 @@ def logout_from_netbrain(token: str):
     return status
 
 
+@observe_outbound('netbrain', 'add_benchmark')
+@traced('netbrain.add_benchmark')
 def add_benchmark(token, benchmark_payload_dict):
-    url = "http://10.139.225.12/ServicesAPI/API/V1/CMDB/Benchmark/Tasks"
+    url = f"{API_URL}/CMDB/Benchmark/Tasks"
 
     headers = {
         "Content-Type": "application/json",
@@ -77,8 +91,10 @@ def add_benchmark(token, benchmark_payload_dict):
     return status
 
 
+@observe_outbound('netbrain', 'check_task_status')
+@traced('netbrain.check_task_status')
 def check_task_status(token, task_name):
-    url = f"http://10.139.225.12/ServicesAPI/API/V1/CMDB/Benchmark/Tasks/{task_name}/Status"
+    url = f"{API_URL}/CMDB/Benchmark/Tasks/{task_name}/Status"
 
     headers = {
         "Content-Type": "application/json",
@@ -100,8 +116,10 @@ def check_task_status(token, task_name):
     return status
 
 
-def get_device_info(token, ipaddress):
-    url = f"http://10.139.225.12/ServicesAPI/API/V1/CMDB/Devices/DeviceRawData"
+@observe_outbound('netbrain', 'get_device_info')
+@traced('netbrain.get_device_info')
+def get_device_info(token, ipaddress, data_type="2", cmd="sh controllers tenGigE0/0/0/0  phy"):
+    url = f"{API_URL}/CMDB/Devices/DeviceRawData"
 
     headers = {
         "Content-Type": "application/json",
@@ -110,8 +128,8 @@ def get_device_info(token, ipaddress):
 
     query_params = {
         "IP": ipaddress,
-        "dataType": "2",
-        "cmd": "sh controllers tenGigE0/0/0/0  phy"
+        "dataType": data_type,
+        "cmd": cmd
     }
 
     response = requests.get(url, headers=headers, params=query_params)
@@ -130,8 +148,38 @@ def get_device_info(token, ipaddress):
     return {"status": status, 'content': content}
 
 
+@observe_outbound('netbrain', 'list_tasks')
+@traced('netbrain.list_tasks')
+def list_tasks(token):
+    """names of the benchmark tasks defined on NetBrain"""
+    url = f"{API_URL}/CMDB/Benchmark/Tasks"
+
+    headers = {
+        "Content-Type": "application/json",
+        "token": token
+    }
+
+    response = requests.get(url, headers=headers)
+
+    tasks = []
+    if response.status_code == 200:
+        try:
+            response_json = response.json()
+            status = response_json["statusDescription"]  # expecting 'Success.' as response
+            tasks = [task['taskName'] if isinstance(task, dict) else task for task in response_json.get('tasks', [])]
+        except Exception as e:
+            """capture if any other error"""
+            status = f"Failed to list benchmark tasks. Error: {str(e)}"
+    else:
+        status = f"Failed to list benchmark tasks. Status code: {response.status_code}, Message: {response.text}"
+
+    return {'status': status, 'tasks': tasks}
+
+
+@observe_outbound('netbrain', 'delete_task')
+@traced('netbrain.delete_task')
 def delete_task(token, task_name):
-    url = f"http://10.139.225.12/ServicesAPI/API/V1/CMDB/Benchmark/Tasks/{task_name}"
+    url = f"{API_URL}/CMDB/Benchmark/Tasks/{task_name}"
 
     headers = {
         "Content-Type": "application/json",
@@ -16,11 +16,15 @@ def check_task_status(token, task_name):
     return 'Success.'
 
 
-def get_device_info(token, ipaddress):
+def get_device_info(token, ipaddress, data_type="2", cmd="sh controllers tenGigE0/0/0/0  phy"):
     content = 'some random content to test'
     status = 'Success.'
     return {"status": status, 'content': content}
 
 
+def list_tasks(token):
+    return {'status': 'Success.', 'tasks': []}
+
+
 def delete_task(token, task_name):
     return 'Success.'
@@ -0,0 +1,216 @@
+"""
+Local stand-in for the NetBrain REST API, answering the endpoints used by
+application/requests_consumer with configurable latency, error rate and
+benchmark task completion delay. Used by pipeline_benchmark, can also be
+run on its own:
+
+    python -m src.netbrain_service.benchmarks.fake_netbrain --port 8089 --latency-ms 50
+"""
+
+import json
+import time
+import random
+import threading
+
+from dataclasses import dataclass
+from dataclasses import field
+
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+from urllib.parse import urlparse
+from urllib.parse import parse_qs
+from urllib.parse import unquote
+
+API_PREFIX = '/servicesapi/api/v1'
+
+
+@dataclass
+class FakeNetbrainConfig:
+    # mean response latency in milliseconds, and how it is distributed:
+    # 'fixed', 'uniform' (0 to 2x mean) or 'lognormal' (long tail)
+    latency_ms: float = 20.0
+    latency_dist: str = 'lognormal'
+    # fraction of requests answered with a 500
+    error_rate: float = 0.0
+    # seconds after creation before a benchmark task reports Success.
+    completion_delay: float = 1.0
+    # lines of CLI output returned by DeviceRawData
+    content_lines: int = 200
+
+
+@dataclass
+class FakeNetbrainStats:
+    requests: int = 0
+    errors: int = 0
+    by_endpoint: dict = field(default_factory=dict)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def record(self, endpoint: str, error: bool):
+        with self.lock:
+            self.requests += 1
+            self.errors += int(error)
+            self.by_endpoint[endpoint] = self.by_endpoint.get(endpoint, 0) + 1
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            return {'requests': self.requests, 'errors': self.errors, 'by_endpoint': dict(self.by_endpoint)}
+
+
+class FakeNetbrain:
+    """
+    Threaded HTTP server holding the benchmark tasks it has been sent.
+
+    Example:
+
+        fake = FakeNetbrain(FakeNetbrainConfig(latency_ms=50, completion_delay=2))
+        fake.start()
+        ... point NETBRAIN_HOST at fake.url ...
+        fake.stop()
+    """
+
+    def __init__(self, config: FakeNetbrainConfig, host: str = '127.0.0.1', port: int = 0):
+        self.config = config
+        self.stats = FakeNetbrainStats()
+        self.tasks: dict[str, float] = {}
+        self.tasks_lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self.__handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fake-netbrain', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def sample_latency(self) -> float:
+        mean = self.config.latency_ms / 1000
+        if self.config.latency_dist == 'fixed':
+            return mean
+        if self.config.latency_dist == 'uniform':
+            return random.uniform(0, 2 * mean)
+        # lognormal with sigma 1 has mean exp(mu + 0.5), solve mu for the configured mean
+        return random.lognormvariate(0, 1) * mean / 1.6487 if mean else 0.0
+
+    def device_content(self, ip: str, cmd: str) -> str:
+        lines = [f"{ip}# {cmd}"]
+        for i in range(self.config.content_lines):
+            lines.append(f"TenGigE0/0/0/{i % 48} is up, line protocol is up, rx_errors {random.randint(0, 5)}")
+        return "\n".join(lines)
+
+    def __handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                # keep benchmark output clean
+                pass
+
+            def __respond(self, endpoint: str, status: int, body: dict):
+                time.sleep(fake.sample_latency())
+                error = random.random() < fake.config.error_rate
+                if error:
+                    status, body = 500, {'statusDescription': 'Injected error.'}
+                fake.stats.record(endpoint, error or status >= 400)
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def __body(self) -> dict:
+                length = int(self.headers.get('Content-Length') or 0)
+                return json.loads(self.rfile.read(length) or b'{}')
+
+            def __path(self) -> tuple[str, dict]:
+                parsed = urlparse(self.path)
+                return unquote(parsed.path).lower(), parse_qs(parsed.query)
+
+            def __task_name(self, path: str) -> str:
+                # task names keep their case in the raw path
+                raw = unquote(urlparse(self.path).path)
+                return raw[len(f'{API_PREFIX}/cmdb/benchmark/tasks/'):].split('/')[0]
+
+            def do_POST(self):
+                path, query = self.__path()
+                if path == f'{API_PREFIX}/session':
+                    self.__body()
+                    self.__respond('login', 200, {'token': f'fake-{random.getrandbits(64):x}', 'statusDescription': 'Success.'})
+                elif path == f'{API_PREFIX}/cmdb/benchmark/tasks':
+                    body = self.__body()
+                    with fake.tasks_lock:
+                        fake.tasks[body.get('taskName', '')] = time.monotonic()
+                    self.__respond('add_benchmark', 200, {'statusDescription': 'Success.'})
+                else:
+                    self.__respond('unknown', 404, {'statusDescription': 'Not found.'})
+
+            def do_GET(self):
+                path, query = self.__path()
+                if path == f'{API_PREFIX}/cmdb/benchmark/tasks':
+                    with fake.tasks_lock:
+                        tasks = [{'taskName': task_name} for task_name in fake.tasks]
+                    self.__respond('list_tasks', 200, {'tasks': tasks, 'statusDescription': 'Success.'})
+                elif path.startswith(f'{API_PREFIX}/cmdb/benchmark/tasks/') and path.endswith('/status'):
+                    with fake.tasks_lock:
+                        created = fake.tasks.get(self.__task_name(path))
+                    if created is None:
+                        self.__respond('task_status', 200, {'statusDescription': 'Task not found.'})
+                    elif time.monotonic() - created < fake.config.completion_delay:
+                        self.__respond('task_status', 200, {'statusDescription': 'Running.'})
+                    else:
+                        self.__respond('task_status', 200, {'statusDescription': 'Success.'})
+                elif path == f'{API_PREFIX}/cmdb/devices/devicerawdata':
+                    ip = query.get('IP', [''])[0]
+                    cmd = query.get('cmd', [''])[0]
+                    self.__respond('device_raw_data', 200, {'content': fake.device_content(ip, cmd), 'statusDescription': 'Success.'})
+                else:
+                    self.__respond('unknown', 404, {'statusDescription': 'Not found.'})
+
+            def do_DELETE(self):
+                path, query = self.__path()
+                if path in (f'{API_PREFIX}/session', '/v1/session'):
+                    self.__respond('logout', 200, {'statusDescription': 'Success.'})
+                elif path.startswith(f'{API_PREFIX}/cmdb/benchmark/tasks/'):
+                    with fake.tasks_lock:
+                        fake.tasks.pop(self.__task_name(path), None)
+                    self.__respond('delete_task', 200, {'statusDescription': 'Success.'})
+                else:
+                    self.__respond('unknown', 404, {'statusDescription': 'Not found.'})
+
+        return Handler
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Local NetBrain stand-in')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency-ms', type=float, default=20.0)
+    parser.add_argument('--latency-dist', choices=['fixed', 'uniform', 'lognormal'], default='lognormal')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--completion-delay', type=float, default=1.0)
+    args = parser.parse_args()
+
+    fake_netbrain = FakeNetbrain(
+        FakeNetbrainConfig(
+            latency_ms=args.latency_ms,
+            latency_dist=args.latency_dist,
+            error_rate=args.error_rate,
+            completion_delay=args.completion_delay,
+        ),
+        host=args.host,
+        port=args.port,
+    )
+    print(f"fake NetBrain listening on {fake_netbrain.url}")
+    fake_netbrain.server.serve_forever()
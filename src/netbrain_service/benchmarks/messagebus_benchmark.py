@@ -0,0 +1,247 @@
+"""
+MessageBus micro-benchmarks and load generator.
+
+Drives synthetic Commands (and the Events they fan out to) through a real
+MessageBus with stub consumers and reports, for every consumer thread count:
+
+    locked      - every Command has field_locks on a unique key, so the only
+                  cost over 'unlocked' is lock bookkeeping (lock_overhead_us)
+    unlocked    - same workload with no field_locks
+    contention  - --collision-rate of the Commands lock one of --hot-keys
+                  shared keys, colliding Commands are discarded by the bus
+
+Each scenario reports dispatch throughput (consumer invocations per
+second), queue wait p50/p99 (queued to consumer start) and, for
+contention, how many Commands were discarded on lock conflicts.
+
+    python -m src.netbrain_service.benchmarks.messagebus_benchmark --messages 2000 --threads 1,4,8 --fanout 2
+
+Used as a regression gate by saving a baseline and comparing later runs
+against it, the exit code is 1 when any scenario's throughput drops more
+than --tolerance below the baseline:
+
+    python -m src.netbrain_service.benchmarks.messagebus_benchmark --save-baseline mb_baseline.json
+    python -m src.netbrain_service.benchmarks.messagebus_benchmark --baseline mb_baseline.json --tolerance 0.2
+"""
+
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import threading
+
+from dataclasses import dataclass
+from dataclasses import field
+
+from datetime import datetime
+from datetime import timezone
+
+from statistics import quantiles
+
+from src.netbrain_service.config import settings
+from src.netbrain_service.domain.common import get_cid
+
+logger = logging.getLogger(__name__)
+
+# MessageBus.startup builds a (lazy) Wsgw client, none of the stub
+# consumers call it so placeholder settings are enough
+WSGW_PLACEHOLDER_SETTINGS = {
+    'WSGW_API': 'http://127.0.0.1:9/',
+    'SYS_UN': 'benchmark',
+    'SYS_PW': 'benchmark',
+    'WSGW_DOMAIN': 'benchmark',
+    'DEBUG': False,
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='MessageBus micro-benchmarks')
+    parser.add_argument('--messages', type=int, default=1000, help='Commands submitted per scenario')
+    parser.add_argument('--threads', default='1,4,8', help='comma separated MessageBus consumer counts')
+    parser.add_argument('--consumer-latency-ms', type=float, default=1.0, help='time each stub consumer takes')
+    parser.add_argument('--blocking', action='store_true', help='stub consumers block with time.sleep instead of awaiting')
+    parser.add_argument('--collision-rate', type=float, default=0.25, help='fraction of contention Commands on a hot key')
+    parser.add_argument('--hot-keys', type=int, default=4, help='number of shared keys in the contention scenario')
+    parser.add_argument('--fanout', type=int, default=0, help='Event consumers run for every consumed Command')
+    parser.add_argument('--baseline', help='json report to compare throughput against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed fractional throughput drop vs baseline')
+    parser.add_argument('--save-baseline', help='write the report to this path')
+    return parser.parse_args(argv)
+
+
+def build_message_types(messagebus):
+    """
+    Benchmark Messages subclass the Command and Event classes the
+    MessageBus checks against, imported through it so isinstance holds.
+    """
+
+    @dataclass
+    class BenchCommand(messagebus.Command):
+        key: str
+        cid: str
+        create_time: datetime
+        enqueued_at: float = field(default_factory=time.perf_counter)
+
+        field_locks = ["key"]
+
+    @dataclass
+    class BenchUnlockedCommand(messagebus.Command):
+        key: str
+        cid: str
+        create_time: datetime
+        enqueued_at: float = field(default_factory=time.perf_counter)
+
+    @dataclass
+    class BenchEvent(messagebus.Event):
+        cid: str
+        create_time: datetime
+        enqueued_at: float = field(default_factory=time.perf_counter)
+
+    return BenchCommand, BenchUnlockedCommand, BenchEvent
+
+
+class StubConsumers:
+    """consumer callables for the MessageBus, recording what they were handed"""
+
+    def __init__(self, event_type, latency: float, blocking: bool, fanout: bool):
+        self.event_type = event_type
+        self.latency = latency
+        self.blocking = blocking
+        self.fanout = fanout
+        self.queue_waits: list[float] = []
+        self.commands_consumed = 0
+        self.events_consumed = 0
+        # consumers run on every MessageBus thread
+        self.lock = threading.Lock()
+
+    async def __work(self, message):
+        self.queue_waits.append(time.perf_counter() - message.enqueued_at)
+        if self.blocking:
+            time.sleep(self.latency)
+        elif self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def command_consumer(self, command, wsgw):
+        await self.__work(command)
+        with self.lock:
+            self.commands_consumed += 1
+        if self.fanout:
+            return [self.event_type(cid=command.cid, create_time=datetime.now(timezone.utc))]
+        return []
+
+    async def event_consumer(self, event):
+        await self.__work(event)
+        with self.lock:
+            self.events_consumed += 1
+        return []
+
+
+def percentile(values: list, n: int):
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0]
+    return quantiles(values, n=100, method='inclusive')[n - 1]
+
+
+def run_scenario(args, messagebus, scenario: str, consumer_count: int) -> dict:
+    bench_command, bench_unlocked_command, bench_event = build_message_types(messagebus)
+    stubs = StubConsumers(bench_event, args.consumer_latency_ms / 1000, args.blocking, args.fanout > 0)
+    command_type = bench_unlocked_command if scenario == 'unlocked' else bench_command
+    bus = messagebus.MessageBus(
+        command_consumers={command_type: stubs.command_consumer},
+        event_consumers={bench_event: [stubs.event_consumer] * args.fanout},
+        consumer_count=consumer_count,
+    )
+
+    def key(n: int) -> str:
+        if scenario == 'contention' and random.random() < args.collision_rate:
+            return f"hot-{random.randrange(args.hot_keys)}"
+        return f"key-{n}"
+
+    commands = [command_type(key=key(n), cid=get_cid(), create_time=datetime.now(timezone.utc))
+                for n in range(args.messages)]
+    started = time.perf_counter()
+    for command in commands:
+        command.enqueued_at = time.perf_counter()
+        bus.add_to_queue([command])
+    bus.message_q.join()
+    elapsed = time.perf_counter() - started
+
+    dispatched = stubs.commands_consumed + stubs.events_consumed
+    return {
+        'scenario': scenario,
+        'threads': consumer_count,
+        'commands_submitted': args.messages,
+        'commands_consumed': stubs.commands_consumed,
+        'events_consumed': stubs.events_consumed,
+        # Commands the bus discarded because their field_locks were held
+        'lock_conflicts': args.messages - stubs.commands_consumed,
+        'elapsed_seconds': round(elapsed, 4),
+        'throughput_per_second': round(dispatched / elapsed, 2) if elapsed else None,
+        'queue_wait_p50_ms': round(percentile(stubs.queue_waits, 50) * 1000, 3) if stubs.queue_waits else None,
+        'queue_wait_p99_ms': round(percentile(stubs.queue_waits, 99) * 1000, 3) if stubs.queue_waits else None,
+    }
+
+
+def compare_to_baseline(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    """names of scenarios whose throughput dropped more than tolerance below the baseline"""
+    previous = {(r['scenario'], r['threads']): r['throughput_per_second'] for r in baseline.get('results', [])}
+    regressions = []
+    for result in report['results']:
+        before = previous.get((result['scenario'], result['threads']))
+        if before and result['throughput_per_second'] < before * (1 - tolerance):
+            regressions.append(
+                f"{result['scenario']}@{result['threads']}: {result['throughput_per_second']}/s vs baseline {before}/s")
+    return regressions
+
+
+def run(args) -> dict:
+    for name, value in WSGW_PLACEHOLDER_SETTINGS.items():
+        if settings.get(name) is None:
+            settings.set(name, value)
+
+    # imported after the settings above are in place
+    from src.netbrain_service.application import messagebus
+
+    results = []
+    lock_overhead = {}
+    for consumer_count in [int(threads) for threads in args.threads.split(',')]:
+        by_scenario = {}
+        for scenario in ('unlocked', 'locked', 'contention'):
+            by_scenario[scenario] = run_scenario(args, messagebus, scenario, consumer_count)
+            results.append(by_scenario[scenario])
+        # both ran the same number of Commands with no conflicts
+        lock_overhead[consumer_count] = round(
+            (by_scenario['locked']['elapsed_seconds'] - by_scenario['unlocked']['elapsed_seconds'])
+            / args.messages * 1e6, 3)
+
+    return {
+        'results': results,
+        'lock_overhead_us': lock_overhead,
+        'config': vars(args),
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare_to_baseline(report, json.load(baseline_file), args.tolerance)
+        report['regressions'] = regressions
+        status = 1 if regressions else 0
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,209 @@
+"""
+Offline end-to-end benchmark of process_event.
+
+Starts the local NetBrain stand-in, points requests_consumer at it, submits
+payloads at a fixed rate through process_event and then drains the pipeline
+with process_pending() until every TaskLog has its result (or --timeout hits).
+Benchmark tasks are deleted by a BenchmarkReaper running alongside, the
+report counts the tasks it hasn't deleted yet when the results are in.
+Prints one JSON report with throughput, end-to-end p50/p99 (IncomingPayload
+created to TaskLog completed_datetime) and time spent in each pipeline stage.
+
+    python -m src.netbrain_service.benchmarks.pipeline_benchmark --events 200 --rate 20 --latency-ms 50
+
+Runs against a throwaway database, by default mongodb://localhost:27017/netbrain_benchmark.
+--mongomock runs without a Mongo server, but mongomock does not honor the
+partial unique indexes, so dedupe behavior is only exercised on a real
+MongoDB.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+
+from statistics import quantiles
+
+from datetime import datetime
+
+from concurrent.futures import ThreadPoolExecutor
+
+from src.netbrain_service.benchmarks.fake_netbrain import FakeNetbrain
+from src.netbrain_service.benchmarks.fake_netbrain import FakeNetbrainConfig
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Offline process_event benchmark')
+    parser.add_argument('--events', type=int, default=100, help='payloads to submit')
+    parser.add_argument('--rate', type=float, default=10.0, help='payloads submitted per second')
+    parser.add_argument('--ingest-threads', type=int, default=4, help='concurrent process_event callers')
+    parser.add_argument('--timeout', type=float, default=300.0, help='seconds to wait for the pipeline to drain')
+    parser.add_argument('--latency-ms', type=float, default=20.0)
+    parser.add_argument('--latency-dist', choices=['fixed', 'uniform', 'lognormal'], default='lognormal')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--completion-delay', type=float, default=1.0)
+    parser.add_argument('--mongo-uri', default='mongodb://localhost:27017/netbrain_benchmark')
+    parser.add_argument('--mongomock', action='store_true', help='use an in-memory mongomock client')
+    parser.add_argument('--parse-processes', type=int, default=0, help='content parser pool size, 0 parses in-process')
+    return parser.parse_args(argv)
+
+
+def stage_totals() -> dict:
+    """current per stage count and sum of the STAGE_LATENCY histogram"""
+    from src.netbrain_service.metrics import STAGE_LATENCY
+
+    totals: dict = {}
+    for metric in STAGE_LATENCY.collect():
+        for sample in metric.samples:
+            stage = sample.labels.get('stage')
+            if sample.name.endswith('_count'):
+                totals.setdefault(stage, {})['count'] = sample.value
+            elif sample.name.endswith('_sum'):
+                totals.setdefault(stage, {})['total'] = sample.value
+    return totals
+
+
+def stage_report(before: dict, after: dict) -> dict:
+    report = {}
+    for stage, values in after.items():
+        count = values.get('count', 0) - before.get(stage, {}).get('count', 0)
+        total = values.get('total', 0) - before.get(stage, {}).get('total', 0)
+        if count:
+            report[stage] = {'count': int(count), 'mean_seconds': round(total / count, 6), 'total_seconds': round(total, 4)}
+    return report
+
+
+def percentile_report(latencies: list) -> dict:
+    if not latencies:
+        return {'p50_seconds': None, 'p99_seconds': None, 'max_seconds': None}
+    if len(latencies) == 1:
+        return {'p50_seconds': latencies[0], 'p99_seconds': latencies[0], 'max_seconds': latencies[0]}
+    cuts = quantiles(latencies, n=100, method='inclusive')
+    return {'p50_seconds': round(cuts[49], 4), 'p99_seconds': round(cuts[98], 4), 'max_seconds': round(max(latencies), 4)}
+
+
+def run(args) -> dict:
+    fake_netbrain = FakeNetbrain(FakeNetbrainConfig(
+        latency_ms=args.latency_ms,
+        latency_dist=args.latency_dist,
+        error_rate=args.error_rate,
+        completion_delay=args.completion_delay,
+    ))
+    fake_netbrain.start()
+
+    from mongoengine import connect
+
+    from src.netbrain_service import bootstrap
+    from src.netbrain_service.config import settings
+
+    # requests_consumer and command_consumers read these at import time
+    settings.set('NETBRAIN_HOST', fake_netbrain.url)
+    settings.set('NETBRAIN_USE_DUMMY_API', False)
+    settings.set('CONTENT_PARSER_PROCESSES', args.parse_processes)
+
+    from src.netbrain_service.domain.common import get_cid
+    from src.netbrain_service.application.mongo_models import IncomingPayload
+    from src.netbrain_service.application.mongo_models import BenchmarkPayload
+    from src.netbrain_service.application.mongo_models import TaskLog
+    from src.netbrain_service.application.mongo_models import LoginToken
+    from src.netbrain_service.application.mongo_models import DeviceInventoryEntry
+    from src.netbrain_service.application.mongo_models import AlertResult
+    from src.netbrain_service.application.event_consumer import process_event
+    from src.netbrain_service.application.event_consumer import process_pending
+    from src.netbrain_service.application.benchmark_reaper import BenchmarkReaper
+
+    # Mongo is connected below to the benchmark database instead of MONGO_URI
+    bootstrap.init_logging()
+    bootstrap.init_tracing()
+    if args.mongomock:
+        import mongomock
+        connect(host='mongodb://localhost/netbrain_benchmark', mongo_client_class=mongomock.MongoClient)
+    else:
+        connect(host=args.mongo_uri)
+    for model in (IncomingPayload, BenchmarkPayload, TaskLog, LoginToken, DeviceInventoryEntry, AlertResult):
+        model.drop_collection()
+
+    ipaddresses = [f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}" for i in range(1, args.events + 1)]
+    # devices missing from the inventory are rejected before a benchmark is created
+    DeviceInventoryEntry.objects.insert([
+        DeviceInventoryEntry(devicename=f"bench-device-{n}", ipaddress=ipaddress,
+                             site_path=f"My Network/Benchmark/bench-device-{n}", updated_datetime=datetime.utcnow())
+        for n, ipaddress in enumerate(ipaddresses)
+    ], load_bulk=False)
+    reaper = BenchmarkReaper(poll_interval=0.2)
+    reaper.start()
+    before = stage_totals()
+    started = time.perf_counter()
+
+    # submit at a fixed rate, process_event callers run concurrently like Flask request threads
+    with ThreadPoolExecutor(max_workers=args.ingest_threads) as executor:
+        futures = []
+        for n, ipaddress in enumerate(ipaddresses):
+            delay = started + n / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            payload = {
+                'devicename': f"bench-device-{n}",
+                'ipaddress': ipaddress,
+                'objectname': f"TenGigE0/0/0/{n % 48}",
+                'cid': get_cid(),
+            }
+            futures.append(executor.submit(process_event, payload))
+        submit_errors = sum(1 for future in futures if future.exception() is not None)
+    submitted = time.perf_counter()
+
+    # drain whatever is still waiting on NetBrain
+    deadline = submitted + args.timeout
+    completed = TaskLog.objects(completed_datetime__ne=None, ipaddress__in=ipaddresses).count()
+    while completed < len(ipaddresses) and time.perf_counter() < deadline:
+        process_pending()
+        completed = TaskLog.objects(completed_datetime__ne=None, ipaddress__in=ipaddresses).count()
+        if completed < len(ipaddresses):
+            time.sleep(0.2)
+    finished = time.perf_counter()
+    reaper.stop()
+    pending_deletes = len(TaskLog.objects(status='DELETE_TASK', ipaddress__in=ipaddresses).distinct('task_name'))
+
+    created = {
+        payload.ipaddress: payload.created_datetime
+        for payload in IncomingPayload.objects(ipaddress__in=ipaddresses).only('ipaddress', 'created_datetime')
+    }
+    latencies = sorted(
+        (task_log.completed_datetime - created[task_log.ipaddress]).total_seconds()
+        for task_log in TaskLog.objects(completed_datetime__ne=None, ipaddress__in=ipaddresses)
+        .only('ipaddress', 'completed_datetime')
+        if task_log.completed_datetime and task_log.ipaddress in created
+    )
+
+    fake_netbrain.stop()
+    elapsed = finished - started
+    return {
+        'events': len(ipaddresses),
+        'completed': completed,
+        'submit_errors': submit_errors,
+        'timed_out': completed < len(ipaddresses),
+        'tasks_pending_delete': pending_deletes,
+        'elapsed_seconds': round(elapsed, 3),
+        'ingest_seconds': round(submitted - started, 3),
+        'throughput_per_second': round(completed / elapsed, 3) if elapsed else None,
+        'end_to_end': percentile_report(latencies),
+        'stages': stage_report(before, stage_totals()),
+        'fake_netbrain': fake_netbrain.stats.as_dict(),
+        'config': vars(args),
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+    json.dump(report, sys.stdout, indent=2, default=str)
+    sys.stdout.write(os.linesep)
+    return 1 if report['timed_out'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
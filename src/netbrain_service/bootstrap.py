@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+
+from logging.handlers import QueueHandler
+
+from typing import Callable
+from typing import Optional
+
+from src.netbrain_service.config import settings
+
+"""
+Explicit process startup.
+
+Importing the package has no side effects; whatever runs the service (the
+Flask app factory, a worker process, a benchmark) calls bootstrap() once,
+which initializes logging, then tracing, then registers the Mongo
+connection. Each step runs only once per process no matter how often it is
+called, so it is safe to call from every entry point.
+
+The Mongo client is created with connect=False, no connection is opened
+until the first query.
+"""
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.RLock()
+_log_listener = None
+_tracer_provider = None
+_logging_ready = False
+_tracing_ready = False
+_mongo_ready = False
+
+# background workers started by start_workers(), name -> thread
+_worker_factories: dict[str, Callable[[], threading.Thread]] = {}
+_worker_threads: dict[str, threading.Thread] = {}
+# whether start_workers() ran in this process, and its heartbeat thread
+_workers_started = False
+_heartbeat_thread: Optional[threading.Thread] = None
+
+
+def init_logging():
+    """attach the queue based handlers to the package logger, see log_config.configure_logging"""
+    global _log_listener, _logging_ready
+    with _lock:
+        if not _logging_ready:
+            from src.netbrain_service.log_config import configure_logging
+            _log_listener = configure_logging(logging.getLogger('src.netbrain_service'))
+            _logging_ready = True
+    return _log_listener
+
+
+def init_tracing():
+    """install the tracer provider, must run before the Mongo client is created"""
+    global _tracer_provider, _tracing_ready
+    with _lock:
+        if not _tracing_ready:
+            from src.netbrain_service.tracing import configure_tracing
+            _tracer_provider = configure_tracing()
+            _tracing_ready = True
+    return _tracer_provider
+
+
+# MongoClient options read from settings, left at the pymongo default when unset
+MONGO_CLIENT_SETTINGS = {
+    'MONGO_MAX_POOL_SIZE': 'maxPoolSize',
+    'MONGO_MIN_POOL_SIZE': 'minPoolSize',
+    'MONGO_MAX_IDLE_TIME_MS': 'maxIdleTimeMS',
+    'MONGO_WAIT_QUEUE_TIMEOUT_MS': 'waitQueueTimeoutMS',
+    'MONGO_SERVER_SELECTION_TIMEOUT_MS': 'serverSelectionTimeoutMS',
+    'MONGO_CONNECT_TIMEOUT_MS': 'connectTimeoutMS',
+    'MONGO_SOCKET_TIMEOUT_MS': 'socketTimeoutMS',
+    'MONGO_READ_PREFERENCE': 'readPreference',
+    'MONGO_WRITE_CONCERN': 'w',
+}
+
+
+def mongo_client_options() -> dict:
+    """MongoClient keyword arguments from the MONGO_* settings"""
+    options = {'maxPoolSize': 100, 'serverSelectionTimeoutMS': 5000}
+    for setting, option in MONGO_CLIENT_SETTINGS.items():
+        value = settings.get(setting)
+        if value is not None:
+            options[option] = value
+    return options
+
+
+def init_mongo():
+    """
+    Register the default mongoengine connection from MONGO_URI and the
+    MONGO_* client settings. Lazy, the first query opens the connection.
+    Collections may override write concern and read preference, see
+    adapters.odm.TunedDocument. Pool usage is reported on /metrics by
+    metrics.MongoPoolListener.
+    """
+    global _mongo_ready
+    with _lock:
+        if not _mongo_ready:
+            from mongoengine import connect
+            from src.netbrain_service.metrics import MongoPoolListener
+            options = mongo_client_options()
+            connect(
+                host=settings.get('MONGO_URI', 'mongodb://localhost:27017/netbrain'),
+                event_listeners=[MongoPoolListener()],
+                connect=False,
+                **options,
+            )
+            _mongo_ready = True
+            logger.info("mongo connection registered with %s", options)
+
+
+def bootstrap():
+    """initialize logging, tracing and Mongo, in that order, once per process"""
+    init_logging()
+    init_tracing()
+    init_mongo()
+
+
+def after_fork():
+    """
+    Re-run bootstrap in a freshly forked child process (gunicorn post_fork).
+    Threads don't survive fork, so the log listener is replaced, the
+    child gets its own Mongo client instead of the parent's, and the
+    worker registry starts empty: workers belong to the process that
+    started them.
+    """
+    global _lock, _logging_ready, _mongo_ready, _workers_started, _heartbeat_thread
+    # another parent thread may have held the lock at fork time
+    _lock = threading.RLock()
+    package_logger = logging.getLogger('src.netbrain_service')
+    for handler in list(package_logger.handlers):
+        if isinstance(handler, QueueHandler):
+            package_logger.removeHandler(handler)
+    _logging_ready = False
+    if _mongo_ready:
+        from mongoengine import disconnect
+        disconnect()
+        _mongo_ready = False
+    _worker_factories.clear()
+    _worker_threads.clear()
+    _workers_started = False
+    _heartbeat_thread = None
+    bootstrap()
+
+
+def register_worker(name: str, factory: Callable[[], threading.Thread]):
+    """
+    Register a background worker to be run by start_workers(). factory
+    starts the worker and returns its thread, ex.
+
+        register_worker('outbox-relay', lambda: OutboxRelay().start())
+    """
+    with _lock:
+        _worker_factories[name] = factory
+
+
+def start_workers():
+    """
+    start every registered worker that isn't already running, and the
+    heartbeat that publishes their status to other processes
+    """
+    global _workers_started, _heartbeat_thread
+    with _lock:
+        for name, factory in _worker_factories.items():
+            thread = _worker_threads.get(name)
+            if thread is None or not thread.is_alive():
+                _worker_threads[name] = factory()
+                logger.info("worker %s started", name)
+        _workers_started = True
+        if _heartbeat_thread is None or not _heartbeat_thread.is_alive():
+            _heartbeat_thread = threading.Thread(target=_heartbeat, name='worker-heartbeat', daemon=True)
+            _heartbeat_thread.start()
+
+
+def heartbeat_file() -> str:
+    return settings.get('WORKER_HEARTBEAT_FILE', os.path.join(tempfile.gettempdir(), 'netbrain_service_workers.json'))
+
+
+def _local_worker_status() -> dict[str, bool]:
+    with _lock:
+        return {
+            name: bool(_worker_threads.get(name) and _worker_threads[name].is_alive())
+            for name in _worker_factories
+        }
+
+
+def write_heartbeat():
+    """write this process's worker status to the heartbeat file, replaced atomically"""
+    path = heartbeat_file()
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as heartbeat:
+        json.dump({'pid': os.getpid(), 'time': time.time(), 'workers': _local_worker_status()}, heartbeat)
+    os.replace(temp_path, path)
+
+
+def _heartbeat():
+    interval = settings.get('WORKER_HEARTBEAT_INTERVAL', 5)
+    while True:
+        try:
+            write_heartbeat()
+        except Exception as e:
+            logger.error("worker heartbeat not written: '%s'", e)
+        time.sleep(interval)
+
+
+def read_heartbeat() -> Optional[dict[str, bool]]:
+    """worker status from the heartbeat file, None when it is missing or older than WORKER_HEARTBEAT_TTL"""
+    try:
+        with open(heartbeat_file()) as heartbeat:
+            beat = json.load(heartbeat)
+    except (OSError, ValueError):
+        return None
+    ttl = settings.get('WORKER_HEARTBEAT_TTL', 3 * settings.get('WORKER_HEARTBEAT_INTERVAL', 5))
+    if time.time() - beat.get('time', 0) > ttl:
+        return None
+    return beat.get('workers', {})
+
+
+def worker_status() -> Optional[dict[str, bool]]:
+    """
+    registered worker name -> whether its thread is alive. Under gunicorn
+    the workers run in the master, so a process that didn't start workers
+    itself reports the master's from the heartbeat file, or None when no
+    fresh heartbeat says the workers are running.
+    """
+    if _workers_started:
+        return _local_worker_status()
+    return read_heartbeat()
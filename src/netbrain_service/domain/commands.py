@@ -1,11 +1,31 @@
-
-@dataclass
-class LoginRequest(Command):
-    objectname: str
-    ipaddress: str
-    devicename: str
-
-@dataclass
-class
-
-
+from dataclasses import dataclass
+
+from datetime import datetime
+
+from src.netbrain_service.domain.common import Cid
+from src.netbrain_service.domain.common import Command
+
+
+@dataclass
+class LoginRequest(Command):
+    objectname: str
+    ipaddress: str
+    devicename: str
+
+@dataclass
+class UpdateCampaignResults(Command):
+    """
+    Placed on the External Message Queue by the PollingManager every
+    time a campaign's polling interval fires.
+
+    Only one UpdateCampaignResults per domain/campaign is useful at a
+    time, so duplicates are coalesced while one is queued and locked
+    while one is running.
+    """
+    domain: str
+    campaign: str
+    cid: Cid
+    create_time: datetime
+
+    field_locks = ["domain", "campaign"]
+    coalesce_fields = ["domain", "campaign"]
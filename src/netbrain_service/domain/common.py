@@ -1,133 +1,227 @@
-from dataclasses import dataclass
-
-from random import choices
-
-from typing import NewType
-from typing import Literal
-from typing import Union
-
-from datetime import datetime
-from datetime import timezone
-from datetime import timedelta
-
-from src.netbrain_service.config import settings
-
-RAND_ROOT = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz123456789'
-
-# short for Correlation ID, standard length of 12 alphanumeric chars
-# a cid should be created at the start of a transaction or process
-# and be passed through each phase for log correlation and event
-# sourcing abilities, real-time and historical, in the future.
-Cid = NewType('Cid', str)
-
-
-# provides a randomly generated correlation id
-def get_cid() -> Cid:
-    selections: list[str] = choices(RAND_ROOT, k=settings.CORRELATION_ID_LENGTH)
-    cid = Cid(''.join(selections))
-    return cid
-
-
-#
-# Message base classes
-class Message:
-    """
-    Abstract parent level class intended to be extended. Only
-    refer to Message when extending to a more specialized base
-    class, such as Command or Event.
-
-    You should not be instantiating a Message.
-
-    Locking behavior is provided and is declared here so that all
-    children inherit the behavior. To declare idempotent behavior
-    for a Message, provide one or more fields as strings that
-    require uniqueness constraints across the inherited Message
-    child class namespace [ex. Message.Command.TestCommand
-    namespace in below example].
-
-    For example
-        Message.Command.TestCommand may have the fields
-        cid, name, domain, description, create_time
-        and field_locks could be ["name", "domain"]
-
-        In this case, every Message.Command.TestCommand that comes
-        in will try to run and the MessageBus will confirm that
-        no other Message.Command.TestCommand with the same data in
-        fields "name" and "domain" is currently running, by checking
-        a idempotent cllection. If it is, the Message is discarded
-        with a logging message recording the event, if it is not
-        currently running, the Message is processed and the
-        "signature" of the Message type and data from the fields is
-        added to a idempotent collection so that the next
-        Message.Command.TestCommand that matches will be discarded
-        as per above description.
-
-    """
-    cid: Cid
-    create_time: datetime
-    target_stage: Literal[
-        "DEV",
-        "TEST",
-        "PROD",] = "PROD"
-
-
-class Document(Message):
-    """
-    Message that is a Data Representation, typically of a
-    resource or result.
-
-    Informational in nature, not of something
-    that has occurred, as that has its Event, but something that
-    is. Typically used as a method of transferring State.
-    """
-    cid: Cid
-    create_time: datetime
-    target_stage: Literal[
-        "DEV",
-        "TEST",
-        "PROD",] = "PROD"
-
-
-class Command(Message):
-    """
-    Message that makes a request of the system, analagous to
-    an instruction being given.
-
-    Commands are only ever passed to one function. This is
-    because if you are asking for a change to be made in the
-    system, we do not want multiple functions trying to make
-    that same change.
-
-    Command is an abstract class, not intended to be directly
-    instantiated. You should extend it to a specific class,
-    such as ExampleCommand(Command)
-    """
-
-    field_locks: list[str] = list()
-
-
-class Event(Message):
-    """
-    Message that documents the occurrence or result of an
-    action somewhere in the system
-
-    Events can be passed to many functions. This is because
-    an event is inherently informative and non-actionable.
-    If an action (besides reporting/logging/etc.) needs to
-    be taken in response to an Event, then an EventConsumer
-    of that Event should consume it and then return one or
-    more Commands that make further requests of the system.
-
-    Event is an abstract class, not intended to be directly
-    instantiated. You should extend it to a specific class,
-    such as ExampleEvent(Event)
-    """
-    pass
-
-
-# End Message base classes
-#
-def get_yesterday() -> datetime:
-    # return a datetime object representing yesterday
-    yesterday = datetime.now(timezone.utc) - timedelta(days=1)
-    return yesterday
+from dataclasses import dataclass
+
+import time
+import random
+import threading
+
+from contextlib import contextmanager
+
+from contextvars import ContextVar
+
+from typing import NewType
+from typing import Optional
+from typing import Literal
+from typing import Union
+
+from datetime import datetime
+from datetime import timezone
+from datetime import timedelta
+
+from src.netbrain_service.config import settings
+
+# base62 in ASCII order, so encoded values sort the same as the numbers
+CID_ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+CID_TIME_CHARS = 8
+
+# short for Correlation ID, CORRELATION_ID_LENGTH alphanumeric chars
+# a cid should be created at the start of a transaction or process
+# and be passed through each phase for log correlation and event
+# sourcing abilities, real-time and historical, in the future.
+Cid = NewType('Cid', str)
+
+
+# every 2 char base62 string in order, encoding two digits per divmod
+_BASE62_PAIRS = [a + b for a in CID_ALPHABET for b in CID_ALPHABET]
+
+
+def _base62(value: int, width: int) -> str:
+    """fixed width base62 encoding of value"""
+    pairs = []
+    for _ in range((width + 1) // 2):
+        value, index = divmod(value, 3844)
+        pairs.append(_BASE62_PAIRS[index])
+    return ''.join(reversed(pairs))[-width:]
+
+
+class _CidGenerator:
+    """
+    ULID style cids: 8 chars of millisecond timestamp followed by random
+    chars, so cids sort by creation time and indexes on cid stay
+    append-mostly. Within the same millisecond the random part is
+    incremented instead of redrawn, keeping cids from one process
+    strictly increasing. The length is read from settings once.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._random_chars = None
+        self._random_limit = None
+        self._last_ms = -1
+        self._last_random = 0
+
+    def __call__(self) -> Cid:
+        if self._random_chars is None:
+            random_chars = settings.get('CORRELATION_ID_LENGTH', 25) - CID_TIME_CHARS
+            if random_chars < 8:
+                raise ValueError(f"CORRELATION_ID_LENGTH must be at least {CID_TIME_CHARS + 8}")
+            self._random_limit = 62 ** random_chars
+            self._random_chars = random_chars
+        with self._lock:
+            now_ms = time.time_ns() // 1_000_000
+            if now_ms > self._last_ms:
+                self._last_ms = now_ms
+                self._last_random = random.randrange(self._random_limit)
+            else:
+                # same millisecond or the clock stepped back, stay monotonic
+                self._last_random += 1
+                if self._last_random >= self._random_limit:
+                    self._last_ms += 1
+                    self._last_random = random.randrange(self._random_limit)
+            ms, rand = self._last_ms, self._last_random
+        return Cid(_base62(ms, CID_TIME_CHARS) + _base62(rand, self._random_chars))
+
+
+# provides a time ordered, randomly suffixed correlation id
+get_cid = _CidGenerator()
+
+
+def cid_datetime(cid: str) -> Optional[datetime]:
+    """creation time encoded in a get_cid cid, None for anything else"""
+    if len(cid) < CID_TIME_CHARS + 8 or any(char not in CID_ALPHABET for char in cid):
+        return None
+    ms = 0
+    for char in cid[:CID_TIME_CHARS]:
+        ms = ms * 62 + CID_ALPHABET.index(char)
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc)
+
+
+# the cid of the transaction currently being worked on by this thread or
+# asyncio task. It is set at ingest and for each Message consumed, and is
+# added to every log record by log_config.CidFilter, so log calls don't
+# need to carry the cid themselves.
+current_cid: ContextVar[Optional[Cid]] = ContextVar('current_cid', default=None)
+
+
+@contextmanager
+def cid_context(cid: Cid):
+    """set current_cid for the duration of the with block"""
+    token = current_cid.set(cid)
+    try:
+        yield cid
+    finally:
+        current_cid.reset(token)
+
+
+#
+# Message base classes
+class Message:
+    """
+    Abstract parent level class intended to be extended. Only
+    refer to Message when extending to a more specialized base
+    class, such as Command or Event.
+
+    You should not be instantiating a Message.
+
+    Locking behavior is provided and is declared here so that all
+    children inherit the behavior. To declare idempotent behavior
+    for a Message, provide one or more fields as strings that
+    require uniqueness constraints across the inherited Message
+    child class namespace [ex. Message.Command.TestCommand
+    namespace in below example].
+
+    For example
+        Message.Command.TestCommand may have the fields
+        cid, name, domain, description, create_time
+        and field_locks could be ["name", "domain"]
+
+        In this case, every Message.Command.TestCommand that comes
+        in will try to run and the MessageBus will confirm that
+        no other Message.Command.TestCommand with the same data in
+        fields "name" and "domain" is currently running, by checking
+        a idempotent cllection. If it is, the Message is discarded
+        with a logging message recording the event, if it is not
+        currently running, the Message is processed and the
+        "signature" of the Message type and data from the fields is
+        added to a idempotent collection so that the next
+        Message.Command.TestCommand that matches will be discarded
+        as per above description.
+
+    """
+    cid: Cid
+    create_time: datetime
+    target_stage: Literal[
+        "DEV",
+        "TEST",
+        "PROD",] = "PROD"
+    # w3c trace context of the span that queued the Message, set by the
+    # MessageBus so consuming the Message continues the same trace
+    trace_context: Optional[dict] = None
+
+
+class Document(Message):
+    """
+    Message that is a Data Representation, typically of a
+    resource or result.
+
+    Informational in nature, not of something
+    that has occurred, as that has its Event, but something that
+    is. Typically used as a method of transferring State.
+    """
+    cid: Cid
+    create_time: datetime
+    target_stage: Literal[
+        "DEV",
+        "TEST",
+        "PROD",] = "PROD"
+
+
+class Command(Message):
+    """
+    Message that makes a request of the system, analagous to
+    an instruction being given.
+
+    Commands are only ever passed to one function. This is
+    because if you are asking for a change to be made in the
+    system, we do not want multiple functions trying to make
+    that same change.
+
+    Command is an abstract class, not intended to be directly
+    instantiated. You should extend it to a specific class,
+    such as ExampleCommand(Command)
+
+    coalesce_fields works like field_locks but is checked when the
+    Command is added to the MessageBus queue instead of when it is
+    consumed. While a Command of the same type with the same data in
+    those fields is queued or running, further copies are dropped
+    instead of piling up behind it.
+    """
+
+    field_locks: list[str] = list()
+    coalesce_fields: list[str] = list()
+
+
+class Event(Message):
+    """
+    Message that documents the occurrence or result of an
+    action somewhere in the system
+
+    Events can be passed to many functions. This is because
+    an event is inherently informative and non-actionable.
+    If an action (besides reporting/logging/etc.) needs to
+    be taken in response to an Event, then an EventConsumer
+    of that Event should consume it and then return one or
+    more Commands that make further requests of the system.
+
+    Event is an abstract class, not intended to be directly
+    instantiated. You should extend it to a specific class,
+    such as ExampleEvent(Event)
+    """
+    pass
+
+
+# End Message base classes
+#
+def get_yesterday() -> datetime:
+    # return a datetime object representing yesterday
+    yesterday = datetime.now(timezone.utc) - timedelta(days=1)
+    return yesterday
@@ -0,0 +1,49 @@
+import ipaddress
+
+from typing import Annotated
+from typing import Optional
+
+from pydantic import BaseModel
+from pydantic import ConfigDict
+from pydantic import Field
+from pydantic import AfterValidator
+from pydantic import ValidationError
+
+"""
+Data Transfer Objects for request bodies received by the entry points.
+
+DTOs are pydantic models, so a raw request body is decoded and validated
+in a single pass with model_validate_json, and malformed payloads are
+rejected before any of the pipeline or Mongo is touched.
+"""
+
+
+def _valid_ip(value: str) -> str:
+    # raises ValueError, reported by pydantic as a validation error on the field
+    ipaddress.ip_address(value)
+    return value
+
+
+NonEmptyStr = Annotated[str, Field(min_length=1, max_length=256)]
+IpAddressStr = Annotated[str, Field(max_length=64), AfterValidator(_valid_ip)]
+
+
+class LoginRequestDTO(BaseModel):
+    """
+    Body of /api/v1/request, the fields of domain.commands.LoginRequest
+    plus an optional cid, injected by the endpoint when not provided.
+    """
+    model_config = ConfigDict(str_strip_whitespace=True, extra='ignore', frozen=True)
+
+    objectname: NonEmptyStr
+    ipaddress: IpAddressStr
+    devicename: NonEmptyStr
+    cid: Optional[NonEmptyStr] = None
+
+
+def validation_errors(error: ValidationError) -> list[dict]:
+    """short field/error pairs for a ValidationError, safe to return to the caller"""
+    return [
+        {'field': '.'.join(str(part) for part in detail['loc']) or 'body', 'error': detail['msg']}
+        for detail in error.errors(include_url=False)
+    ]
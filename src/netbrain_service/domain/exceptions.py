@@ -0,0 +1,3 @@
+class ApiActionError(Exception):
+    """Raised when a WSGW api_action receives an unsuccessful response."""
+    pass
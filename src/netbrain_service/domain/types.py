@@ -0,0 +1,7 @@
+from typing import Any
+
+# json-serializable body of a POST/PUT request to the WSGW
+PostData = dict[str, Any]
+
+# decoded json body of a WSGW DeviceRawData response
+DeviceDataResponse = dict[str, Any]
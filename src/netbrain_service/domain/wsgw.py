@@ -1,86 +1,326 @@
-
-
-
-
-# Restrained Type Aliases
-AuthType = Literal['BASIC', 'TOKEN']
-RequestType = Literal['GET', 'POST', 'PUT']
-
-
-class WsgwConfig(BaseModel):
-    api_url: str
-    api_un: str
-    api_pw: str
-    auth_type: AuthType = 'BASIC'
-    debug: Optional[bool] = False
-
-class Wsgw:
-    """
-        Ojbect to represent the Web Services Gateway API
-
-        DEV: During development, some output is recorded in local files. This
-        will be turned off in PROD.
-        """
-
-    def __init__(self, wsgw_config: WsgwConfig):
-        # set configuration
-        self.config = wsgw_config
-        # set authentication
-        # TODO:// add token authentication if needed
-        if self.config.auth_type == 'BASIC':
-            self.auth = HTTPBasicAuth(username=self.config.api_un, password=self.config.api_pw)
-        self.headers = {'accept': 'application/json', 'content-type': 'application/json'}
-        self.messages: list[Message] = []
-
-    def retrieve_messages(self) -> list[Message]:
-        messages = self.messages
-        # we want to clear out after we grab them
-        # we don't want messages double processed
-        self.messages = []
-        return messages
-
-    def api_action(self, action: RequestType, url: str, data: Optional[types.PostData] = None, params = None, debug_filename: Optional[str] = None, cid: Cid = get_cid(),) -> Response:
-        """
-        Direct HTTP Request of the WSGW REST API.
-
-        This method is effectively a wrapper around requests.request()
-        """
-        logger.info(f'{cid} api_action request being made: action {action} url {url} debug_filename {debug_filename}')
-        logger.debug(f'{cid} headers={self.headers} data={data}')
-        # data must be json encoded string
-        if action == 'GET':
-            response: Response = request(method=action, url=url, params=params, headers=self.headers, auth=self.auth)
-            return response
-        else:
-            if data:
-                data = json.dumps(data)
-            response: Response = request(method=action, url=url, data=data, headers=self.headers, auth=self.auth)
-
-            # if self.config.debug:
-            #     # make sure we have the directory available
-            #     if not os.path.exists('debug_output'):
-            #         try:
-            #             os.mkdir('debug_output')
-            #         except:
-            #             logger.error(f'Unable to create the local directory debug_output', exc_info=True)
-            #     # confirm we now have the path, if so then dump output
-            #     if os.path.exists('debug_output'):
-            #         if response.ok:
-            #             with open(f'debug_output\\{debug_filename}_{datetime.now()}.json', 'a') as output:
-            #                 json.dump(response.json(), output)
-            #             logger.info(f'{cid} DEBUG enabled created output file {debug_filename}.json')
-            #         else: # fail message will be in xml
-            #             with open(f'debug_output\\{debug_filename}_ERROR.xml', 'a') as output:
-            #                 output.write(response.text)
-            #             logger.info(f'{cid} DEBUG enabled created output file {debug_filename}_ERROR.xml')
-
-            logger.info(f'{cid} api_action response status_code {response.status_code}')
-            if not response.ok:
-                raise exceptions.ApiActionError(
-                    f'{action} {url} received status_code {response.status_code} {response.text}')
-            return response
-
-
-    # Get Device Data
-    def device_data(self, cid: Cid = get_cid()) -> types.DeviceDataResponse:
-        url = f'{self.config.api_url}/CMDB/Devices/DeviceRawData?IP=10.139.252.208&dataType=2&cmd=show interface&token=ae547ee8-1da2-4271-8b0a-ad64edae84b4'
+import json
+import time
+import asyncio
+import threading
+
+import httpx
+
+from typing import Literal
+from typing import Optional
+
+from pydantic import BaseModel
+
+from src.netbrain_service import logger
+from src.netbrain_service.domain import types
+from src.netbrain_service.domain import exceptions
+from src.netbrain_service.domain.common import Cid
+from src.netbrain_service.domain.common import Message
+from src.netbrain_service.domain.common import get_cid
+from src.netbrain_service.domain.common import cid_context
+from src.netbrain_service.domain.common import current_cid
+from src.netbrain_service.log_config import Truncated
+from src.netbrain_service.metrics import OUTBOUND_ERRORS
+from src.netbrain_service.metrics import OUTBOUND_LATENCY
+from src.netbrain_service.tracing import span
+
+# Restrained Type Aliases
+AuthType = Literal['BASIC', 'TOKEN']
+RequestType = Literal['GET', 'POST', 'PUT']
+
+# gateway responses that are worth another attempt
+RETRY_STATUS_CODES = {502, 503, 504}
+
+# methods that are safe to send again after the gateway may have acted on
+# them; POST and PUT are only retried when the connection was never made
+IDEMPOTENT_METHODS = {'GET'}
+
+# refresh a cached token this many seconds before it expires so
+# in-flight requests don't race the expiry
+TOKEN_EXPIRY_SKEW = 30
+
+
+class WsgwConfig(BaseModel):
+    api_url: str
+    api_un: str
+    api_pw: str
+    auth_type: AuthType = 'BASIC'
+    debug: Optional[bool] = False
+    # transport tuning, seconds unless noted
+    timeout: float = 30.0
+    connect_timeout: float = 5.0
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    retries: int = 2
+    retry_backoff: float = 0.5
+    # TOKEN auth, token_path is relative to api_url
+    token_path: str = '/Session'
+    token_header: str = 'token'
+    token_ttl: int = 1800
+
+
+class WsgwTokenAuth(httpx.Auth):
+    """
+    httpx authentication flow for the WSGW token mode.
+
+    A token is acquired once with the configured credentials, cached
+    until shortly before token_ttl runs out, and set as a header on
+    every request sent through the Wsgw's per-loop AsyncClient pools.
+    A 401 response refreshes the token and replays the request once.
+
+    Acquisition is single-flight across threads and event loops:
+    concurrent callers that find no valid token wait on one threading.Lock
+    while one of them logs in, then reuse its token. Async callers wait
+    for it on a worker thread so their loop is not blocked.
+    A refresh after a 401 only logs in again when the rejected token is
+    still the cached one, so a burst of 401s costs a single login.
+    """
+
+    def __init__(self, wsgw_config: WsgwConfig):
+        self.token_url = f'{wsgw_config.api_url}{wsgw_config.token_path}'
+        self.credentials = {'username': wsgw_config.api_un, 'password': wsgw_config.api_pw}
+        self.header = wsgw_config.token_header
+        self.ttl = wsgw_config.token_ttl
+        self.timeout = httpx.Timeout(wsgw_config.timeout, connect=wsgw_config.connect_timeout)
+        self._token: Optional[str] = None
+        self._expires_at: float = 0.0
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self._token = None
+            self._expires_at = 0.0
+
+    def __cached(self, stale: Optional[str] = None) -> Optional[str]:
+        if self._token and self._token != stale and time.monotonic() < self._expires_at:
+            return self._token
+        return None
+
+    def __store(self, response: httpx.Response) -> str:
+        if not response.is_success:
+            raise exceptions.ApiActionError(
+                f'POST {self.token_url} token request received status_code {response.status_code} {response.text}')
+        self._token = response.json()['token']
+        self._expires_at = time.monotonic() + self.ttl - TOKEN_EXPIRY_SKEW
+        logger.info('WSGW token acquired, cached for %s seconds', self.ttl)
+        return self._token
+
+    def get_token(self, stale: Optional[str] = None) -> str:
+        token = self.__cached(stale)
+        if token:
+            return token
+        with self._lock:
+            token = self.__cached(stale)
+            if token:
+                return token
+            response = httpx.post(self.token_url, json=self.credentials, timeout=self.timeout)
+            return self.__store(response)
+
+    async def aget_token(self, stale: Optional[str] = None) -> str:
+        token = self.__cached(stale)
+        if token:
+            return token
+        return await asyncio.to_thread(self.get_token, stale)
+
+    def sync_auth_flow(self, request: httpx.Request):
+        token = self.get_token()
+        request.headers[self.header] = token
+        response = yield request
+        if response.status_code == 401:
+            logger.info('WSGW rejected cached token, refreshing')
+            request.headers[self.header] = self.get_token(stale=token)
+            yield request
+
+    async def async_auth_flow(self, request: httpx.Request):
+        token = await self.aget_token()
+        request.headers[self.header] = token
+        response = yield request
+        if response.status_code == 401:
+            logger.info('WSGW rejected cached token, refreshing')
+            request.headers[self.header] = await self.aget_token(stale=token)
+            yield request
+
+class Wsgw:
+    """
+        Ojbect to represent the Web Services Gateway API
+
+        Calls go through pooled httpx clients. api_action_async is the
+        native interface for async consumers on the MessageBus, so many
+        gateway calls can be in flight from one event loop; api_action is
+        the blocking facade for legacy callers, running api_action_async on
+        a background event loop owned by the Wsgw. Both share the same
+        timeouts, retry policy and authentication; with auth_type TOKEN
+        the gateway token is cached and shared by every pool.
+
+        An httpx.AsyncClient is bound to the event loop it first runs on,
+        and each MessageBus consumer thread runs its own loop, so one async
+        pool is kept per loop.
+
+        DEV: During development, some output is recorded in local files. This
+        will be turned off in PROD.
+        """
+
+    def __init__(self, wsgw_config: WsgwConfig, transport: Optional[httpx.AsyncBaseTransport] = None):
+        # set configuration
+        self.config = wsgw_config
+        # set authentication
+        if self.config.auth_type == 'BASIC':
+            self.auth = httpx.BasicAuth(username=self.config.api_un, password=self.config.api_pw)
+        elif self.config.auth_type == 'TOKEN':
+            self.auth = WsgwTokenAuth(self.config)
+        self.headers = {'accept': 'application/json', 'content-type': 'application/json'}
+        self.messages: list[Message] = []
+        # replaces the network transport of every pool, for local stand-ins
+        self.transport = transport
+        self._async_clients: dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
+        self._clients_lock = threading.Lock()
+        # event loop running the api_action facade's requests
+        self._sync_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def retrieve_messages(self) -> list[Message]:
+        messages = self.messages
+        # we want to clear out after we grab them
+        # we don't want messages double processed
+        self.messages = []
+        return messages
+
+    def __client_options(self) -> dict:
+        return dict(
+            transport=self.transport,
+            auth=self.auth,
+            headers=self.headers,
+            timeout=httpx.Timeout(self.config.timeout, connect=self.config.connect_timeout),
+            limits=httpx.Limits(
+                max_connections=self.config.max_connections,
+                max_keepalive_connections=self.config.max_keepalive_connections,
+            ),
+        )
+
+    def _get_async_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        with self._clients_lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                # pools of loops that have since been closed can't be used again
+                for closed in [closed for closed in self._async_clients if closed.is_closed()]:
+                    del self._async_clients[closed]
+                client = httpx.AsyncClient(**self.__client_options())
+                self._async_clients[loop] = client
+            return client
+
+    def _get_sync_loop(self) -> asyncio.AbstractEventLoop:
+        with self._clients_lock:
+            if self._sync_loop is None:
+                self._sync_loop = asyncio.new_event_loop()
+                threading.Thread(target=self._sync_loop.run_forever, name='wsgw-sync-loop', daemon=True).start()
+            return self._sync_loop
+
+    async def aclose(self):
+        """Close the connection pool belonging to the running event loop."""
+        loop = asyncio.get_running_loop()
+        with self._clients_lock:
+            client = self._async_clients.pop(loop, None)
+        if client is not None:
+            await client.aclose()
+
+    def close(self):
+        """Close the api_action facade's connection pool and stop its event loop."""
+        with self._clients_lock:
+            loop, self._sync_loop = self._sync_loop, None
+        if loop is not None:
+            asyncio.run_coroutine_threadsafe(self.aclose(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+
+    @staticmethod
+    def __request_kwargs(action: RequestType, data: Optional[types.PostData], params) -> dict:
+        # data must be json encoded string
+        if action == 'GET':
+            return dict(params=params)
+        return dict(content=json.dumps(data) if data else None)
+
+    def __retry_delay(self, attempt: int) -> float:
+        return self.config.retry_backoff * (2 ** attempt)
+
+    def __should_retry(self, action: RequestType, attempt: int, response: Optional[httpx.Response] = None,
+                       error: Optional[httpx.TransportError] = None) -> bool:
+        if attempt >= self.config.retries:
+            return False
+        if action not in IDEMPOTENT_METHODS:
+            # the request may have reached the gateway, sending it again could act twice
+            return isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout))
+        return error is not None or response.status_code in RETRY_STATUS_CODES
+
+    @staticmethod
+    def __check_response(action: RequestType, url: str, response: httpx.Response) -> httpx.Response:
+        if action == 'GET':
+            return response
+        logger.info('api_action response status_code %s', response.status_code)
+        if not response.is_success:
+            raise exceptions.ApiActionError(
+                f'{action} {url} received status_code {response.status_code} {response.text}')
+        return response
+
+    async def api_action_async(self, action: RequestType, url: str, data: Optional[types.PostData] = None, params = None, debug_filename: Optional[str] = None, cid: Optional[Cid] = None,) -> httpx.Response:
+        """
+        Direct HTTP Request of the WSGW REST API without blocking the
+        event loop.
+
+        GET requests are retried on transport errors and 502/503/504
+        responses, POST and PUT only when the connection could not be
+        made, with exponential backoff up to config.retries times.
+
+        Logged under cid, else the caller's current cid, else a new one.
+        """
+        with cid_context(cid or current_cid.get() or get_cid()):
+            logger.info('api_action request being made: action %s url %s debug_filename %s', action, url, debug_filename)
+            logger.debug('headers=%s data=%s', self.headers, Truncated(data))
+            client = self._get_async_client()
+            kwargs = self.__request_kwargs(action, data, params)
+            endpoint = debug_filename or action
+            attempt = 0
+            while True:
+                response = None
+                try:
+                    with OUTBOUND_LATENCY.labels('wsgw', endpoint).time(), \
+                            span(f'wsgw.{endpoint}', **{'http.method': action, 'http.url': url, 'attempt': attempt}):
+                        response = await client.request(action, url, **kwargs)
+                except httpx.TransportError as e:
+                    OUTBOUND_ERRORS.labels('wsgw', endpoint).inc()
+                    if not self.__should_retry(action, attempt, error=e):
+                        raise exceptions.ApiActionError(f'{action} {url} failed with {type(e).__name__} {e}') from e
+                else:
+                    if not response.is_success:
+                        OUTBOUND_ERRORS.labels('wsgw', endpoint).inc()
+                    if not self.__should_retry(action, attempt, response=response):
+                        return self.__check_response(action, url, response)
+                logger.warning('api_action %s %s attempt %s failed, retrying', action, url, attempt + 1)
+                await asyncio.sleep(self.__retry_delay(attempt))
+                attempt += 1
+
+    def api_action(self, action: RequestType, url: str, data: Optional[types.PostData] = None, params = None, debug_filename: Optional[str] = None, cid: Optional[Cid] = None,) -> httpx.Response:
+        """
+        Blocking facade over api_action_async for callers that are not
+        running in an event loop, async consumers await api_action_async.
+        The caller's current cid is carried over to the background loop.
+        """
+        coroutine = self.api_action_async(action, url, data=data, params=params, debug_filename=debug_filename,
+                                          cid=cid or current_cid.get())
+        return asyncio.run_coroutine_threadsafe(coroutine, self._get_sync_loop()).result()
+
+    # Get Device Data
+    async def device_data_async(self, ip: str, data_type: str = '2', cmd: str = 'show interface', cid: Optional[Cid] = None) -> types.DeviceDataResponse:
+        url = f'{self.config.api_url}/CMDB/Devices/DeviceRawData'
+        params = {'IP': ip, 'dataType': data_type, 'cmd': cmd}
+        response = await self.api_action_async('GET', url, params=params, debug_filename='device_data', cid=cid)
+        if not response.is_success:
+            raise exceptions.ApiActionError(
+                f'GET {url} received status_code {response.status_code} {response.text}')
+        return response.json()
+
+    def device_data(self, ip: str, data_type: str = '2', cmd: str = 'show interface', cid: Optional[Cid] = None) -> types.DeviceDataResponse:
+        url = f'{self.config.api_url}/CMDB/Devices/DeviceRawData'
+        params = {'IP': ip, 'dataType': data_type, 'cmd': cmd}
+        response = self.api_action('GET', url, params=params, debug_filename='device_data', cid=cid)
+        if not response.is_success:
+            raise exceptions.ApiActionError(
+                f'GET {url} received status_code {response.status_code} {response.text}')
+        return response.json()
@@ -1,32 +1,149 @@
-import json
-
-from flask import request, jsonify
-from src.netbrain_service import logger
-from src.netbrain_service.domain.common import get_cid
-from src.netbrain_service.application.event_consumer import process_event
-
-
-def incoming_payload():
-    """Handle incoming request from stackstorm and send it to login_request"""
-    temp_cid = get_cid()
-
-    try:
-        request_json = request.get_json(force=True, cache=False)
-    except json.JSONDecodeError as jde:
-        logger.warning(f"CID: {temp_cid} : JSONDecodeError: {str(jde)} :Request::Headers: { str(request.headers) } :Data: {str(request.get_data)}")
-        return jsonify(400, f"Issue with the Request body. CID={temp_cid}")
-    else:
-        # inject CID if not provided in the Request body object
-        if not request_json.get("cid"):
-            request_json.update({"cid": temp_cid})
-        logger.warning(f"CID: {temp_cid} : incoming payload: {str(request_json)}")
-    # TODO convert the Request data into a DTO for easier field documentation & access
-
-    # send payload to login request
-    try:
-        process_event(request_json)
-    except Exception as e:
-        logger.error(f"{temp_cid} Exception encountered while deserializing the Message body. request.data=\"{str(request.data)}\"", exc_info=True)
-        return jsonify(500, f"CID={temp_cid} Error generated while deserializing the Message body provided.")
-    return jsonify(200, "Success.")
-
+import json
+
+from flask import request, jsonify, Response
+from prometheus_client import CONTENT_TYPE_LATEST
+from src.netbrain_service import metrics as service_metrics
+from src.netbrain_service import logger
+from src.netbrain_service.log_config import Truncated
+from src.netbrain_service.domain.common import get_cid
+from src.netbrain_service.domain.common import cid_context
+from src.netbrain_service.domain.dtos import LoginRequestDTO
+from pydantic import ValidationError
+from src.netbrain_service.domain.dtos import validation_errors
+from src.netbrain_service.tracing import span
+from src.netbrain_service.config import settings
+from src.netbrain_service import bootstrap
+from src.netbrain_service.application.event_consumer import process_event
+from src.netbrain_service.application.event_consumer import process_events
+
+
+def incoming_payload():
+    """Handle incoming request from stackstorm and send it to login_request"""
+    temp_cid = get_cid()
+
+    # decode and validate in one pass, malformed payloads never reach the pipeline
+    body = request.get_data(cache=False)
+    try:
+        login_request = LoginRequestDTO.model_validate_json(body)
+    except ValidationError as ve:
+        errors = validation_errors(ve)
+        logger.warning("Invalid Request body: %s :Request::Headers: %s :Data: %s", errors, request.headers, Truncated(body), extra={'cid': temp_cid})
+        return jsonify(400, f"Issue with the Request body. CID={temp_cid}", errors), 400
+    # inject CID if not provided in the Request body object
+    request_json = login_request.model_dump()
+    if not request_json["cid"]:
+        request_json["cid"] = temp_cid
+
+    # every log record from here through the pipeline carries the payload's cid
+    with cid_context(request_json["cid"]), span('incoming_payload'):
+        logger.warning("incoming payload: %s", Truncated(request_json))
+
+        # send payload to login request
+        try:
+            result = process_event(request_json)
+        except Exception as e:
+            logger.error("Exception encountered while processing the Message body. request_json=\"%s\"", Truncated(request_json), exc_info=True)
+            return jsonify(500, f"CID={request_json['cid']} Error generated while processing the Message body provided."), 500
+    if result['status'] != 'Success.':
+        logger.error("payload not registered: %s", result['status'], extra={'cid': request_json["cid"]})
+        return jsonify(500, f"CID={request_json['cid']} {result['status']}"), 500
+    # a duplicate is attached to the in-flight alert and accepted like /api/v1/requests does,
+    # the cid/tracking id are those of the work already running
+    tracking = {"cid": result['cid'], "tracking_id": result['tracking_id'], "duplicate": result['duplicate']}
+    return jsonify(200, "Success.", tracking)
+
+
+def incoming_payloads():
+    """
+    Handle a batch of incoming requests, either a JSON array of payloads or
+    NDJSON (one payload per line, Content-Type application/x-ndjson). Every
+    item is validated with LoginRequestDTO and gets its own result with its
+    cid, items that fail validation are reported with their field errors
+    without failing the rest of the batch.
+    """
+    temp_cid = get_cid()
+    body = request.get_data(cache=False)
+    try:
+        if request.mimetype == 'application/x-ndjson' or not body.lstrip().startswith(b'['):
+            payloads = []
+            for line in body.splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    payloads.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # keep its position so the caller can match results to lines
+                    payloads.append(None)
+        else:
+            payloads = json.loads(body)
+    except json.JSONDecodeError as jde:
+        logger.warning("JSONDecodeError: %s :Request::Headers: %s :Data: %s", jde, request.headers, Truncated(body), extra={'cid': temp_cid})
+        return jsonify(400, f"Issue with the Request body. CID={temp_cid}"), 400
+    if not payloads:
+        return jsonify(400, f"Request body contains no payloads. CID={temp_cid}"), 400
+    max_items = settings.get('INGEST_BATCH_MAX_ITEMS', 1000)
+    if len(payloads) > max_items:
+        return jsonify(413, f"Batch of {len(payloads)} payloads exceeds the limit of {max_items}. CID={temp_cid}"), 413
+
+    results = [None] * len(payloads)
+    # (position in the batch, validated payload)
+    valid = []
+    for index, item in enumerate(payloads):
+        try:
+            valid.append((index, LoginRequestDTO.model_validate(item).model_dump()))
+        except ValidationError as ve:
+            results[index] = {'index': index, 'cid': item.get('cid') if isinstance(item, dict) else None,
+                              'status': 'Invalid payload.', 'errors': validation_errors(ve)}
+
+    with cid_context(temp_cid), span('incoming_payloads', payloads=len(payloads)):
+        logger.warning("incoming payloads: %s items, %s invalid", len(payloads), len(payloads) - len(valid))
+        if valid:
+            try:
+                result = process_events([payload for index, payload in valid])
+            except Exception as e:
+                logger.error("Exception encountered while processing the batch. items=%s", len(payloads), exc_info=True)
+                return jsonify(500, f"CID={temp_cid} Error generated while processing the batch provided."), 500
+            if result['status'] != 'Success.':
+                return jsonify(500, f"CID={temp_cid} {result['status']}"), 500
+            for (index, payload), item_result in zip(valid, result['results']):
+                results[index] = {**item_result, 'index': index}
+    return jsonify(200, "Success.", {"cid": temp_cid, "results": results})
+
+
+def health_live():
+    """liveness, the process is up and serving requests"""
+    return jsonify(200, "Success.", {"status": "alive"})
+
+
+def health_ready():
+    """
+    readiness, Mongo answers a ping within HEALTH_MONGO_TIMEOUT seconds and
+    every background worker is running, in this process or, under
+    gunicorn, in the master according to its heartbeat. Responds 503 when
+    not ready so load balancers stop routing here.
+    """
+    import pymongo
+    from mongoengine.connection import get_connection
+
+    checks = {}
+    try:
+        with pymongo.timeout(settings.get('HEALTH_MONGO_TIMEOUT', 2)):
+            get_connection().admin.command('ping')
+        checks['mongo'] = 'ok'
+    except Exception as e:
+        logger.warning("health_ready > mongo ping failed: %s", e)
+        checks['mongo'] = f"failed: {type(e).__name__}"
+    workers = bootstrap.worker_status()
+    if workers is None:
+        checks['workers'] = 'no heartbeat'
+    else:
+        checks['workers'] = {name: 'ok' if alive else 'stopped' for name, alive in workers.items()}
+
+    if checks['mongo'] == 'ok' and workers is not None and all(workers.values()):
+        return jsonify(200, "Success.", checks)
+    return jsonify(503, "Not ready.", checks), 503
+
+
+def metrics():
+    """Prometheus scrape endpoint"""
+    return Response(service_metrics.latest(), mimetype=CONTENT_TYPE_LATEST)
@@ -1,11 +1,52 @@
 from flask import Flask, Blueprint
-from src.netbrain_service.entry_points.flask_app.main.api import incoming_payload  # Import the routes
+from src.netbrain_service.config import settings
+from src.netbrain_service import bootstrap
 
-bp = Blueprint('main', __name__)
-bp.add_url_rule("/api/v1/request", view_func=incoming_payload, methods=["POST"])  # Add the route to the blueprint
 
-app = Flask(__name__)
-app.register_blueprint(bp)
+def register_workers():
+    """register the background workers enabled in settings with bootstrap"""
+    if settings.get('OUTBOX_RELAY_ENABLED', False):
+        from src.netbrain_service.application.outbox_relay import OutboxRelay
+        bootstrap.register_worker('outbox-relay', lambda: OutboxRelay().start())
+    # nothing else deletes finished benchmark tasks from NetBrain
+    if settings.get('BENCHMARK_REAPER_ENABLED', True):
+        from src.netbrain_service.application.benchmark_reaper import BenchmarkReaper
+        bootstrap.register_worker('benchmark-reaper', lambda: BenchmarkReaper().start())
+    if settings.get('BENCHMARK_BATCH_WINDOW', 0) > 0:
+        from src.netbrain_service.application.event_consumer import start_pipeline_pump
+        bootstrap.register_worker('pipeline-pump', lambda: start_pipeline_pump(settings.BENCHMARK_BATCH_WINDOW))
+
+
+def create_app(start_workers: bool = True) -> Flask:
+    """
+    Application factory, runs bootstrap() (logging, tracing, lazy Mongo
+    connection) and, unless start_workers is False, starts the registered
+    background workers. Under gunicorn the workers run once in the master
+    instead, see gunicorn_conf.
+    """
+    bootstrap.bootstrap()
+
+    # routes import the pipeline, keep that off the import path of this module
+    from src.netbrain_service.entry_points.flask_app.main.api import incoming_payload, incoming_payloads, metrics  # Import the routes
+    from src.netbrain_service.entry_points.flask_app.main.api import health_live, health_ready
+    bp = Blueprint('main', __name__)
+    bp.add_url_rule("/api/v1/request", view_func=incoming_payload, methods=["POST"])  # Add the route to the blueprint
+    bp.add_url_rule("/api/v1/requests", view_func=incoming_payloads, methods=["POST"])
+    bp.add_url_rule("/metrics", view_func=metrics, methods=["GET"])
+    bp.add_url_rule("/health/live", view_func=health_live, methods=["GET"])
+    bp.add_url_rule("/health/ready", view_func=health_ready, methods=["GET"])
+
+    if start_workers:
+        register_workers()
+        bootstrap.start_workers()
+
+    app = Flask(__name__)
+    # larger bodies are rejected with 413 before they are read
+    app.config['MAX_CONTENT_LENGTH'] = settings.get('MAX_CONTENT_LENGTH', 16 * 1024 * 1024)
+    app.register_blueprint(bp)
+    return app
+
 
 if __name__ == "__main__":
-    app.run(debug=True, port=5050)
+    # development server only, run production through gunicorn, see gunicorn_conf
+    create_app().run(debug=True, port=5050)
@@ -0,0 +1,69 @@
+import os
+import glob
+import multiprocessing
+
+from src.netbrain_service.config import settings
+
+"""
+gunicorn configuration for the Flask app, every value can be set with the
+matching GUNICORN_* setting. See wsgi.py for the command line.
+
+The default gthread workers suit this service: requests spend most of
+their time waiting on Mongo and NetBrain, so each worker process runs
+several request threads, and worker processes spread ingestion across
+cores. With preload_app the app is imported once in the master and
+shared copy-on-write by the workers.
+"""
+
+bind = settings.get('GUNICORN_BIND', '0.0.0.0:5050')
+workers = settings.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1)
+worker_class = settings.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = settings.get('GUNICORN_THREADS', 4)
+preload_app = settings.get('GUNICORN_PRELOAD', True)
+keepalive = settings.get('GUNICORN_KEEPALIVE', 5)
+timeout = settings.get('GUNICORN_TIMEOUT', 60)
+graceful_timeout = settings.get('GUNICORN_GRACEFUL_TIMEOUT', 30)
+# recycle workers after this many requests (plus jitter), 0 disables
+max_requests = settings.get('GUNICORN_MAX_REQUESTS', 0)
+max_requests_jitter = settings.get('GUNICORN_MAX_REQUESTS_JITTER', 0)
+backlog = settings.get('GUNICORN_BACKLOG', 2048)
+# request line and header limits, body size is MAX_CONTENT_LENGTH in the app
+limit_request_line = settings.get('GUNICORN_LIMIT_REQUEST_LINE', 4094)
+limit_request_fields = settings.get('GUNICORN_LIMIT_REQUEST_FIELDS', 100)
+limit_request_field_size = settings.get('GUNICORN_LIMIT_REQUEST_FIELD_SIZE', 8190)
+
+# prometheus_client picks multiprocess mode up from the environment when it
+# is first imported, which is after this file is read
+prometheus_multiproc_dir = settings.get('PROMETHEUS_MULTIPROC_DIR', None)
+if prometheus_multiproc_dir:
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = prometheus_multiproc_dir
+
+
+def on_starting(server):
+    """values left by a previous run would be summed into this one's"""
+    if prometheus_multiproc_dir:
+        os.makedirs(prometheus_multiproc_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(prometheus_multiproc_dir, '*.db')):
+            os.remove(path)
+
+
+def when_ready(server):
+    """master is up, run the background workers here once rather than in every worker"""
+    from src.netbrain_service import bootstrap
+    from src.netbrain_service.entry_points.flask_app.main.app import register_workers
+    bootstrap.bootstrap()
+    register_workers()
+    bootstrap.start_workers()
+
+
+def post_fork(server, worker):
+    """threads, the log listener and the Mongo client don't survive fork, rebuild them"""
+    from src.netbrain_service import bootstrap
+    bootstrap.after_fork()
+
+
+def child_exit(server, worker):
+    """drop the live gauges of a worker that exited"""
+    if prometheus_multiproc_dir:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,13 @@
+from src.netbrain_service.entry_points.flask_app.main.app import create_app
+
+"""
+WSGI entry point for production serving:
+
+    gunicorn -c python:src.netbrain_service.entry_points.flask_app.main.gunicorn_conf \
+        src.netbrain_service.entry_points.flask_app.main.wsgi:app
+
+Background workers are started by the gunicorn master (gunicorn_conf.when_ready),
+not by every worker process.
+"""
+
+app = create_app(start_workers=False)
@@ -0,0 +1,147 @@
+import os
+import copy
+import json
+import atexit
+import queue
+import logging
+
+from logging.handlers import QueueHandler
+from logging.handlers import QueueListener
+from logging.handlers import RotatingFileHandler
+
+from src.netbrain_service.config import settings
+from src.netbrain_service.domain.common import current_cid
+
+
+# This is in order to allow log level customization in the config via LOG_LEVEL=
+log_levels = {
+    'DEBUG': logging.DEBUG,
+    'INFO': logging.INFO,
+    'WARNING': logging.WARNING,
+    'ERROR': logging.ERROR,
+    'CRITICAL': logging.CRITICAL,
+}
+
+
+class Truncated:
+    """
+    Wraps a log argument so it is only converted to a string when the
+    record is actually emitted, and cut down to limit characters so a
+    whole document or payload never ends up in a log line.
+
+    Use with %-style arguments, never inside an f-string:
+        logger.info("create_event_entry > payload: %s", Truncated(payload))
+
+    obj may also be a zero-argument callable (ex. document.to_mongo), which
+    is only called if the record is emitted.
+    """
+    limit = 1000
+
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        text = str(self.obj() if callable(self.obj) else self.obj)
+        if len(text) <= self.limit:
+            return text
+        return f"{text[:self.limit]}... [{len(text) - self.limit} more chars]"
+
+
+class CidFilter(logging.Filter):
+    """
+    Adds the cid from domain.common.current_cid to every record as
+    record.cid, unless the call passed one with extra={'cid': ...}. Must
+    sit on the QueueHandler, which runs in the thread or task that logged,
+    not on the listener's handlers.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, 'cid', None) is None:
+            record.cid = current_cid.get() or '-'
+        return True
+
+
+class RecordQueueHandler(QueueHandler):
+    """
+    QueueHandler whose prepare() keeps the traceback apart from the
+    message. The stock prepare() appends it to msg and clears exc_info,
+    so JsonFormatter on the listener thread could no longer emit it as
+    its own field. The traceback is formatted here, in the thread that
+    logged, and travels as record.exc_text, which logging.Formatter also
+    appends for the text format.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+        # tracebacks don't pickle, and the listener must not touch frames of a running thread
+        record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """one json object per line, so the log file can be indexed and queried by field"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'cid': getattr(record, 'cid', '-'),
+            'message': record.getMessage(),
+            'path': f"{record.pathname}:{record.lineno}",
+        }
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            # formatted by RecordQueueHandler before the record was queued
+            entry['exc_info'] = record.exc_text
+        if record.stack_info:
+            entry['stack_info'] = record.stack_info
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(logger: logging.Logger) -> QueueListener:
+    """
+    Attach a QueueHandler to logger and start a QueueListener that owns the
+    RotatingFileHandler, so the calling thread only puts the record on an
+    in-memory queue and all disk I/O happens on the listener thread.
+
+    LOG_LEVEL, LOG_FILE, LOG_FORMAT ('json' or 'text') and
+    LOG_PAYLOAD_MAX_CHARS come from settings.
+    """
+    log_level = log_levels.get(str(settings.get('LOG_LEVEL', 'DEBUG')).upper(), logging.DEBUG)
+    log_file = settings.get('LOG_FILE', 'logs/netbrain_service.log')
+    Truncated.limit = settings.get('LOG_PAYLOAD_MAX_CHARS', 1000)
+
+    log_dir = os.path.dirname(log_file)
+    if log_dir and not os.path.exists(log_dir):
+        os.makedirs(log_dir, exist_ok=True)
+
+    # set handler to rollover log file at 5mb each, 50mb total
+    file_handler = RotatingFileHandler(log_file, maxBytes=5000000000, backupCount=50)
+    if str(settings.get('LOG_FORMAT', 'json')).lower() == 'json':
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s: %(cid)s %(message)s '
+            '[in %(pathname)s:%(lineno)d]'))
+    file_handler.setLevel(log_level)
+
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    # flush whatever is still queued when the process exits
+    atexit.register(listener.stop)
+
+    queue_handler = RecordQueueHandler(log_queue)
+    queue_handler.addFilter(CidFilter())
+    logger.addHandler(queue_handler)
+    logger.setLevel(log_level)
+    return listener
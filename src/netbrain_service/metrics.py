@@ -0,0 +1,254 @@
+import os
+import time
+import logging
+import threading
+import functools
+
+from typing import Callable, Optional
+
+from prometheus_client import Counter
+from prometheus_client import Gauge
+from prometheus_client import Histogram
+from prometheus_client import REGISTRY
+from prometheus_client import CollectorRegistry
+from prometheus_client import generate_latest
+from prometheus_client import multiprocess
+from prometheus_client.core import GaugeMetricFamily
+
+from pymongo import monitoring
+
+"""
+Prometheus metrics for the service, exposed by the Flask app on /metrics.
+
+Metrics are process wide and registered on the default registry. Label
+values are kept to fixed names (stage, service, endpoint, message type)
+so cardinality stays bounded.
+
+Under gunicorn every worker is its own process. With
+PROMETHEUS_MULTIPROC_DIR set (gunicorn_conf sets it from settings before
+the app is imported) each process writes its values to files in that
+directory and latest() aggregates them, so a scrape sees every worker
+rather than whichever one answered it. Gauges set with set_function are
+not exported in that mode.
+"""
+
+logger = logging.getLogger(__name__)
+
+STAGE_LATENCY = Histogram(
+    'netbrain_pipeline_stage_seconds',
+    'Time spent in each stage of process_event',
+    ['stage'],
+)
+OUTBOUND_LATENCY = Histogram(
+    'netbrain_outbound_request_seconds',
+    'Latency of calls to NetBrain, WSGW and Stackstorm',
+    ['service', 'endpoint'],
+)
+OUTBOUND_ERRORS = Counter(
+    'netbrain_outbound_request_errors_total',
+    'Failed calls to NetBrain, WSGW and Stackstorm, exceptions and unsuccessful responses',
+    ['service', 'endpoint'],
+)
+MESSAGEBUS_QUEUE_DEPTH = Gauge(
+    'netbrain_messagebus_queue_depth',
+    'Messages waiting on the MessageBus queue',
+)
+MESSAGEBUS_CONSUMERS = Gauge(
+    'netbrain_messagebus_consumers',
+    'MessageBus consumer threads started',
+)
+MESSAGEBUS_BUSY_CONSUMERS = Gauge(
+    'netbrain_messagebus_busy_consumers',
+    'MessageBus consumers currently consuming a Message',
+    multiprocess_mode='livesum',
+)
+MESSAGEBUS_LOCK_CONFLICTS = Counter(
+    'netbrain_messagebus_lock_conflicts_total',
+    'Commands discarded because their field_locks were held',
+    ['message_type'],
+)
+BENCHMARK_TASKS_DELETED = Counter(
+    'netbrain_benchmark_tasks_deleted_total',
+    'NetBrain benchmark tasks deleted by the BenchmarkReaper, finished or orphaned',
+    ['kind', 'result'],
+)
+POLLING_TICK = Histogram(
+    'netbrain_polling_manager_tick_seconds',
+    'Duration of one PollingManager loop iteration, excluding the sleep',
+)
+MONGO_POOL_CONNECTIONS = Gauge(
+    'netbrain_mongo_pool_connections',
+    'Open connections in the Mongo connection pool',
+    ['address'],
+    multiprocess_mode='livesum',
+)
+MONGO_POOL_CHECKED_OUT = Gauge(
+    'netbrain_mongo_pool_checked_out_connections',
+    'Mongo connections currently checked out by a thread',
+    ['address'],
+    multiprocess_mode='livesum',
+)
+MONGO_POOL_WAITING = Gauge(
+    'netbrain_mongo_pool_waiting_checkouts',
+    'Threads waiting to check a connection out of the Mongo pool',
+    ['address'],
+    multiprocess_mode='livesum',
+)
+MONGO_POOL_CHECKOUT_FAILURES = Counter(
+    'netbrain_mongo_pool_checkout_failures_total',
+    'Failed Mongo connection checkouts, ex. timeout waiting for a free connection',
+    ['address', 'reason'],
+)
+MONGO_POOL_CLEARED = Counter(
+    'netbrain_mongo_pool_cleared_total',
+    'Times the Mongo connection pool was cleared, usually after a network error',
+    ['address'],
+)
+
+
+def is_failed_status(result) -> bool:
+    """requests_consumer calls return 'Success.' or {'status': 'Success.', ...} when they worked"""
+    status = result.get('status') if isinstance(result, dict) else result
+    return status != 'Success.'
+
+
+def observe_outbound(service: str, endpoint: str, is_error: Optional[Callable] = is_failed_status):
+    """
+    Decorator recording latency of an outbound call, and counting it as an
+    error when it raises or is_error(result) is True.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                OUTBOUND_ERRORS.labels(service, endpoint).inc()
+                raise
+            finally:
+                OUTBOUND_LATENCY.labels(service, endpoint).observe(time.perf_counter() - start)
+            if is_error and is_error(result):
+                OUTBOUND_ERRORS.labels(service, endpoint).inc()
+            return result
+        return wrapper
+    return decorator
+
+
+class MongoPoolListener(monitoring.ConnectionPoolListener):
+    """
+    pymongo pool listener keeping the MONGO_POOL_* metrics current,
+    passed to the client by bootstrap.init_mongo().
+    """
+
+    @staticmethod
+    def __address(event) -> str:
+        host, port = event.address
+        return f"{host}:{port}"
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        MONGO_POOL_CLEARED.labels(self.__address(event)).inc()
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        MONGO_POOL_CONNECTIONS.labels(self.__address(event)).inc()
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        MONGO_POOL_CONNECTIONS.labels(self.__address(event)).dec()
+
+    def connection_check_out_started(self, event):
+        MONGO_POOL_WAITING.labels(self.__address(event)).inc()
+
+    def connection_check_out_failed(self, event):
+        MONGO_POOL_WAITING.labels(self.__address(event)).dec()
+        MONGO_POOL_CHECKOUT_FAILURES.labels(self.__address(event), str(event.reason)).inc()
+
+    def connection_checked_out(self, event):
+        MONGO_POOL_WAITING.labels(self.__address(event)).dec()
+        MONGO_POOL_CHECKED_OUT.labels(self.__address(event)).inc()
+
+    def connection_checked_in(self, event):
+        MONGO_POOL_CHECKED_OUT.labels(self.__address(event)).dec()
+
+
+class StatusCountCollector:
+    """
+    Counts documents per status in the pipeline collections at scrape time,
+    showing how deep each status backlog is.
+
+    Counts are kept for METRICS_STATUS_COUNT_TTL seconds, so frequent or
+    concurrent scrapes don't run the $group on every request.
+    """
+
+    def __init__(self):
+        self._counts: list[tuple[str, str, int]] = []
+        self._counted_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def describe(self):
+        # without describe() the registry calls collect() on register,
+        # which would query Mongo at import time
+        return [GaugeMetricFamily('netbrain_documents_by_status', '', labels=['collection', 'status'])]
+
+    @staticmethod
+    def count() -> list[tuple[str, str, int]]:
+        """(collection, status, documents) for every pipeline collection"""
+        # imported here so that importing metrics doesn't pull in the models
+        from src.netbrain_service.application.mongo_models import IncomingPayload
+        from src.netbrain_service.application.mongo_models import BenchmarkPayload
+        from src.netbrain_service.application.mongo_models import TaskLog
+
+        counts = []
+        for model in (IncomingPayload, BenchmarkPayload, TaskLog):
+            collection = model._meta['collection']
+            try:
+                rows = model.objects.aggregate([{'$group': {'_id': '$status', 'count': {'$sum': 1}}}])
+                counts.extend((collection, str(row['_id']), row['count']) for row in rows)
+            except Exception as e:
+                logger.error("StatusCountCollector unable to count %s documents: %s", collection, e)
+        return counts
+
+    def collect(self):
+        from src.netbrain_service.config import settings
+
+        ttl = settings.get('METRICS_STATUS_COUNT_TTL', 15)
+        with self._lock:
+            if self._counted_at is None or time.monotonic() - self._counted_at >= ttl:
+                self._counts = self.count()
+                self._counted_at = time.monotonic()
+            counts = self._counts
+
+        family = GaugeMetricFamily(
+            'netbrain_documents_by_status',
+            'Documents in each pipeline collection by status',
+            labels=['collection', 'status'],
+        )
+        for collection, status, documents in counts:
+            family.add_metric([collection, status], documents)
+        yield family
+
+
+STATUS_COUNTS = StatusCountCollector()
+REGISTRY.register(STATUS_COUNTS)
+
+
+def latest() -> bytes:
+    """the /metrics exposition, aggregated over every process in multiprocess mode"""
+    if not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        return generate_latest()
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    # counted from Mongo, the same for every process, so collected once here
+    registry.register(STATUS_COUNTS)
+    return generate_latest(registry)
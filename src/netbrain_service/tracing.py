@@ -0,0 +1,158 @@
+import os
+import logging
+import functools
+import threading
+
+from contextlib import contextmanager
+from typing import Optional
+
+from opentelemetry import trace
+from opentelemetry import propagate
+from opentelemetry import context as otel_context
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+from opentelemetry.trace import Status
+from opentelemetry.trace import StatusCode
+
+from pymongo import monitoring
+
+from src.netbrain_service.config import settings
+from src.netbrain_service.domain.common import current_cid
+
+"""
+OpenTelemetry tracing for the service.
+
+Spans are created around ingest, each process_event stage, each MessageBus
+Message, each Mongo command and each outbound HTTP call, and carry the cid
+as an attribute. Trace context is injected into Messages when they are
+queued and extracted when they are consumed, so work picked up by another
+MessageBus consumer continues the same trace.
+
+Until configure_tracing() runs, the tracer is a no-op.
+"""
+
+logger = logging.getLogger(__name__)
+
+tracer = trace.get_tracer('src.netbrain_service')
+
+
+class MongoCommandTracer(monitoring.CommandListener):
+    """
+    pymongo command listener that records a span for every command sent
+    to Mongo. started/succeeded/failed are delivered on the thread that
+    ran the command, so the span is parented to whatever span is current
+    there (ex. the pipeline stage).
+    """
+
+    def __init__(self):
+        self._spans = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        span = tracer.start_span(
+            f"mongo.{event.command_name}",
+            kind=trace.SpanKind.CLIENT,
+            attributes={
+                'db.system': 'mongodb',
+                'db.name': event.database_name,
+                'db.operation': event.command_name,
+                'db.mongodb.collection': str(event.command.get(event.command_name, '')),
+            },
+        )
+        cid = current_cid.get()
+        if cid:
+            span.set_attribute('cid', cid)
+        with self._lock:
+            self._spans[(event.connection_id, event.request_id)] = span
+
+    def __finish(self, event) -> Optional[trace.Span]:
+        with self._lock:
+            return self._spans.pop((event.connection_id, event.request_id), None)
+
+    def succeeded(self, event):
+        span = self.__finish(event)
+        if span:
+            span.end()
+
+    def failed(self, event):
+        span = self.__finish(event)
+        if span:
+            span.set_status(Status(StatusCode.ERROR, str(event.failure)))
+            span.end()
+
+
+def configure_tracing() -> Optional[TracerProvider]:
+    """
+    Install the tracer provider selected by TRACE_EXPORTER:
+        'none' (default) - tracing stays a no-op
+        'file'           - one json span per line appended to TRACE_FILE
+        'otlp'           - sent to the collector at OTLP_ENDPOINT over http
+
+    Also registers the Mongo command listener, which must happen before
+    the Mongo client is created.
+    """
+    exporter_name = str(settings.get('TRACE_EXPORTER', 'none')).lower()
+    if exporter_name == 'none':
+        return None
+
+    if exporter_name == 'otlp':
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        exporter = OTLPSpanExporter(endpoint=settings.get('OTLP_ENDPOINT', 'http://localhost:4318/v1/traces'))
+    else:
+        trace_file = settings.get('TRACE_FILE', 'logs/netbrain_service.traces')
+        trace_dir = os.path.dirname(trace_file)
+        if trace_dir and not os.path.exists(trace_dir):
+            os.makedirs(trace_dir, exist_ok=True)
+        exporter = ConsoleSpanExporter(
+            out=open(trace_file, 'a'),
+            formatter=lambda span: span.to_json(indent=None) + os.linesep,
+        )
+
+    provider = TracerProvider(resource=Resource.create({'service.name': 'netbrain_service'}))
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+    monitoring.register(MongoCommandTracer())
+    logger.info("tracing configured with %s exporter", exporter_name)
+    return provider
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """start a span as the current span, tagged with the current cid"""
+    with tracer.start_as_current_span(name) as current:
+        cid = current_cid.get()
+        if cid:
+            current.set_attribute('cid', cid)
+        for key, value in attributes.items():
+            current.set_attribute(key, value)
+        yield current
+
+
+def traced(name: str):
+    """decorator running the function inside span(name)"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def inject_trace_context() -> dict:
+    """serialize the current trace context (w3c traceparent) into a dict that can travel with a Message"""
+    carrier: dict = {}
+    propagate.inject(carrier)
+    return carrier
+
+
+@contextmanager
+def extracted_trace_context(carrier: Optional[dict]):
+    """make the trace context carried by a Message current for the with block"""
+    token = otel_context.attach(propagate.extract(carrier or {}))
+    try:
+        yield
+    finally:
+        otel_context.detach(token)
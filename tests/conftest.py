@@ -0,0 +1,51 @@
+import os
+import tempfile
+
+# logging is configured on create_app, keep the log file out of the tree
+os.environ.setdefault('DYNACONF_LOG_FILE', os.path.join(tempfile.mkdtemp(), 'netbrain_service.log'))
+
+import mongomock
+import mongoengine
+import pytest
+
+from src.netbrain_service.config import settings
+
+
+@pytest.fixture
+def mongo():
+    """a fresh in-memory Mongo behind the default mongoengine connection"""
+    mongoengine.connect('netbrain_test', host='mongodb://localhost', mongo_client_class=mongomock.MongoClient,
+                         uuidRepresentation='standard')
+    yield
+    mongoengine.disconnect()
+
+
+@pytest.fixture
+def override_settings():
+    """set settings for one test, restored afterwards"""
+    missing = object()
+    previous = {}
+
+    def override(**values):
+        for key, value in values.items():
+            previous.setdefault(key, settings.get(key, missing))
+            settings.set(key, value)
+
+    yield override
+    for key, value in previous.items():
+        if value is missing:
+            settings.unset(key)
+        else:
+            settings.set(key, value)
+
+
+@pytest.fixture(autouse=True)
+def reset_singletons():
+    """process wide caches built from settings start empty in every test"""
+    from src.netbrain_service.application import device_data_cache
+    from src.netbrain_service.application import device_inventory
+    device_data_cache._device_data_cache = None
+    device_inventory._device_inventory = None
+    yield
+    device_data_cache._device_data_cache = None
+    device_inventory._device_inventory = None
@@ -0,0 +1,121 @@
+import time
+
+from datetime import datetime
+
+import pytest
+
+from bson import ObjectId
+
+from src.netbrain_service.application import command_consumers
+from src.netbrain_service.application.benchmark_reaper import BenchmarkReaper
+from src.netbrain_service.application.mongo_models import Benchmark
+from src.netbrain_service.application.mongo_models import BenchmarkPayload
+from src.netbrain_service.application.mongo_models import DeviceScope
+from src.netbrain_service.application.mongo_models import LoginToken
+from src.netbrain_service.application.mongo_models import Schedule
+from src.netbrain_service.application.mongo_models import TaskLog
+from src.netbrain_service.domain.common import CID_TIME_CHARS
+from src.netbrain_service.domain.common import _base62
+
+
+def task_name(age: float, suffix: str) -> str:
+    """a Benchmark_event_ name whose cid was created age seconds ago"""
+    ms = int((time.time() - age) * 1000)
+    return f'Benchmark_event_{_base62(ms, CID_TIME_CHARS)}{suffix * 17}'
+
+
+def task_log(name, status, **fields):
+    return TaskLog(parent_id=ObjectId(), task_name=name, ipaddress='10.0.0.1', content='', status=status,
+                   created_datetime=datetime.utcnow(), **fields).save()
+
+
+def benchmark_payload(name, status):
+    return BenchmarkPayload(
+        parent_id=ObjectId(), status=status, created_datetime=datetime.utcnow(),
+        benchmark_payload=Benchmark(taskName=name, startDate='2024-01-01',
+                                    schedule=Schedule(frequency='once', startTime=['00:00:00']),
+                                    deviceScope=DeviceScope(scopeType='site', scopes=['My Network']),
+                                    cliCommands=['showversion'])).save()
+
+
+@pytest.fixture
+def netbrain(monkeypatch):
+    """records the calls the reaper makes through the NetBrain request module"""
+    calls = {'login': 0, 'logout': [], 'delete': [], 'fail': set()}
+
+    def login_to_netbrain(username, password):
+        calls['login'] += 1
+        return {'status': 'Success.', 'token': f'reaper-{calls["login"]}'}
+
+    def delete_task(token, name):
+        calls['delete'].append((token, name))
+        return 'Error: 500' if name in calls['fail'] else 'Success.'
+
+    api = command_consumers.requests_consumer
+    monkeypatch.setattr(api, 'login_to_netbrain', login_to_netbrain)
+    monkeypatch.setattr(api, 'logout_from_netbrain', lambda token: calls['logout'].append(token) or 'Success.')
+    monkeypatch.setattr(api, 'delete_task', delete_task)
+    return calls
+
+
+def test_orphans_are_old_unreferenced_benchmark_tasks(mongo):
+    old, young, busy, adding, done = (task_name(7200, 'a'), task_name(60, 'b'), task_name(7200, 'c'),
+                                      task_name(7200, 'd'), task_name(7200, 'e'))
+    task_log(busy, 'DELETE_TASK')
+    task_log(done, 'COMPLETED')
+    benchmark_payload(adding, 'ADDING')
+    reaper = BenchmarkReaper(orphan_min_age=3600)
+
+    orphans = reaper.orphaned_task_names([old, young, busy, adding, done, 'Benchmark_event_legacy', 'Other_task'])
+
+    assert orphans == [old, done]
+
+
+def test_ready_task_names_waits_for_every_device(mongo):
+    task_log('group', 'DELETE_TASK')
+    task_log('group', 'PROCESS_CONTENT')
+    task_log('single', 'DELETE_TASK')
+    # written before from_cache existed
+    TaskLog._get_collection().insert_one({'parent_id': ObjectId(), 'task_name': 'legacy', 'ipaddress': '10.0.0.2',
+                                          'content': '', 'status': 'DELETE_TASK',
+                                          'created_datetime': datetime.utcnow()})
+    task_log('cached', 'DELETE_TASK', from_cache=True)
+
+    assert sorted(BenchmarkReaper().ready_task_names()) == ['legacy', 'single']
+
+
+def test_reaper_uses_its_own_session(mongo, netbrain):
+    LoginToken(token='shared', datetime=datetime.utcnow()).save()
+    task_log('done', 'DELETE_TASK')
+    reaper = BenchmarkReaper(rate=1000)
+
+    assert reaper.reap_batch() == 1
+
+    assert netbrain['delete'] == [('reaper-1', 'done')]
+    assert TaskLog.objects.get(task_name='done').status == 'COMPLETED'
+    assert LoginToken.objects.get().token == 'shared'
+
+
+def test_failed_deletes_back_off_and_renew_the_session(mongo, netbrain):
+    task_log('done', 'DELETE_TASK')
+    task_log('stuck', 'DELETE_TASK')
+    netbrain['fail'].add('stuck')
+    reaper = BenchmarkReaper(rate=1000, poll_interval=1)
+
+    assert reaper.reap_batch() == 2
+
+    stuck = TaskLog.objects.get(task_name='stuck')
+    assert stuck.status == 'DELETE_TASK' and stuck.delete_attempts == 1
+    assert stuck.next_delete_datetime > datetime.utcnow()
+    assert netbrain['logout'] == ['reaper-1']
+    # waiting out its backoff
+    assert reaper.reap_batch() == 0
+
+
+def test_deletes_give_up_after_max_attempts(mongo, netbrain):
+    task_log('stuck', 'DELETE_TASK', delete_attempts=2)
+    netbrain['fail'].add('stuck')
+
+    BenchmarkReaper(rate=1000, max_attempts=3).reap_batch()
+
+    assert TaskLog.objects.get(task_name='stuck').status == 'COMPLETED'
@@ -0,0 +1,119 @@
+from datetime import datetime
+from datetime import timedelta
+
+from bson import ObjectId
+
+from src.netbrain_service.application import command_consumers
+from src.netbrain_service.application.command_consumers import DEVICE_DATA_CMD
+from src.netbrain_service.application.command_consumers import DEVICE_DATA_TYPE
+from src.netbrain_service.application.content_parser import store_parsed_records
+from src.netbrain_service.application.content_parser import store_parsed_records_many
+from src.netbrain_service.application.device_data_cache import get_device_data_cache
+from src.netbrain_service.application.mongo_models import DeviceInventoryEntry
+from src.netbrain_service.application.mongo_models import IncomingPayload
+from src.netbrain_service.application.mongo_models import ParsedRecord
+from src.netbrain_service.application.mongo_models import TaskLog
+
+SITE = 'My Network/USA/TEXAS/Westlake/Westlake Lab'
+CONTENT = 'TenGigE0/0/0/0 is up, line protocol is up\n Vendor : Cisco\n Temperature : 30 C\n'
+
+
+def incoming_payload(devicename, ipaddress, cid):
+    return IncomingPayload(devicename=devicename, ipaddress=ipaddress, objectname='Te0/0/0/0', cid=cid,
+                           related_cids=[cid], status='NEW', created_datetime=datetime.utcnow()).save()
+
+
+def task_log(ipaddress, status='PROCESS_CONTENT', **fields):
+    return TaskLog(parent_id=ObjectId(), task_name='Benchmark_event_x', ipaddress=ipaddress, content=CONTENT,
+                   status=status, created_datetime=datetime.utcnow(), **fields).save()
+
+
+def inventory(*devices):
+    for devicename, ipaddress in devices:
+        DeviceInventoryEntry(devicename=devicename, ipaddress=ipaddress, site_path=f'{SITE}/{devicename}',
+                             updated_datetime=datetime.utcnow()).save()
+
+
+def test_device_not_in_inventory_is_rejected_before_the_cache(mongo):
+    inventory(('SAP1', '10.0.0.1'))
+    get_device_data_cache().put('10.0.0.9', DEVICE_DATA_TYPE, DEVICE_DATA_CMD, CONTENT)
+    payload = incoming_payload('UNKNOWN', '10.0.0.9', 'cid-1')
+
+    command_consumers.translate_incoming_payload_to_benchmark_payload()
+
+    payload.reload()
+    assert payload.status == 'INVALID_DEVICE' and not payload.in_flight
+    assert TaskLog.objects.count() == 0
+
+
+def test_cached_device_data_is_used_for_inventory_devices(mongo):
+    inventory(('SAP1', '10.0.0.1'))
+    get_device_data_cache().put('10.0.0.1', DEVICE_DATA_TYPE, DEVICE_DATA_CMD, CONTENT)
+    payload = incoming_payload('SAP1', '10.0.0.1', 'cid-1')
+
+    command_consumers.translate_incoming_payload_to_benchmark_payload()
+
+    assert payload.reload().status == 'COMPLETED'
+    cached = TaskLog.objects.get(parent_id=payload.id)
+    assert cached.from_cache and cached.status == 'PROCESS_CONTENT' and cached.cids == ['cid-1']
+
+
+def test_legacy_site_paths_serve_an_empty_inventory(mongo):
+    assert command_consumers.get_device_name('SAP1') == f'{SITE}/ADRMTXAA7'
+    inventory(('NEC1', '10.0.0.2'))
+    command_consumers.get_device_inventory().refresh(full=True)
+    assert command_consumers.get_device_name('SAP1') == 'Invalid device'
+
+
+def test_incoming_payload_is_claimed_once(mongo):
+    payload = incoming_payload('SAP1', '10.0.0.1', 'cid-1')
+
+    assert command_consumers.claim_incoming_payload(payload)
+    assert not command_consumers.claim_incoming_payload(payload)
+    assert payload.reload().status == 'TRANSLATING'
+
+
+def test_create_event_entry_attaches_in_flight_duplicates(mongo):
+    fields = {'devicename': 'SAP1', 'ipaddress': '10.0.0.1', 'objectname': 'Te0/0/0/0'}
+
+    first = command_consumers.create_event_entry({**fields, 'cid': 'cid-1'})
+    second = command_consumers.create_event_entry({**fields, 'cid': 'cid-2'})
+
+    assert not first['duplicate'] and second['duplicate']
+    assert second['tracking_id'] == first['tracking_id'] and second['cid'] == 'cid-1'
+    assert IncomingPayload.objects.count() == 1
+
+
+def test_parsed_records_are_stored_once(mongo):
+    log = task_log('10.0.0.1')
+
+    assert store_parsed_records(log, DEVICE_DATA_CMD) == {'status': 'Success.', 'records': 3}
+    store_parsed_records(log, DEVICE_DATA_CMD)
+    store_parsed_records_many([log], DEVICE_DATA_CMD)
+
+    assert ParsedRecord.objects(task_log_id=log.id).count() == 3
+    assert sorted(ParsedRecord.objects(task_log_id=log.id).distinct('seq')) == [0, 1, 2]
+
+
+def test_process_device_content_skips_claimed_task_logs(mongo):
+    claimed = task_log('10.0.0.1', status='PARSING', parsing_datetime=datetime.utcnow())
+    abandoned = task_log('10.0.0.2', status='PARSING', parsing_datetime=datetime.utcnow() - timedelta(hours=1))
+    new = task_log('10.0.0.3')
+
+    command_consumers.process_device_content()
+
+    assert claimed.reload().status == 'PARSING'
+    assert ParsedRecord.objects(task_log_id=claimed.id).count() == 0
+    for log in (abandoned, new):
+        assert log.reload().status == 'DELETE_TASK'
+        assert ParsedRecord.objects(task_log_id=log.id).count() == 3
+
+
+def test_process_device_content_hands_back_failed_parses(mongo, monkeypatch):
+    log = task_log('10.0.0.1')
+    monkeypatch.setattr(command_consumers, 'store_parsed_records_many',
+                        lambda task_logs, cmd: {task_log.id: {'status': 'Error: boom'} for task_log in task_logs})
+
+    command_consumers.process_device_content()
+
+    assert log.reload().status == 'PROCESS_CONTENT'
@@ -0,0 +1,146 @@
+import json
+
+import pytest
+
+from src.netbrain_service import bootstrap
+from src.netbrain_service.application import event_consumer
+from src.netbrain_service.application.mongo_models import IncomingPayload
+from src.netbrain_service.entry_points.flask_app.main.app import create_app
+
+
+def payload(**fields):
+    return {'objectname': 'Te0/0/0/0', 'ipaddress': '10.0.0.1', 'devicename': 'SAP1', **fields}
+
+
+@pytest.fixture
+def make_client(mongo, monkeypatch):
+    """test client of an app without workers, the pipeline stages after ingest don't run"""
+    monkeypatch.setattr(bootstrap, '_mongo_ready', True)
+    monkeypatch.setattr(event_consumer, 'process_pending', lambda consumer=None: None)
+    return lambda: create_app(start_workers=False).test_client()
+
+
+@pytest.fixture
+def client(make_client):
+    return make_client()
+
+
+def test_single_payload_is_registered(client):
+    response = client.post('/api/v1/request', json=payload(cid='cid-1'))
+
+    assert response.status_code == 200
+    code, msg, data = response.get_json()
+    assert (code, msg) == (200, 'Success.')
+    assert data['cid'] == 'cid-1' and not data['duplicate']
+    assert IncomingPayload.objects(cid='cid-1', status='NEW').count() == 1
+
+
+def test_single_payload_gets_a_cid(client):
+    response = client.post('/api/v1/request', json=payload())
+
+    assert response.status_code == 200
+    assert response.get_json()[2]['cid']
+
+
+def test_duplicate_single_payload_is_accepted(client):
+    client.post('/api/v1/request', json=payload(cid='cid-1'))
+    response = client.post('/api/v1/request', json=payload(cid='cid-2'))
+
+    assert response.status_code == 200
+    code, msg, data = response.get_json()
+    assert (code, msg) == (200, 'Success.')
+    assert data == {'cid': 'cid-1', 'tracking_id': data['tracking_id'], 'duplicate': True}
+    assert IncomingPayload.objects.get(cid='cid-1').related_cids == ['cid-1', 'cid-2']
+
+
+@pytest.mark.parametrize('body', [
+    payload(ipaddress='10.0.0.300'),
+    payload(devicename=''),
+    {'objectname': 'Te0/0/0/0', 'ipaddress': '10.0.0.1'},
+])
+def test_invalid_single_payload_is_400(client, body):
+    response = client.post('/api/v1/request', json=body)
+
+    assert response.status_code == 400
+    code, msg, errors = response.get_json()
+    assert code == 400 and errors
+    assert IncomingPayload.objects.count() == 0
+
+
+def test_malformed_json_is_400(client):
+    response = client.post('/api/v1/request', data=b'{"objectname": ', content_type='application/json')
+
+    assert response.status_code == 400
+    assert response.get_json()[2][0]['field'] == 'body'
+
+
+def test_pipeline_failure_is_500(client, monkeypatch):
+    monkeypatch.setattr('src.netbrain_service.application.command_consumers.create_event_entry',
+                        lambda payload: {'status': 'create_event_entry failed.', 'tracking_id': None, 'cid': None,
+                                         'duplicate': False})
+
+    response = client.post('/api/v1/request', json=payload(cid='cid-1'))
+
+    assert response.status_code == 500
+    assert 'CID=cid-1' in response.get_json()[1]
+
+
+def test_pipeline_exception_reports_the_request_cid(client, monkeypatch):
+    def fail(payload):
+        raise RuntimeError('boom')
+    monkeypatch.setattr('src.netbrain_service.application.command_consumers.create_event_entry', fail)
+
+    response = client.post('/api/v1/request', json=payload(cid='cid-1'))
+
+    assert response.status_code == 500
+    assert response.get_json()[1].startswith('CID=cid-1 ')
+
+
+def test_batch_validates_every_item(client):
+    items = [payload(cid='cid-1'), payload(ipaddress='not an ip', cid='cid-2'), 'not an object',
+             payload(devicename='NEC1', ipaddress='10.0.0.2', cid='cid-3')]
+
+    response = client.post('/api/v1/requests', json=items)
+
+    assert response.status_code == 200
+    results = response.get_json()[2]['results']
+    assert [result['index'] for result in results] == [0, 1, 2, 3]
+    assert [result['status'] for result in results] == ['Success.', 'Invalid payload.', 'Invalid payload.', 'Success.']
+    assert results[1]['cid'] == 'cid-2' and results[1]['errors'][0]['field'] == 'ipaddress'
+    assert results[2]['cid'] is None
+    assert sorted(IncomingPayload.objects.distinct('cid')) == ['cid-1', 'cid-3']
+
+
+def test_batch_ndjson_keeps_line_positions(client):
+    body = b'\n'.join([json.dumps(payload(cid='cid-1')).encode(), b'{broken', b'',
+                       json.dumps(payload(devicename='NEC1', cid='cid-2')).encode()])
+
+    response = client.post('/api/v1/requests', data=body, content_type='application/x-ndjson')
+
+    assert response.status_code == 200
+    results = response.get_json()[2]['results']
+    assert [result['status'] for result in results] == ['Success.', 'Invalid payload.', 'Success.']
+
+
+def test_empty_batch_is_400(client):
+    response = client.post('/api/v1/requests', json=[])
+
+    assert response.status_code == 400
+
+
+def test_batch_over_item_limit_is_413(client, override_settings):
+    override_settings(INGEST_BATCH_MAX_ITEMS=2)
+
+    response = client.post('/api/v1/requests', json=[payload(cid=f'cid-{index}') for index in range(3)])
+
+    assert response.status_code == 413
+    assert IncomingPayload.objects.count() == 0
+
+
+def test_body_over_content_length_is_413(make_client, override_settings):
+    override_settings(MAX_CONTENT_LENGTH=64)
+    client = make_client()
+
+    response = client.post('/api/v1/request', json=payload(objectname='x' * 100))
+
+    assert response.status_code == 413
@@ -0,0 +1,131 @@
+import asyncio
+
+import httpx
+import pytest
+
+from src.netbrain_service.domain import exceptions
+from src.netbrain_service.domain.wsgw import Wsgw
+from src.netbrain_service.domain.wsgw import WsgwConfig
+
+URL = 'http://wsgw.test/api'
+
+
+@pytest.fixture
+def gateway():
+    """a Wsgw whose client answers from the responses queued on it, one per request"""
+    requests = []
+    responses = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        response = responses.pop(0)
+        if isinstance(response, type) and issubclass(response, httpx.TransportError):
+            raise response('simulated', request=request)
+        return httpx.Response(response, json={})
+
+    wsgw = Wsgw(WsgwConfig(api_url=URL, api_un='user', api_pw='secret', retries=2, retry_backoff=0),
+                transport=httpx.MockTransport(handler))
+    wsgw.requests = requests
+    wsgw.responses = responses
+    yield wsgw
+    wsgw.close()
+
+
+def test_get_is_retried_on_gateway_errors(gateway):
+    gateway.responses[:] = [503, 502, 200]
+
+    response = gateway.api_action('GET', f'{URL}/CMDB/Devices')
+
+    assert response.status_code == 200
+    assert len(gateway.requests) == 3
+
+
+def test_get_returns_the_last_response_when_retries_run_out(gateway):
+    gateway.responses[:] = [503, 503, 504]
+
+    assert gateway.api_action('GET', f'{URL}/CMDB/Devices').status_code == 504
+    assert len(gateway.requests) == 3
+
+
+def test_get_is_retried_on_transport_errors(gateway):
+    gateway.responses[:] = [httpx.ReadTimeout, httpx.ReadTimeout, httpx.ReadTimeout]
+
+    with pytest.raises(exceptions.ApiActionError):
+        gateway.api_action('GET', f'{URL}/CMDB/Devices')
+    assert len(gateway.requests) == 3
+
+
+def test_get_is_not_retried_on_client_errors(gateway):
+    gateway.responses[:] = [404]
+
+    assert gateway.api_action('GET', f'{URL}/CMDB/Devices').status_code == 404
+    assert len(gateway.requests) == 1
+
+
+@pytest.mark.parametrize('response', [503, httpx.ReadTimeout, httpx.RemoteProtocolError])
+def test_post_is_not_retried_once_sent(gateway, response):
+    gateway.responses[:] = [response, 200]
+
+    with pytest.raises(exceptions.ApiActionError):
+        gateway.api_action('POST', f'{URL}/CMDB/Benchmark/Tasks', data={'taskName': 'x'})
+    assert len(gateway.requests) == 1
+
+
+@pytest.mark.parametrize('response', [httpx.ConnectError, httpx.ConnectTimeout])
+def test_post_is_retried_when_never_sent(gateway, response):
+    gateway.responses[:] = [response, 200]
+
+    assert gateway.api_action('POST', f'{URL}/CMDB/Benchmark/Tasks', data={'taskName': 'x'}).status_code == 200
+    assert len(gateway.requests) == 2
+
+
+def test_async_calls_share_the_loop(gateway):
+    gateway.responses[:] = [503, 200, 200]
+
+    async def calls():
+        try:
+            return await asyncio.gather(gateway.api_action_async('GET', f'{URL}/CMDB/Devices'),
+                                        gateway.device_data_async('10.0.0.1'))
+        finally:
+            await gateway.aclose()
+
+    response, device_data = asyncio.run(calls())
+
+    assert response.status_code == 200 and device_data == {}
+    assert len(gateway.requests) == 3
+
+
+def test_token_is_acquired_once_for_every_loop(monkeypatch):
+    logins = []
+    tokens = {}
+
+    def login(url, json=None, timeout=None):
+        logins.append(url)
+        return httpx.Response(200, json={'token': f'token-{len(logins)}'}, request=httpx.Request('POST', url))
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        token = request.headers['token']
+        tokens[token] = tokens.get(token, 0) + 1
+        # the gateway forgets the first token once
+        if token == 'token-1' and tokens[token] == 2:
+            return httpx.Response(401)
+        return httpx.Response(200, json={})
+
+    monkeypatch.setattr(httpx, 'post', login)
+    wsgw = Wsgw(WsgwConfig(api_url=URL, api_un='user', api_pw='secret', auth_type='TOKEN'),
+                transport=httpx.MockTransport(handler))
+
+    async def calls():
+        try:
+            return await asyncio.gather(*(wsgw.api_action_async('GET', f'{URL}/CMDB/Devices') for i in range(3)))
+        finally:
+            await wsgw.aclose()
+
+    try:
+        assert wsgw.api_action('GET', f'{URL}/CMDB/Devices').status_code == 200
+        assert [response.status_code for response in asyncio.run(calls())] == [200, 200, 200]
+    finally:
+        wsgw.close()
+
+    assert logins == [f'{URL}/Session', f'{URL}/Session']
+    assert tokens == {'token-1': 2, 'token-2': 3}